@@ -6,6 +6,7 @@ try:
     from aiogram import Bot, Dispatcher
     from aiogram.client.default import DefaultBotProperties
     from app.config import settings
+    from app.db import init_db, close_db
     from app.handlers import admin_menu, admin_stats
 except Exception as e:
     print(">>> IMPORT FAIL:", repr(e), flush=True)
@@ -31,12 +32,15 @@ async def main() -> None:
 
     log.info("ADMIN_BOT_TOKEN startswith: %s***", token[:10])
 
+    await init_db()
+
     bot = Bot(token=token, default=DefaultBotProperties(parse_mode="HTML"))
     dp = Dispatcher()
 
     # Только админ-роутеры, без channel_admin/scheduler
     dp.include_router(admin_menu.router)
     dp.include_router(admin_stats.router)
+    admin_stats.disable_process_stats()  # счётчики в памяти есть только у основного бота
 
     # Пробный вызов get_me — сразу видно, если токен некорректен
     try:
@@ -58,6 +62,10 @@ async def main() -> None:
             await bot.session.close()
         except Exception:
             log.exception("Close session error")
+        try:
+            await close_db()
+        except Exception:
+            log.exception("Close DB error")
         print(">>> main() end (admin)", flush=True)
 
 if __name__ == "__main__":
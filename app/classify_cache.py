@@ -0,0 +1,106 @@
+# app/classify_cache.py
+"""
+Кэш меток классификатора (llm.classify).
+
+Ключ — хэш версии классификатора и prefilter.normalize_text(текста):
+повторы и тексты, отличающиеся только регистром и пробелами, не идут в LLM.
+Версия — хэш промпта и набора меток: поменяли CLASSIFIER_PROMPT — старые
+записи просто перестают совпадать и стареют по TTL.
+
+Память: LRU + TTL. Опционально — таблица classify_cache в SQLite, чтобы
+метки переживали перезапуск (CLASSIFY_CACHE_SQLITE); записи туда уходят
+через write-behind очередь db.py вместе с прочими мелкими записями.
+"""
+from __future__ import annotations
+
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from .db import read_db, write_db, store_classify_label
+from .prefilter import normalize_text
+
+Result = Tuple[str, float]  # (label, confidence)
+
+
+def classifier_version(prompt: str, labels: Iterable[str]) -> str:
+    h = hashlib.blake2b(digest_size=6)
+    h.update(prompt.strip().encode("utf-8"))
+    h.update(b"\0")
+    h.update(",".join(sorted(labels)).encode("utf-8"))
+    return h.hexdigest()
+
+
+class ClassifyCache:
+    def __init__(self, version: str, max_items: int, ttl_sec: float, use_sqlite: bool):
+        self.version = version
+        self.max_items = max(0, int(max_items))
+        self.ttl = float(ttl_sec)
+        self.use_sqlite = bool(use_sqlite)
+        self._data: "OrderedDict[str, Tuple[str, float, float]]" = OrderedDict()  # key → (label, conf, ts)
+
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def key(self, text: str) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(self.version.encode("ascii"))
+        h.update(b"\0")
+        h.update(normalize_text(text).encode("utf-8"))
+        return h.hexdigest()
+
+    def _fresh(self, ts: float, now: float) -> bool:
+        return self.ttl <= 0 or now - ts <= self.ttl
+
+    async def get(self, key: str) -> Optional[Result]:
+        now = time.time()
+        e = self._data.get(key)
+        if e is not None:
+            if self._fresh(e[2], now):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return e[0], e[1]
+            del self._data[key]
+        if self.use_sqlite:
+            async with read_db() as db:
+                cur = await db.execute(
+                    "SELECT label, confidence, created_at FROM classify_cache WHERE key=?", (key,)
+                )
+                row = await cur.fetchone()
+                await cur.close()
+            if row and self._fresh(row[2], now):
+                self.db_hits += 1
+                self._put(key, row[0], float(row[1]), float(row[2]))
+                return row[0], float(row[1])
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, label: str, confidence: float) -> None:
+        now = time.time()
+        self._put(key, label, confidence, now)
+        if self.use_sqlite:
+            # промах кэша — обычное дело; commit на каждый ждал бы общий писатель, поэтому пишем пачкой
+            store_classify_label(key, label, confidence, int(now))
+
+    def _put(self, key: str, label: str, confidence: float, ts: float) -> None:
+        if self.max_items == 0:
+            return
+        self._data[key] = (label, confidence, ts)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_items:
+            self._data.popitem(last=False)
+
+    async def prune(self) -> int:
+        """Удаляет из SQLite записи старше TTL (в т.ч. от прошлых версий промпта)."""
+        if not self.use_sqlite or self.ttl <= 0:
+            return 0
+        async with write_db() as db:
+            cur = await db.execute(
+                "DELETE FROM classify_cache WHERE created_at < ?", (int(time.time() - self.ttl),)
+            )
+            return cur.rowcount or 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"items": len(self._data), "hits": self.hits, "db_hits": self.db_hits, "misses": self.misses}
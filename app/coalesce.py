@@ -0,0 +1,72 @@
+# app/coalesce.py
+"""
+Склейка быстрых сообщений пользователя в одну реплику.
+
+Люди часто пишут мысль в 2–3 сообщения подряд. Первое сообщение открывает
+окно и ждёт тишины window секунд (каждое новое сообщение продлевает ожидание,
+но не дальше max_wait от первого); следующие просто дописываются в окно.
+Ответ один — на склеенный текст: один вызов LLM и одно списание лимита.
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Dict, List, Optional
+
+
+class _Turn:
+    __slots__ = ("parts", "first", "last")
+
+    def __init__(self, text: str, now: float):
+        self.parts: List[str] = [text]
+        self.first = now
+        self.last = now
+
+
+class Coalescer:
+    def __init__(self, window_sec: float, max_wait_sec: float):
+        self.window = max(0.0, float(window_sec))
+        self.max_wait = max(self.window, float(max_wait_sec))
+        self._open: Dict[int, _Turn] = {}
+
+        self.turns = 0
+        self.merged = 0  # сообщений, дописанных в чужое окно
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    async def collect(self, key: int, text: str) -> Optional[str]:
+        """
+        Текст реплики целиком — если это сообщение открыло окно (его обработчик
+        и отвечает); None — сообщение ушло в уже открытое окно, отвечать не нужно.
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        turn = self._open.get(key)
+        if turn is not None:
+            turn.parts.append(text)
+            turn.last = now
+            self.merged += 1
+            return None
+        if not self.enabled:
+            return text
+        turn = self._open[key] = _Turn(text, now)
+        try:
+            while True:
+                # конец окна только отодвигается — спим до него и пересчитываем
+                delay = min(turn.last + self.window, turn.first + self.max_wait) - loop.time()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        finally:
+            self._open.pop(key, None)
+        self.turns += 1
+        return "\n".join(turn.parts)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "open": len(self._open),
+            "turns": self.turns,
+            "merged": self.merged,
+            "avg_parts": (self.turns + self.merged) / self.turns if self.turns else 0.0,
+        }
@@ -40,6 +40,21 @@ def _parse_int_list(env_value: Optional[str]) -> List[int]:
             continue
     return out
 
+def _parse_json_list(env_value: Optional[str]) -> List[Dict]:
+    """
+    Читает из ENV JSON-список словарей. Невалидное значение → [].
+    Пример: LLM_PROVIDERS='[{"name":"ds","url":"https://...","api_key_env":"DEEPSEEK_API_KEY","models":{"chat":"deepseek-chat"}}]'
+    """
+    if not env_value:
+        return []
+    try:
+        obj = json.loads(env_value)
+    except Exception:
+        return []
+    if not isinstance(obj, list):
+        return []
+    return [x for x in obj if isinstance(x, dict)]
+
 def _parse_json_dict(env_value: Optional[str]) -> Optional[Dict]:
     """
     Читает JSON-словарь из ENV. Возвращает dict или None.
@@ -68,6 +83,77 @@ class Settings(BaseModel):
     # --- LLM ---
     deepseek_api_key: str = os.getenv("DEEPSEEK_API_KEY", "")
     deepseek_model: str = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+    # Модель для классификатора (можно дешевле/быстрее основной)
+    deepseek_classify_model: str = os.getenv("DEEPSEEK_CLASSIFY_MODEL", "") or deepseek_model
+    # Несколько OpenAI-совместимых провайдеров (JSON-список), запросы идут туда,
+    # где ниже p95 задержки и меньше ошибок; при сбое — на следующего.
+    # Поля: name, url, api_key или api_key_env, models {"chat": ..., "classify": ...},
+    # routes (необязательно: какие маршруты обслуживает). Пусто — один DeepSeek из DEEPSEEK_*
+    llm_providers: List[Dict] = _parse_json_list(os.getenv("LLM_PROVIDERS"))
+    # Кэш меток классификатора: размер в памяти, срок жизни и хранение в SQLite (переживает рестарт)
+    classify_cache_max: int = int(os.getenv("CLASSIFY_CACHE_MAX", "20000"))
+    classify_cache_ttl_sec: int = int(os.getenv("CLASSIFY_CACHE_TTL_SEC", str(7 * 24 * 3600)))
+    classify_cache_sqlite: bool = os.getenv("CLASSIFY_CACHE_SQLITE", "1").strip().lower() in ("1", "true", "yes", "on")
+    # Микро-батчинг классификатора: до N текстов или ждать не дольше стольких мс — один запрос (1 — без батчинга)
+    classify_batch_max: int = int(os.getenv("CLASSIFY_BATCH_MAX", "8"))
+    classify_batch_wait_ms: float = float(os.getenv("CLASSIFY_BATCH_WAIT_MS", "15"))
+    # Локальная пре-модерация по словарям перед классификатором (app/premod.py):
+    # off — всё в LLM; assist — очевидные совпадения размечаются локально, остальное в LLM;
+    # local — ещё и текст без совпадений считается normal без LLM
+    premod_mode: str = os.getenv("PREMOD_MODE", "assist").strip().lower()
+    # Доля локальных решений, которые LLM перепроверяет в фоне (для точности/полноты)
+    premod_shadow_rate: float = float(os.getenv("PREMOD_SHADOW_RATE", "0.05"))
+    # Окно статистики провайдера для маршрутизации, секунд
+    llm_health_window_sec: float = float(os.getenv("LLM_HEALTH_WINDOW_SEC", "300"))
+    # HTTP-пул клиента DeepSeek (одна сессия на процесс)
+    llm_pool_size: int = int(os.getenv("LLM_POOL_SIZE", "32"))
+    llm_keepalive_sec: float = float(os.getenv("LLM_KEEPALIVE_SEC", "30"))
+    llm_dns_ttl_sec: int = int(os.getenv("LLM_DNS_TTL_SEC", "300"))
+    llm_timeout_sec: float = float(os.getenv("LLM_TIMEOUT_SEC", "30"))
+    # Не больше N запросов к LLM одновременно; остальные ждут в очереди (платные — первыми)
+    llm_max_concurrency: int = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+    # Длина очереди; при переполнении пользователь сразу получает «занято»
+    llm_max_queue: int = int(os.getenv("LLM_MAX_QUEUE", "100"))
+    # Общий бюджет на один вызов LLM: очередь + все попытки + паузы между ними, секунд
+    llm_call_budget_sec: float = float(os.getenv("LLM_CALL_BUDGET_SEC", "20"))
+    # Ретраи: число попыток и экспоненциальная пауза с джиттером (Retry-After важнее)
+    llm_retry_attempts: int = int(os.getenv("LLM_RETRY_ATTEMPTS", "3"))
+    llm_retry_base_sec: float = float(os.getenv("LLM_RETRY_BASE_SEC", "0.5"))
+    llm_retry_max_sec: float = float(os.getenv("LLM_RETRY_MAX_SEC", "8"))
+    # Circuit breaker: после N сбоев подряд не ходим к провайдеру столько секунд
+    llm_breaker_failures: int = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+    llm_breaker_reset_sec: float = float(os.getenv("LLM_BREAKER_RESET_SEC", "30"))
+    # Цены DeepSeek, $ за 1M токенов — только для оценки стоимости в /llmstats
+    llm_price_cache_hit: float = float(os.getenv("LLM_PRICE_CACHE_HIT", "0.07"))
+    llm_price_cache_miss: float = float(os.getenv("LLM_PRICE_CACHE_MISS", "0.27"))
+    llm_price_output: float = float(os.getenv("LLM_PRICE_OUTPUT", "1.10"))
+
+    # --- Dialog ---
+    # Потоковый ответ: первое предложение уходит сразу, дальше сообщение дописывается правками
+    dialog_streaming: bool = os.getenv("DIALOG_STREAMING", "0").strip().lower() in ("1", "true", "yes", "on")
+    # Не чаще одной правки сообщения за столько секунд (лимиты Telegram на edit в чате)
+    dialog_stream_edit_interval_sec: float = float(os.getenv("DIALOG_STREAM_EDIT_INTERVAL_SEC", "1.2"))
+    # Ответ не по-русски: "rewrite" — отдельный запрос «перепиши по-русски»,
+    # "regenerate" — повторная генерация с жёстким требованием языка, "off" — не трогать.
+    # Транслит переводится в кириллицу локально в любом режиме, кроме "off"
+    dialog_lang_fix: str = os.getenv("DIALOG_LANG_FIX", "rewrite").strip().lower()
+    # Склейка быстрых сообщений: ждём тишины столько секунд после последнего сообщения
+    # (но не дольше max_wait от первого) и отвечаем один раз на всё вместе; 0 — без склейки,
+    # тогда сообщения чаще раза в 2 секунды отклоняются. По умолчанию выключено: окно задерживает
+    # каждую реплику, а большинство реплик — одно сообщение (включать, например, 1.5)
+    dialog_coalesce_window_sec: float = float(os.getenv("DIALOG_COALESCE_WINDOW_SEC", "0"))
+    dialog_coalesce_max_wait_sec: float = float(os.getenv("DIALOG_COALESCE_MAX_WAIT_SEC", "4"))
+    # Модерация реплик: "parallel" — классификатор и генерация стартуют одновременно,
+    # при метке не normal генерация отменяется и уходит заготовка из prompts.py (сообщение не списывается);
+    # "off" — без модерации. По умолчанию выключено: это лишний вызов классификатора на каждую реплику
+    dialog_moderation: str = os.getenv("DIALOG_MODERATION", "off").strip().lower()
+    # Бюджет промпта в токенах (system + история + новая реплика) и максимум реплик истории в нём
+    dialog_prompt_budget_tokens: int = int(os.getenv("DIALOG_PROMPT_BUDGET_TOKENS", "2500"))
+    dialog_prompt_max_history: int = int(os.getenv("DIALOG_PROMPT_MAX_HISTORY", "16"))
+    # Бюджет на один апдейт диалога от получения до ответа, секунд (0 — без ограничения)
+    dialog_deadline_sec: float = float(os.getenv("DIALOG_DEADLINE_SEC", "12"))
+    # Если до дедлайна осталось меньше — необязательные шаги (перевод ответа на русский) пропускаем
+    dialog_optional_min_sec: float = float(os.getenv("DIALOG_OPTIONAL_MIN_SEC", "4"))
 
     # --- Security / Privacy ---
     user_id_salt: str = os.getenv("USER_ID_SALT", "change_me")
@@ -81,6 +167,30 @@ class Settings(BaseModel):
     # --- Database ---
     # Убедись, что этот путь совпадает у пользователя и админ-бота
     db_path: str = os.getenv("DB_PATH", "./data/bot.db")
+    # Сколько соединений-читателей держит пул (писатель всегда один)
+    db_pool_readers: int = int(os.getenv("DB_POOL_READERS", "3"))
+    # Отложенная запись conv_buffer/kv/flags: коммит пачкой раз в N мс или по M строк.
+    # DB_FLUSH_INTERVAL_MS=0 — писать сразу (по одной транзакции на вызов)
+    db_flush_interval_ms: int = int(os.getenv("DB_FLUSH_INTERVAL_MS", "50"))
+    db_flush_max_rows: int = int(os.getenv("DB_FLUSH_MAX_ROWS", "64"))
+    # Хранение истории диалога: "rows" — строка на реплику (conv_buffer),
+    # "ring" — один зашифрованный blob на пользователя (conv_ring).
+    # При смене режима история переносится при старте основного бота (init_db(main=True))
+    conv_storage: str = os.getenv("CONV_STORAGE", "rows").strip().lower()
+    # Сколько последних реплик хранить на пользователя (в промпт идёт не больше, см. DIALOG_PROMPT_*)
+    conv_keep: int = int(os.getenv("CONV_KEEP", "16"))
+    # Кэш расшифрованной истории в памяти процесса (0 пользователей — выключен)
+    conv_cache_max_users: int = int(os.getenv("CONV_CACHE_MAX_USERS", "5000"))
+    conv_cache_max_bytes: int = int(os.getenv("CONV_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+    conv_cache_ttl_sec: int = int(os.getenv("CONV_CACHE_TTL_SEC", "900"))
+
+    # --- Фоновые задачи ---
+    # Как часто пересобирать витрину top_users_30d для админ-статистики, минут
+    stats_refresh_min: int = int(os.getenv("STATS_REFRESH_MIN", "10"))
+    # Как часто проверять, у кого наступила полночь, и сбрасывать лимиты пачкой, секунд
+    quota_reset_every_sec: int = int(os.getenv("QUOTA_RESET_EVERY_SEC", "60"))
+    # Как часто сбрасывать поминутную телеметрию LLM в llm_usage_minute, секунд
+    telemetry_flush_sec: int = int(os.getenv("TELEMETRY_FLUSH_SEC", "60"))
 
     # --- Daily limits / quotas ---
     # Базовые квоты на день (использстилься, если карта ниже не задана)
@@ -91,6 +201,11 @@ class Settings(BaseModel):
     # DAILY_QUOTA_MAP='{"FREE":10,"PLUS":30,"PREMIUM":100}'
     daily_quota_map: Optional[Dict[str, int]] = _parse_json_dict(os.getenv("DAILY_QUOTA_MAP"))
 
+    # Пояс суточного сброса для пользователей без users.tz_name (пусто — пояс сервера)
+    quota_tz: str = os.getenv("QUOTA_TZ", "")
+    # Как часто сверять версию карты квот в kv (карта кэшируется в памяти процесса), секунд
+    quota_version_check_sec: float = float(os.getenv("QUOTA_VERSION_CHECK_SEC", "5"))
+
     # --- Telegram Stars (XTR) pricing ---
     # Telegram ждёт amount в "центах" валюты → XTR * 100 в sendInvoice.
     # Значения ниже — примеры; подправь под свою экономику.
@@ -0,0 +1,127 @@
+# app/conv_cache.py
+"""
+LRU + TTL кэш расшифрованной истории диалога (ключ — tg_hash).
+
+conv_append/conv_clear обновляют запись напрямую (write-through), поэтому
+активный собеседник на следующих репликах не ходит в БД и не дёргает Fernet.
+Объём ограничен и числом пользователей, и примерным размером текста.
+"""
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# накладные расходы на одну реплику сверх текста (dict, строки role и т.п.), байт
+_ITEM_OVERHEAD = 120
+
+
+class _Entry:
+    __slots__ = ("items", "whole", "size", "ts")
+
+    def __init__(self, items: List[Dict[str, str]], whole: bool):
+        self.items = items
+        self.whole = whole  # в items вся сохранённая история, а не только последние N
+        self.size = _size_of(items)
+        self.ts = time.monotonic()
+
+
+def _size_of(items: List[Dict[str, str]]) -> int:
+    return sum(len(m.get("content", "")) * 2 + _ITEM_OVERHEAD for m in items)
+
+
+class HistoryCache:
+    def __init__(self, max_users: int, max_bytes: int, ttl_sec: float):
+        self.max_users = max(0, int(max_users))
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl = float(ttl_sec)
+        self._data: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        # загрузки из БД «в полёте»: True — пока грузили, пришла запись, результат устарел
+        self._inflight: Dict[str, bool] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_users > 0 and self.max_bytes > 0
+
+    # --- чтение ---
+
+    def get(self, tg_hash: str, limit: int) -> Optional[List[Dict[str, str]]]:
+        e = self._data.get(tg_hash)
+        if e is None:
+            self.misses += 1
+            return None
+        if self.ttl > 0 and time.monotonic() - e.ts > self.ttl:
+            self._drop(tg_hash)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        if not e.whole and len(e.items) < limit:
+            # закэширована более короткая выборка, чем просят
+            self.misses += 1
+            return None
+        self._data.move_to_end(tg_hash)
+        self.hits += 1
+        items = e.items[-limit:] if limit > 0 else []
+        return [dict(m) for m in items]
+
+    def begin_load(self, tg_hash: str) -> None:
+        self._inflight.setdefault(tg_hash, False)
+
+    def end_load(self, tg_hash: str, items: List[Dict[str, str]], limit: int) -> None:
+        """Кладёт результат чтения из БД, если за время чтения не было записей."""
+        stale = self._inflight.pop(tg_hash, True)
+        if stale or not self.enabled:
+            return
+        self._put(tg_hash, _Entry([dict(m) for m in items], whole=len(items) < limit))
+
+    # --- write-through ---
+
+    def append(self, tg_hash: str, role: str, text: str, keep: int) -> None:
+        if tg_hash in self._inflight:
+            self._inflight[tg_hash] = True
+        e = self._data.get(tg_hash)
+        if e is None:
+            # без полной картины истории не кэшируем — дочитаем из БД при следующем запросе
+            return
+        items = e.items + [{"role": role, "content": text}]
+        if keep > 0 and len(items) > keep:
+            items = items[-keep:]
+        self._put(tg_hash, _Entry(items, whole=e.whole))
+
+    def clear(self, tg_hash: str) -> None:
+        if tg_hash in self._inflight:
+            self._inflight[tg_hash] = True
+        if self.enabled:
+            self._put(tg_hash, _Entry([], whole=True))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "users": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    # --- служебное ---
+
+    def _put(self, tg_hash: str, e: _Entry) -> None:
+        self._drop(tg_hash)
+        self._data[tg_hash] = e
+        self._bytes += e.size
+        while self._data and (len(self._data) > self.max_users or self._bytes > self.max_bytes):
+            _, old = self._data.popitem(last=False)
+            self._bytes -= old.size
+            self.evictions += 1
+
+    def _drop(self, tg_hash: str) -> None:
+        e = self._data.pop(tg_hash, None)
+        if e is not None:
+            self._bytes -= e.size
@@ -0,0 +1,72 @@
+# app/conv_ring.py
+"""
+Компактная история диалога: все последние реплики пользователя — один
+зашифрованный blob в conv_ring (одна строка на tg_hash).
+
+Формат до шифрования:
+  1 байт версии, затем записи подряд:
+  [1 байт длина role][role utf-8][4 байта длина текста, big-endian][текст utf-8]
+"""
+from __future__ import annotations
+
+import struct
+from typing import List, Tuple
+
+from .security import fernet
+
+_VERSION = 1
+_TEXT_LEN = struct.Struct(">I")
+
+Item = Tuple[str, str]  # (role, text)
+
+
+def pack(items: List[Item]) -> bytes:
+    out = bytearray([_VERSION])
+    for role, text in items:
+        r = role.encode("utf-8")[:255]
+        t = text.encode("utf-8")
+        out.append(len(r))
+        out += r
+        out += _TEXT_LEN.pack(len(t))
+        out += t
+    return bytes(out)
+
+
+def unpack(data: bytes) -> List[Item]:
+    if not data or data[0] != _VERSION:
+        return []
+    items: List[Item] = []
+    pos, end = 1, len(data)
+    try:
+        while pos < end:
+            rlen = data[pos]
+            pos += 1
+            role = data[pos:pos + rlen].decode("utf-8")
+            pos += rlen
+            (tlen,) = _TEXT_LEN.unpack_from(data, pos)
+            pos += _TEXT_LEN.size
+            text = data[pos:pos + tlen].decode("utf-8")
+            pos += tlen
+            items.append((role, text))
+    except (struct.error, UnicodeDecodeError):
+        # битый хвост — отдаём то, что успели разобрать
+        pass
+    return items
+
+
+def encode(items: List[Item], keep: int) -> bytes:
+    """Обрезает до keep последних реплик, упаковывает и шифрует (если задан ключ)."""
+    packed = pack(items[-int(keep):] if keep > 0 else [])
+    return fernet.encrypt(packed) if fernet else packed
+
+
+def decode(blob: bytes | None) -> List[Item]:
+    """Один decrypt на всю историю. Нерасшифровываемый blob считаем пустой историей."""
+    if not blob:
+        return []
+    if fernet:
+        try:
+            blob = fernet.decrypt(blob)
+        except Exception:
+            return []
+    return unpack(blob)
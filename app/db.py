@@ -1,97 +1,20 @@
+import asyncio
+import logging
 import time
 import aiosqlite
+from contextlib import asynccontextmanager
 from pathlib import Path
 
+from . import conv_ring
 from .config import settings
+from .conv_cache import HistoryCache
+from .deadline import DeadlineExceeded, remaining as deadline_remaining, spawn_detached
+from .migrations import LATEST_VERSION, get_schema_version, migrate
 from .security import fernet
 
-SCHEMA = """
-PRAGMA journal_mode=WAL;
-PRAGMA foreign_keys=ON;
-
-CREATE TABLE IF NOT EXISTS users(
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  tg_hash TEXT UNIQUE NOT NULL,
-  created_at INTEGER NOT NULL,
-  counter_reset_at INTEGER NOT NULL,
-  subscription_tier TEXT NOT NULL DEFAULT 'FREE',
-  subscription_until INTEGER,
-  daily_limit_remaining INTEGER NOT NULL DEFAULT 10,
-  bonus_messages INTEGER NOT NULL DEFAULT 0,
-  earned_referral_messages INTEGER NOT NULL DEFAULT 0,
-  referrer_hash TEXT,
-  tz_name TEXT,
-  gender TEXT NOT NULL DEFAULT 'male'
-);
-
-CREATE TABLE IF NOT EXISTS usage_events(
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  tg_hash TEXT NOT NULL,
-  created_at INTEGER NOT NULL,
-  type TEXT NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS referrals(
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  referrer_hash TEXT NOT NULL,
-  invitee_hash TEXT NOT NULL UNIQUE,
-  created_at INTEGER NOT NULL,
-  activated_at INTEGER,
-  status TEXT NOT NULL DEFAULT 'pending',
-  progress_count INTEGER NOT NULL DEFAULT 0,
-  expires_at INTEGER
-);
-
-CREATE TABLE IF NOT EXISTS purchases(
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  tg_hash TEXT NOT NULL,
-  created_at INTEGER NOT NULL,
-  kind TEXT NOT NULL,
-  meta TEXT NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS feedback(
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  tg_hash TEXT NOT NULL,
-  created_at INTEGER NOT NULL,
-  blob BLOB NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS conv_buffer(
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  tg_hash TEXT NOT NULL,
-  role TEXT NOT NULL,
-  created_at INTEGER NOT NULL,
-  blob BLOB NOT NULL
-);
-
-CREATE INDEX IF NOT EXISTS idx_conv_hash_id ON conv_buffer(tg_hash, id);
-CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedback(created_at);
-
-CREATE TABLE IF NOT EXISTS flags(
-  user_id TEXT NOT NULL,
-  flag TEXT NOT NULL,
-  value TEXT NOT NULL,
-  updated REAL NOT NULL,
-  PRIMARY KEY(user_id, flag)
-);
-
-CREATE TABLE IF NOT EXISTS kv(
-  user_id TEXT NOT NULL,
-  key TEXT NOT NULL,
-  value TEXT,
-  updated REAL NOT NULL,
-  PRIMARY KEY(user_id, key)
-);
-
-CREATE TABLE IF NOT EXISTS stability(
-  user_id TEXT PRIMARY KEY,
-  label TEXT NOT NULL,
-  count INTEGER NOT NULL
-);
-"""
+log = logging.getLogger(__name__)
 
-async def open_db():
+async def _connect() -> aiosqlite.Connection:
     db_path = Path(settings.db_path)
     if db_path.parent and not db_path.parent.exists():
         db_path.parent.mkdir(parents=True, exist_ok=True)
@@ -99,162 +22,649 @@ async def open_db():
     db = await aiosqlite.connect(str(db_path))
     await db.execute("PRAGMA journal_mode=WAL;")
     await db.execute("PRAGMA foreign_keys=ON;")
-    await db.executescript(SCHEMA)
+    # админ-бот и основной бот пишут в один файл — ждём блокировку, а не падаем
+    await db.execute("PRAGMA busy_timeout=5000;")
+    return db
 
-    try:
-        cur = await db.execute("PRAGMA table_info(users)")
-        cols = [row[1] for row in await cur.fetchall()]
-        await cur.close()
-        if "tz_name" not in cols:
-            await db.execute("ALTER TABLE users ADD COLUMN tz_name TEXT")
-        if "gender" not in cols:
-            await db.execute("ALTER TABLE users ADD COLUMN gender TEXT DEFAULT 'male'")
-        await db.commit()
-    except Exception:
-        pass
+async def open_db():
+    """
+    Отдельное соединение «на один раз» (вызывающий сам делает close()).
+    Для хендлеров и хелперов используйте read_db()/write_db() — они берут соединение из пула.
+    """
+    db = await _connect()
+    # схему накатывает init_db() при старте; здесь — только сверка номера версии
+    if await get_schema_version(db) < LATEST_VERSION:
+        await migrate(db)
+    return db
 
+def _ring_mode() -> bool:
+    return settings.conv_storage == "ring"
+
+_CONV_KEEP = settings.conv_keep  # как keep по умолчанию в conv_append
+
+def _decrypt_row(blob: bytes) -> str | None:
+    if fernet:
+        try:
+            return fernet.decrypt(blob).decode("utf-8")
+        except Exception:
+            return None
+    return blob.decode("utf-8", errors="ignore")
+
+# в каком режиме сейчас лежит история: kv-запись без пользователя
+_CONV_LAYOUT_KEY = ("", "conv_storage")
+
+async def _stored_conv_layout(db: aiosqlite.Connection) -> str | None:
+    cur = await db.execute("SELECT value FROM kv WHERE user_id=? AND key=?", _CONV_LAYOUT_KEY)
+    row = await cur.fetchone()
+    await cur.close()
+    return row[0] if row else None
+
+async def _convert_conv_layout(db: aiosqlite.Connection) -> None:
+    """
+    Переносит историю в текущий режим CONV_STORAGE, если он отличается от записанного
+    в kv (первое включение ring или откат на rows). Одна транзакция вместе с отметкой режима;
+    при совпадении режима таблицы не сканируются. Вызывает только основной бот (init_db(main=True)).
+    """
+    stored = await _stored_conv_layout(db)
+    if stored == settings.conv_storage:
+        return
+    await _move_conv_history(db)
+    await db.execute(
+        "INSERT OR REPLACE INTO kv(user_id, key, value, updated) VALUES(?,?,?,?)",
+        (*_CONV_LAYOUT_KEY, settings.conv_storage, time.time()),
+    )
     await db.commit()
-    return db
 
-async def conv_load_history(tg_hash: str, limit: int = 8):
-    if not tg_hash:
-        return []
-    db = await open_db()
+async def _move_conv_history(db: aiosqlite.Connection) -> None:
+    if _ring_mode():
+        cur = await db.execute("SELECT 1 FROM conv_buffer LIMIT 1")
+        has_rows = await cur.fetchone()
+        await cur.close()
+        if not has_rows:
+            return
+        users: dict[str, dict] = {}
+        async with db.execute("SELECT tg_hash, role, created_at, blob FROM conv_buffer ORDER BY id") as cur:
+            async for tg_hash, role, created_at, blob in cur:
+                st = users.setdefault(tg_hash, {"items": [], "ts": 0})
+                text = _decrypt_row(blob)
+                if text is not None:
+                    st["items"].append((role, text))
+                st["ts"] = max(st["ts"], int(created_at or 0))
+        for tg_hash, st in users.items():
+            cur = await db.execute("SELECT blob FROM conv_ring WHERE tg_hash=?", (tg_hash,))
+            row = await cur.fetchone()
+            await cur.close()
+            items = (conv_ring.decode(row[0] if row else None) + st["items"])[-_CONV_KEEP:]
+            await db.execute(
+                "INSERT OR REPLACE INTO conv_ring(tg_hash, updated_at, n_items, blob) VALUES(?,?,?,?)",
+                (tg_hash, st["ts"], len(items), conv_ring.encode(items, _CONV_KEEP))
+            )
+        await db.execute("DELETE FROM conv_buffer")
+        log.info("conv_buffer → conv_ring: перенесено пользователей: %d", len(users))
+        return
+
+    cur = await db.execute("SELECT tg_hash, updated_at, blob FROM conv_ring")
+    rows = await cur.fetchall()
+    await cur.close()
+    if not rows:
+        return
+    for tg_hash, updated_at, ring_blob in rows:
+        batch = []
+        for role, text in conv_ring.decode(ring_blob):
+            payload = text.encode("utf-8")
+            batch.append((tg_hash, role, int(updated_at), fernet.encrypt(payload) if fernet else payload))
+        if batch:
+            await db.executemany(
+                "INSERT INTO conv_buffer(tg_hash, role, created_at, blob) VALUES(?,?,?,?)", batch
+            )
+    await db.execute("DELETE FROM conv_ring")
+    log.info("conv_ring → conv_buffer: перенесено пользователей: %d", len(rows))
+
+
+# -------- Пул соединений --------
+
+async def _within_deadline(aw, what: str):
+    """Ждёт aw не дольше остатка бюджета апдейта (см. app/deadline.py); без дедлайна — просто ждёт."""
+    left = deadline_remaining()
+    if left is None:
+        return await aw
     try:
+        return await asyncio.wait_for(aw, left)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"deadline exceeded waiting for {what}") from None
+
+class _ConnectionPool:
+    """
+    Долгоживущие соединения на весь процесс: один писатель (под замком) и несколько читателей.
+    SQLite всё равно сериализует запись, а в WAL читатели не мешают писателю.
+    """
+
+    def __init__(self, readers: int):
+        self._n_readers = max(1, int(readers))
+        self._writer: aiosqlite.Connection | None = None
+        self._writer_lock = asyncio.Lock()
+        self._readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._all: list[aiosqlite.Connection] = []
+
+    async def open(self, main: bool) -> None:
+        self._writer = await _connect()
+        self._all.append(self._writer)
+        await migrate(self._writer)
+        if main:
+            await _convert_conv_layout(self._writer)
+        else:
+            stored = await _stored_conv_layout(self._writer)
+            if stored is not None and stored != settings.conv_storage:
+                log.warning("CONV_STORAGE=%s, а история лежит в режиме %s — переносит только основной бот",
+                            settings.conv_storage, stored)
+        for _ in range(self._n_readers):
+            db = await _connect()
+            self._all.append(db)
+            self._readers.put_nowait(db)
+
+    async def close(self) -> None:
+        async with self._writer_lock:
+            for db in self._all:
+                try:
+                    await db.close()
+                except Exception:
+                    pass
+            self._all.clear()
+            self._writer = None
+
+    @asynccontextmanager
+    async def writer(self):
+        """Коммит при нормальном выходе, rollback при исключении."""
+        await _within_deadline(self._writer_lock.acquire(), "DB writer")
+        try:
+            db = self._writer
+            try:
+                yield db
+            except BaseException:
+                if db.in_transaction:
+                    await db.rollback()
+                raise
+            if db.in_transaction:
+                await db.commit()
+        finally:
+            self._writer_lock.release()
+
+    @asynccontextmanager
+    async def reader(self):
+        db = await _within_deadline(self._readers.get(), "DB reader")
+        try:
+            yield db
+        finally:
+            if db.in_transaction:
+                await db.rollback()
+            self._readers.put_nowait(db)
+
+_pool: _ConnectionPool | None = None
+_pool_lock = asyncio.Lock()
+
+async def init_db(main: bool = False) -> None:
+    """
+    Открывает пул при старте бота. Повторный вызов ничего не делает.
+    main=True — основной бот: он один переносит историю при смене CONV_STORAGE.
+    """
+    global _pool
+    async with _pool_lock:
+        if _pool is not None:
+            return
+        pool = _ConnectionPool(settings.db_pool_readers)
+        await pool.open(main)
+        _pool = pool
+
+async def close_db() -> None:
+    """Сбрасывает отложенные записи и закрывает все соединения пула (вызывать при остановке бота)."""
+    global _pool
+    await _write_behind.stop()
+    async with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        await pool.close()
+
+async def _get_pool() -> _ConnectionPool:
+    if _pool is None:
+        # страховка для скриптов/тестов, где init_db() не вызывали
+        await init_db()
+    return _pool
+
+@asynccontextmanager
+async def read_db():
+    """Соединение-читатель из пула: `async with read_db() as db: ...`"""
+    pool = await _get_pool()
+    async with pool.reader() as db:
+        yield db
+
+@asynccontextmanager
+async def write_db():
+    """Единственное соединение-писатель; транзакция фиксируется при выходе из блока."""
+    pool = await _get_pool()
+    async with pool.writer() as db:
+        yield db
+
+
+# -------- Отложенная запись (write-behind) --------
+
+class _WriteBehind:
+    """
+    Копит мелкие записи (conv_buffer, kv, flags, счётчики активности, кэш меток) и фиксирует их одной транзакцией:
+    раз в interval_ms или сразу, как набралось max_rows. Один commit (= один fsync)
+    на пачку вместо коммита на каждую строку.
+
+    Read-your-writes: пока запись не зафиксирована, она лежит в оверлее и
+    get_user_kv/get_user_flag/conv_load_history видят её.
+    """
+
+    def __init__(self, interval_ms: int, max_rows: int):
+        self._interval = max(0, int(interval_ms)) / 1000.0
+        self._max_rows = max(1, int(max_rows))
+        self._seq = 0
+
+        # очередь на запись
+        # ("append", seq, tg_hash, role, created_at, text, blob, keep) | ("clear", seq, tg_hash);
+        # blob — зашифрованная реплика для conv_buffer (в режиме ring не нужен)
+        self._conv_ops: list[tuple] = []
+        self._kv: dict[tuple[str, str], tuple[str, float]] = {}
+        self._flags: dict[tuple[str, str], tuple[str, float]] = {}
+        self._activity: dict[tuple[int, str], int] = {}  # (day, tg_hash) -> +сообщений
+        self._classify: dict[str, tuple[str, float, int]] = {}  # key -> (label, confidence, created_at)
+
+        # оверлей для чтения (чистится только после успешного commit)
+        self._conv_overlay: dict[str, dict] = {}  # tg_hash -> {"cleared": seq|None, "items": [(seq, role, text)]}
+        self._kv_overlay: dict[tuple[str, str], tuple[int, str]] = {}
+        self._flags_overlay: dict[tuple[str, str], tuple[int, str]] = {}
+
+        self._flush_lock = asyncio.Lock()
+        self._has_data = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    # --- постановка в очередь ---
+
+    def _next_seq(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def _pending_rows(self) -> int:
+        return len(self._conv_ops) + len(self._kv) + len(self._flags) + len(self._activity) + len(self._classify)
+
+    def _kick(self) -> None:
+        if self._task is None or self._task.done():
+            # задача общая для всех апдейтов — дедлайн того, кто её разбудил первым, ей не нужен
+            self._task = spawn_detached(self._run())
+        self._has_data.set()
+        if self._interval <= 0 or self._pending_rows() >= self._max_rows:
+            self._full.set()
+
+    def conv_append(self, tg_hash: str, role: str, text: str, blob: bytes | None, keep: int) -> None:
+        seq = self._next_seq()
+        self._conv_ops.append(("append", seq, tg_hash, role, int(time.time()), text, blob, int(keep)))
+        ov = self._conv_overlay.setdefault(tg_hash, {"cleared": None, "items": []})
+        ov["items"].append((seq, role, text))
+        self._kick()
+
+    def conv_clear(self, tg_hash: str) -> None:
+        seq = self._next_seq()
+        self._conv_ops.append(("clear", seq, tg_hash))
+        self._conv_overlay[tg_hash] = {"cleared": seq, "items": []}
+        self._kick()
+
+    def set_kv(self, user_id: str, key: str, value: str) -> None:
+        seq = self._next_seq()
+        self._kv[(user_id, key)] = (value, time.time())
+        self._kv_overlay[(user_id, key)] = (seq, value)
+        self._kick()
+
+    def set_flag(self, user_id: str, flag: str, value: str) -> None:
+        seq = self._next_seq()
+        self._flags[(user_id, flag)] = (value, time.time())
+        self._flags_overlay[(user_id, flag)] = (seq, value)
+        self._kick()
+
+    def add_activity(self, day: int, tg_hash: str, n: int) -> None:
+        key = (day, tg_hash)
+        self._activity[key] = self._activity.get(key, 0) + int(n)
+        self._kick()
+
+    def put_classify(self, key: str, label: str, confidence: float, created_at: int) -> None:
+        # оверлей не нужен: свежая метка и так лежит в памяти ClassifyCache
+        self._classify[key] = (label, float(confidence), int(created_at))
+        self._kick()
+
+    # --- чтение оверлея ---
+
+    def kv(self, user_id: str, key: str) -> tuple[bool, str | None]:
+        hit = self._kv_overlay.get((user_id, key))
+        return (True, hit[1]) if hit else (False, None)
+
+    def flag(self, user_id: str, flag: str) -> tuple[bool, str | None]:
+        hit = self._flags_overlay.get((user_id, flag))
+        return (True, hit[1]) if hit else (False, None)
+
+    def conv(self, tg_hash: str) -> dict | None:
+        return self._conv_overlay.get(tg_hash)
+
+    @property
+    def flush_lock(self) -> asyncio.Lock:
+        return self._flush_lock
+
+    # --- фиксация ---
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_data.wait()
+            if self._interval > 0:
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self._interval)
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("write-behind: flush failed")
+                await asyncio.sleep(max(self._interval, 0.5))
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            self._has_data.clear()
+            self._full.clear()
+            conv_ops, kv, flags, activity = self._conv_ops, self._kv, self._flags, self._activity
+            classify = self._classify
+            if not (conv_ops or kv or flags or activity or classify):
+                return
+            self._conv_ops, self._kv, self._flags, self._activity, self._classify = [], {}, {}, {}, {}
+            upto = self._seq
+            try:
+                await self._write(conv_ops, kv, flags, activity, classify)
+            except BaseException:
+                # вернём пачку в очередь; более свежие записи того же ключа важнее
+                self._conv_ops = conv_ops + self._conv_ops
+                kv.update(self._kv)
+                flags.update(self._flags)
+                classify.update(self._classify)
+                for key, n in self._activity.items():
+                    activity[key] = activity.get(key, 0) + n
+                self._kv, self._flags, self._activity, self._classify = kv, flags, activity, classify
+                self._has_data.set()
+                raise
+            self._forget(upto)
+
+    async def _write(self, conv_ops: list[tuple], kv: dict, flags: dict, activity: dict, classify: dict) -> None:
+        async with write_db() as db:
+            if _ring_mode():
+                await self._write_conv_ring(db, conv_ops)
+            else:
+                await self._write_conv_rows(db, conv_ops)
+            if kv:
+                await db.executemany(
+                    "INSERT OR REPLACE INTO kv(user_id, key, value, updated) VALUES(?,?,?,?)",
+                    [(u, k, v, ts) for (u, k), (v, ts) in kv.items()],
+                )
+            if flags:
+                await db.executemany(
+                    "INSERT OR REPLACE INTO flags(user_id, flag, value, updated) VALUES(?,?,?,?)",
+                    [(u, f, v, ts) for (u, f), (v, ts) in flags.items()],
+                )
+            if activity:
+                rows = [(day, h, n) for (day, h), n in activity.items()]
+                await db.executemany(
+                    """
+                    INSERT INTO activity_daily(day, tg_hash, messages) VALUES(?,?,?)
+                    ON CONFLICT(day, tg_hash) DO UPDATE SET messages = messages + excluded.messages
+                    """,
+                    rows,
+                )
+                await db.executemany(
+                    """
+                    INSERT INTO activity_user(tg_hash, first_day, last_day) VALUES(?,?,?)
+                    ON CONFLICT(tg_hash) DO UPDATE SET last_day = MAX(last_day, excluded.last_day)
+                    """,
+                    [(h, day, day) for day, h, _ in rows],
+                )
+            if classify:
+                await db.executemany(
+                    """
+                    INSERT INTO classify_cache(key, label, confidence, created_at) VALUES(?,?,?,?)
+                    ON CONFLICT(key) DO UPDATE SET
+                      label=excluded.label, confidence=excluded.confidence, created_at=excluded.created_at
+                    """,
+                    [(k, label, conf, ts) for k, (label, conf, ts) in classify.items()],
+                )
+
+    @staticmethod
+    async def _write_conv_rows(db: aiosqlite.Connection, conv_ops: list[tuple]) -> None:
+        trim: dict[str, int] = {}
+        batch: list[tuple] = []
+        for op in conv_ops:
+            if op[0] == "append":
+                _, _, tg_hash, role, created_at, _, blob, keep = op
+                batch.append((tg_hash, role, created_at, blob))
+                trim[tg_hash] = max(keep, trim.get(tg_hash, 0))
+                continue
+            if batch:
+                await db.executemany(
+                    "INSERT INTO conv_buffer(tg_hash, role, created_at, blob) VALUES(?,?,?,?)", batch
+                )
+                batch = []
+            await db.execute("DELETE FROM conv_buffer WHERE tg_hash=?", (op[2],))
+        if batch:
+            await db.executemany(
+                "INSERT INTO conv_buffer(tg_hash, role, created_at, blob) VALUES(?,?,?,?)", batch
+            )
+        # обрезку делаем один раз на пользователя, а не на каждую вставку
+        for tg_hash, keep in trim.items():
+            await db.execute(
+                """
+                DELETE FROM conv_buffer
+                WHERE tg_hash=? AND id NOT IN (
+                  SELECT id FROM conv_buffer WHERE tg_hash=? ORDER BY id DESC LIMIT ?
+                )
+                """,
+                (tg_hash, tg_hash, int(keep))
+            )
+
+    @staticmethod
+    async def _write_conv_ring(db: aiosqlite.Connection, conv_ops: list[tuple]) -> None:
+        # сворачиваем пачку в итоговое состояние по каждому пользователю
+        users: dict[str, dict] = {}
+        for op in conv_ops:
+            st = users.setdefault(op[2], {"cleared": False, "items": [], "keep": 0, "ts": 0})
+            if op[0] == "clear":
+                st.update(cleared=True, items=[])
+                continue
+            _, _, _, role, created_at, text, _, keep = op
+            st["items"].append((role, text))
+            st["keep"] = max(st["keep"], keep)
+            st["ts"] = created_at
+
+        for tg_hash, st in users.items():
+            if not st["items"]:
+                await db.execute("DELETE FROM conv_ring WHERE tg_hash=?", (tg_hash,))
+                continue
+            items = st["items"]
+            if not st["cleared"]:
+                cur = await db.execute("SELECT blob FROM conv_ring WHERE tg_hash=?", (tg_hash,))
+                row = await cur.fetchone()
+                await cur.close()
+                items = conv_ring.decode(row[0] if row else None) + items
+            items = items[-st["keep"]:]
+            await db.execute(
+                """
+                INSERT INTO conv_ring(tg_hash, updated_at, n_items, blob) VALUES(?,?,?,?)
+                ON CONFLICT(tg_hash) DO UPDATE SET
+                  updated_at=excluded.updated_at, n_items=excluded.n_items, blob=excluded.blob
+                """,
+                (tg_hash, st["ts"], len(items), conv_ring.encode(items, st["keep"]))
+            )
+
+    def _forget(self, upto: int) -> None:
+        """Убирает из оверлея всё, что уже лежит в БД (seq <= upto)."""
+        for tg_hash in list(self._conv_overlay):
+            ov = self._conv_overlay[tg_hash]
+            ov["items"] = [it for it in ov["items"] if it[0] > upto]
+            if ov["cleared"] is not None and ov["cleared"] <= upto:
+                ov["cleared"] = None
+            if not ov["items"] and ov["cleared"] is None:
+                del self._conv_overlay[tg_hash]
+        for overlay in (self._kv_overlay, self._flags_overlay):
+            for key in [k for k, (seq, _) in overlay.items() if seq <= upto]:
+                del overlay[key]
+
+    async def stop(self) -> None:
+        """Хук остановки: дописывает хвост очереди и гасит фоновую задачу."""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        await self.flush()
+
+_write_behind = _WriteBehind(settings.db_flush_interval_ms, settings.db_flush_max_rows)
+
+async def flush_writes() -> None:
+    """Принудительно фиксирует отложенные записи (kv/flags/conv_buffer)."""
+    await _write_behind.flush()
+
+async def _conv_read(tg_hash: str, limit: int) -> list[dict]:
+    if _ring_mode():
+        return await _conv_read_ring(tg_hash, limit)
+    async with read_db() as db:
         cur = await db.execute(
             "SELECT role, blob FROM conv_buffer WHERE tg_hash=? ORDER BY id DESC LIMIT ?",
             (tg_hash, int(limit))
         )
         rows = await cur.fetchall()
         await cur.close()
-        rows = rows[::-1]
-        out = []
-        for role, blob in rows:
-            if fernet:
-                try:
-                    text = fernet.decrypt(blob).decode("utf-8")
-                except Exception:
-                    continue
-            else:
-                text = blob.decode("utf-8", errors="ignore")
-            out.append({"role": role, "content": text})
-        return out
-    finally:
-        await db.close()
+    rows = rows[::-1]
+    out = []
+    for role, blob in rows:
+        text = _decrypt_row(blob)
+        if text is None:
+            continue
+        out.append({"role": role, "content": text})
+    return out
+
+async def _conv_read_ring(tg_hash: str, limit: int) -> list[dict]:
+    async with read_db() as db:
+        cur = await db.execute("SELECT blob FROM conv_ring WHERE tg_hash=?", (tg_hash,))
+        row = await cur.fetchone()
+        await cur.close()
+    items = conv_ring.decode(row[0] if row else None)
+    items = items[-int(limit):] if limit > 0 else []
+    return [{"role": role, "content": text} for role, text in items]
+
+_history_cache = HistoryCache(
+    settings.conv_cache_max_users, settings.conv_cache_max_bytes, settings.conv_cache_ttl_sec
+)
 
-async def conv_append(tg_hash: str, role: str, text: str, keep: int = 8):
+def conv_cache_stats() -> dict:
+    """Счётчики кэша истории (hits/misses/evictions/…), для логов и админки."""
+    return _history_cache.stats()
+
+async def conv_load_history(tg_hash: str, limit: int = _CONV_KEEP):
     if not tg_hash:
-        return
-    db = await open_db()
+        return []
+    if not _history_cache.enabled:
+        return await _conv_load_uncached(tg_hash, limit)
+    cached = _history_cache.get(tg_hash, limit)
+    if cached is not None:
+        return cached
+    _history_cache.begin_load(tg_hash)
     try:
+        out = await _conv_load_uncached(tg_hash, limit)
+    except BaseException:
+        _history_cache.end_load(tg_hash, [], limit=0)
+        raise
+    _history_cache.end_load(tg_hash, out, limit)
+    return out
+
+async def _conv_load_uncached(tg_hash: str, limit: int) -> list[dict]:
+    if _write_behind.conv(tg_hash) is None:
+        return await _conv_read(tg_hash, limit)
+    # есть незафиксированные реплики: ждём, пока не идёт flush, и склеиваем БД + оверлей
+    async with _write_behind.flush_lock:
+        ov = _write_behind.conv(tg_hash)
+        if ov is None:
+            return await _conv_read(tg_hash, limit)
+        base = [] if ov["cleared"] is not None else await _conv_read(tg_hash, limit)
+        pending = [{"role": role, "content": text} for _, role, text in ov["items"]]
+        return (base + pending)[-int(limit):] if limit > 0 else []
+
+async def conv_append(tg_hash: str, role: str, text: str, keep: int = _CONV_KEEP):
+    if not tg_hash:
+        return
+    blob = None
+    if not _ring_mode():
         payload = text.encode("utf-8")
         blob = fernet.encrypt(payload) if fernet else payload
-        await db.execute(
-            "INSERT INTO conv_buffer(tg_hash, role, created_at, blob) VALUES(?,?,?,?)",
-            (tg_hash, role, int(time.time()), blob)
-        )
-        await db.execute(
-            """
-            DELETE FROM conv_buffer
-            WHERE tg_hash=? AND id NOT IN (
-              SELECT id FROM conv_buffer WHERE tg_hash=? ORDER BY id DESC LIMIT ?
-            )
-            """,
-            (tg_hash, tg_hash, int(keep))
-        )
-        await db.commit()
-    finally:
-        await db.close()
+    _write_behind.conv_append(tg_hash, role, text, blob, keep)
+    _history_cache.append(tg_hash, role, text, keep)
 
 async def conv_clear(tg_hash: str):
     if not tg_hash:
         return
-    db = await open_db()
-    try:
-        await db.execute("DELETE FROM conv_buffer WHERE tg_hash=?", (tg_hash,))
-        await db.commit()
-    finally:
-        await db.close()
+    _write_behind.conv_clear(tg_hash)
+    _history_cache.clear(tg_hash)
 
 async def get_user_flag(user_id: str, flag: str) -> bool:
-    db = await open_db()
-    try:
+    hit, value = _write_behind.flag(user_id, flag)
+    if hit:
+        return value == "true"
+    async with read_db() as db:
         cur = await db.execute("SELECT value FROM flags WHERE user_id=? AND flag=?", (user_id, flag))
         row = await cur.fetchone()
         await cur.close()
         return bool(row and row[0] == "true")
-    finally:
-        await db.close()
 
 async def set_user_flag(user_id: str, flag: str, value: bool):
-    db = await open_db()
-    try:
-        await db.execute(
-            "INSERT OR REPLACE INTO flags(user_id, flag, value, updated) VALUES(?,?,?,?)",
-            (user_id, flag, "true" if value else "false", time.time()),
-        )
-        await db.commit()
-    finally:
-        await db.close()
+    _write_behind.set_flag(user_id, flag, "true" if value else "false")
 
 async def get_user_kv(user_id: str, key: str) -> str | None:
-    db = await open_db()
-    try:
+    hit, value = _write_behind.kv(user_id, key)
+    if hit:
+        return value
+    async with read_db() as db:
         cur = await db.execute("SELECT value FROM kv WHERE user_id=? AND key=?", (user_id, key))
         row = await cur.fetchone()
         await cur.close()
         return None if row is None else (row[0] if row[0] is not None else None)
-    finally:
-        await db.close()
 
 async def set_user_kv(user_id: str, key: str, value: str | int | float | None):
     v = "" if value is None else str(value)
-    db = await open_db()
-    try:
-        await db.execute(
-            "INSERT OR REPLACE INTO kv(user_id, key, value, updated) VALUES(?,?,?,?)",
-            (user_id, key, v, time.time()),
-        )
-        await db.commit()
-    finally:
-        await db.close()
+    _write_behind.set_kv(user_id, key, v)
 
 async def get_user_state_stability(user_id: str, expected_label: str) -> int:
-    db = await open_db()
-    try:
+    async with write_db() as db:
         cur = await db.execute("SELECT label, count FROM stability WHERE user_id=?", (user_id,))
         row = await cur.fetchone()
+        await cur.close()
         if not row or row[0] != expected_label:
             await db.execute(
                 "INSERT OR REPLACE INTO stability(user_id, label, count) VALUES(?,?,?)",
                 (user_id, expected_label, 1)
             )
-            await db.commit()
             return 1
         else:
             count = row[1] + 1
             await db.execute("UPDATE stability SET count=? WHERE user_id=?", (count, user_id))
-            await db.commit()
             return count
-    finally:
-        await db.close()
 
 async def get_user_gender(tg_hash: str) -> str:
-    db = await open_db()
-    try:
+    async with read_db() as db:
         cur = await db.execute("SELECT gender FROM users WHERE tg_hash=? LIMIT 1", (tg_hash,))
         row = await cur.fetchone()
         await cur.close()
-        g = (row[0] if row else None)
-        g = (g or "").strip().lower()
-        return "female" if g == "female" else "male"
-    finally:
-        await db.close()
+    g = (row[0] if row else None)
+    g = (g or "").strip().lower()
+    return "female" if g == "female" else "male"
 
 async def set_user_gender(tg_hash: str, gender: str) -> None:
     g = "female" if str(gender).strip().lower() == "female" else "male"
-    db = await open_db()
-    try:
+    async with write_db() as db:
         await db.execute(
             """
             INSERT INTO users (tg_hash, created_at, counter_reset_at, gender)
@@ -263,84 +673,119 @@ async def set_user_gender(tg_hash: str, gender: str) -> None:
             """,
             (tg_hash, int(time.time()), int(time.time()), g)
         )
-        await db.commit()
-    finally:
-        await db.close()
+
+def _day_of(ts: int | float) -> int:
+    """Номер суток (UTC) для таблиц активности."""
+    return int(ts) // 86400
+
+async def record_activity(tg_hash: str, messages: int = 1, now_ts: int | None = None) -> None:
+    """Засчитывает пользователю сообщения в дневной rollup (пишется пачкой через write-behind)."""
+    if not tg_hash or messages <= 0:
+        return
+    _write_behind.add_activity(_day_of(now_ts or time.time()), tg_hash, messages)
+
+def store_classify_label(key: str, label: str, confidence: float, created_at: int) -> None:
+    """Кладёт метку классификатора в SQLite-кэш — пачкой через write-behind, без отдельного commit."""
+    _write_behind.put_classify(key, label, confidence, created_at)
 
 async def get_active_counts(now_ts: int | None = None) -> tuple[int, int, int]:
-    now = int(now_ts or time.time())
-    day = now - 24 * 3600
-    week = now - 7 * 24 * 3600
-    month = now - 30 * 24 * 3600
+    """DAU/WAU/MAU по календарным суткам (UTC) из activity_user — индексный диапазон, без сканов истории."""
+    today = _day_of(now_ts or time.time())
 
-    db = await open_db()
-    try:
-        async def _count_since(since_ts: int) -> int:
-            cur = await db.execute(
-                "SELECT COUNT(DISTINCT tg_hash) FROM conv_buffer WHERE created_at >= ?",
-                (int(since_ts),)
-            )
+    async with read_db() as db:
+        async def _count_since(since_day: int) -> int:
+            cur = await db.execute("SELECT COUNT(*) FROM activity_user WHERE last_day >= ?", (int(since_day),))
             row = await cur.fetchone()
             await cur.close()
             return int(row[0] or 0)
 
-        dau = await _count_since(day)
-        wau = await _count_since(week)
-        mau = await _count_since(month)
+        dau = await _count_since(today)
+        wau = await _count_since(today - 6)
+        mau = await _count_since(today - 29)
         return dau, wau, mau
-    finally:
-        await db.close()
+
+async def get_conv_messages_count() -> int:
+    """Сколько реплик сейчас хранится в истории (в любом режиме CONV_STORAGE)."""
+    sql = "SELECT COALESCE(SUM(n_items), 0) FROM conv_ring" if _ring_mode() else "SELECT COUNT(*) FROM conv_buffer"
+    async with read_db() as db:
+        cur = await db.execute(sql)
+        row = await cur.fetchone()
+        await cur.close()
+        return int(row[0] or 0)
 
 async def get_total_users_count() -> int:
-    db = await open_db()
-    try:
+    async with read_db() as db:
         cur = await db.execute("SELECT COUNT(*) FROM users")
         row = await cur.fetchone()
         await cur.close()
         return int(row[0] or 0)
-    finally:
-        await db.close()
+
+# Топ по сообщениям за 30 дней: один запрос вместо 1 + 2·N (purchases и users — через EXISTS/JOIN)
+_SQL_TOP_30D = """
+SELECT a.tg_hash,
+       a.cnt,
+       EXISTS(SELECT 1 FROM purchases p WHERE p.tg_hash = a.tg_hash) AS has_purchases,
+       COALESCE(u.subscription_until, 0) > :now AS has_subscription
+FROM (
+  SELECT tg_hash, SUM(messages) AS cnt
+  FROM activity_daily
+  WHERE day >= :since_day
+  GROUP BY tg_hash
+  ORDER BY cnt DESC
+  LIMIT :limit
+) a
+LEFT JOIN users u ON u.tg_hash = a.tg_hash
+ORDER BY a.cnt DESC
+"""
+
+def _top_row(tg_hash: str, cnt, has_purchases, has_subscription) -> dict:
+    return {
+        "tg_hash": tg_hash,
+        "msg_30d": int(cnt or 0),
+        "has_purchases": bool(has_purchases),
+        "has_subscription": bool(has_subscription),
+    }
+
+def _top_params(limit: int) -> dict:
+    now = int(time.time())
+    return {"now": now, "since_day": _day_of(now) - 29, "limit": int(limit)}
 
 async def get_user_stats_30d(limit: int = 50) -> list[dict]:
-    cutoff = int(time.time()) - 30 * 24 * 3600
-    db = await open_db()
-    try:
+    """Живой расчёт топа за 30 дней (по activity_daily)."""
+    async with read_db() as db:
+        cur = await db.execute(_SQL_TOP_30D, _top_params(limit))
+        rows = await cur.fetchall()
+        await cur.close()
+    return [_top_row(*r) for r in rows]
+
+async def refresh_top_users_30d(limit: int = 50) -> int:
+    """Пересобирает витрину top_users_30d (фоновая задача планировщика). Возвращает число строк."""
+    async with write_db() as db:
+        await db.execute("DELETE FROM top_users_30d")
         cur = await db.execute(
-            """
-            SELECT tg_hash, COUNT(*) AS cnt
-            FROM conv_buffer
-            WHERE created_at >= ?
-            GROUP BY tg_hash
-            ORDER BY cnt DESC
-            LIMIT ?
+            f"""
+            INSERT INTO top_users_30d(rank, tg_hash, msg_30d, has_purchases, has_subscription, refreshed_at)
+            SELECT ROW_NUMBER() OVER (ORDER BY cnt DESC), tg_hash, cnt, has_purchases, has_subscription, :now
+            FROM ({_SQL_TOP_30D})
             """,
-            (cutoff, int(limit))
+            _top_params(limit),
+        )
+        n = cur.rowcount
+        await cur.close()
+    return int(n or 0)
+
+async def get_top_users_30d(limit: int = 50) -> list[dict] | None:
+    """
+    Топ из витрины top_users_30d — чтение за постоянное время.
+    None, если витрина пуста (ещё не строилась) — тогда можно посчитать вживую.
+    """
+    async with read_db() as db:
+        cur = await db.execute(
+            "SELECT tg_hash, msg_30d, has_purchases, has_subscription FROM top_users_30d ORDER BY rank LIMIT ?",
+            (int(limit),),
         )
         rows = await cur.fetchall()
         await cur.close()
-
-        results: list[dict] = []
-        for tg_hash, cnt in rows:
-            cur1 = await db.execute("SELECT 1 FROM purchases WHERE tg_hash=? LIMIT 1", (tg_hash,))
-            has_purchases = bool(await cur1.fetchone())
-            await cur1.close()
-
-            cur2 = await db.execute(
-                "SELECT subscription_until FROM users WHERE tg_hash=? LIMIT 1",
-                (tg_hash,)
-            )
-            r2 = await cur2.fetchone()
-            await cur2.close()
-            now = int(time.time())
-            has_subscription = bool(r2 and (int(r2[0] or 0) > now))
-
-            results.append({
-                "tg_hash": tg_hash,
-                "msg_30d": int(cnt),
-                "has_purchases": has_purchases,
-                "has_subscription": has_subscription,
-            })
-
-        return results
-    finally:
-        await db.close()
+    if not rows:
+        return None
+    return [_top_row(*r) for r in rows]
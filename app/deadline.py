@@ -0,0 +1,59 @@
+# app/deadline.py
+"""
+Бюджет времени на обработку одного апдейта.
+
+Хендлер в начале вызывает start_deadline(сек); LLM-клиент и пул БД читают
+remaining() и не ждут дольше, чем осталось. Дедлайн живёт в ContextVar:
+у каждого апдейта aiogram своя задача, поэтому апдейты друг другу не мешают,
+а фоновые задачи (планировщик, spawn_detached) работают без дедлайна.
+
+Осторожно: asyncio.create_task копирует контекст создателя вместе с дедлайном.
+Долгоживущие и общие для многих апдейтов задачи запускаем через spawn_detached.
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from contextvars import Context, ContextVar
+from typing import Coroutine, Optional
+
+_deadline: ContextVar[Optional[float]] = ContextVar("update_deadline", default=None)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """Бюджет апдейта исчерпан."""
+
+
+def start_deadline(seconds: float) -> None:
+    """Дедлайн текущего апдейта: seconds от этого момента (<= 0 — без дедлайна)."""
+    _deadline.set(time.monotonic() + float(seconds) if seconds and seconds > 0 else None)
+
+
+def deadline_at() -> Optional[float]:
+    """Момент дедлайна по time.monotonic() или None, если он не задан."""
+    return _deadline.get()
+
+
+def remaining() -> Optional[float]:
+    """Сколько секунд осталось (не меньше 0) или None, если дедлайна нет."""
+    d = _deadline.get()
+    if d is None:
+        return None
+    return max(0.0, d - time.monotonic())
+
+
+def clamp(seconds: float) -> float:
+    """seconds, но не больше остатка бюджета."""
+    left = remaining()
+    return seconds if left is None else min(seconds, left)
+
+
+def spawn_detached(coro: Coroutine, deadline: Optional[float] = None) -> asyncio.Task:
+    """
+    Задача в чистом контексте: не наследует дедлайн (и прочие ContextVar) апдейта,
+    из которого её запустили. deadline — свой момент по time.monotonic() или None.
+    """
+    ctx = Context()
+    if deadline is not None:
+        ctx.run(_deadline.set, deadline)
+    return asyncio.get_running_loop().create_task(coro, context=ctx)
@@ -7,7 +7,7 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from ..config import settings
-from ..db import open_db, get_user_kv, set_user_kv
+from ..db import read_db, get_user_kv, set_user_kv
 from ..security import decrypt_feedback
 
 router = Router(name="admin_feedback")
@@ -25,8 +25,7 @@ async def _fetch_feedback(limit: int = 10) -> List[dict]:
     Читаем из таблицы feedback(tg_hash, created_at, blob).
     Возвращаем список словарей {id, tg_hash, created_at, text}.
     """
-    db = await open_db()
-    try:
+    async with read_db() as db:
         cur = await db.execute(
             "SELECT id, tg_hash, created_at, blob FROM feedback ORDER BY id DESC LIMIT ?",
             (int(limit),)
@@ -38,12 +37,9 @@ async def _fetch_feedback(limit: int = 10) -> List[dict]:
             text = decrypt_feedback(r[3])
             out.append({"id": int(r[0]), "tg_hash": r[1], "created_at": int(r[2]), "text": text})
         return out
-    finally:
-        await db.close()
 
 async def _fetch_new_feedback(since_id: int) -> List[dict]:
-    db = await open_db()
-    try:
+    async with read_db() as db:
         cur = await db.execute(
             "SELECT id, tg_hash, created_at, blob FROM feedback WHERE id > ? ORDER BY id ASC",
             (int(since_id),)
@@ -55,8 +51,6 @@ async def _fetch_new_feedback(since_id: int) -> List[dict]:
             text = decrypt_feedback(r[3])
             out.append({"id": int(r[0]), "tg_hash": r[1], "created_at": int(r[2]), "text": text})
         return out
-    finally:
-        await db.close()
 
 def _fmt_row(r: dict) -> str:
     user = (r.get("tg_hash") or "")[:8]
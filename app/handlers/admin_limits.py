@@ -13,7 +13,7 @@ from app.config import settings
 from app.db import get_user_kv, set_user_kv
 from app.security import hash_user_id
 from app.limits import (
-    get_quota_map, set_quota_map,
+    get_quota_map, set_quota_map, get_quota_version,
     get_limits_snapshot, set_user_tier, force_reset_today_limit,
 )
 
@@ -31,10 +31,12 @@ async def cmd_quota(m: Message):
         await m.answer("Недостаточно прав.")
         return
     qmap = await get_quota_map()
+    version = await get_quota_version()
     kv_raw = await get_user_kv("global", "limits:daily_map")
     text = (
         "🧮 <b>Карта дневных квот</b>\n"
-        f"<code>{json.dumps(qmap, ensure_ascii=False)}</code>\n\n"
+        f"<code>{json.dumps(qmap, ensure_ascii=False)}</code>\n"
+        f"Версия: <b>{version}</b>\n\n"
         "KV raw (если есть):\n"
         f"<code>{kv_raw or '—'}</code>\n\n"
         "Пример установки:\n"
@@ -53,10 +55,10 @@ async def cmd_setquota(m: Message):
         return
     try:
         obj = json.loads(parts[1])
-        await set_quota_map(obj)
+        version = await set_quota_map(obj)
         qmap = await get_quota_map()
         await m.answer(
-            "✅ Квоты обновлены.\nТекущая карта:\n"
+            f"✅ Квоты обновлены (версия {version}).\nТекущая карта:\n"
             f"<code>{json.dumps(qmap, ensure_ascii=False)}</code>\n\n"
             "Вступят в силу при ближайшем сбросе (полночь) или сразу после /forcereset для конкретного пользователя.",
             parse_mode="HTML",
@@ -8,7 +8,7 @@ from aiogram.filters import CommandStart
 from aiogram.types import Message
 
 from app.config import settings
-from app.db import open_db  # используем твою БД
+from app.db import read_db, get_active_counts, get_conv_messages_count  # используем твою БД
 # Ничего из channel_* не импортируем
 
 router = Router(name="admin_menu")
@@ -66,28 +66,17 @@ async def cmd_astats(m: Message):
         return
 
     now = int(time.time())
-    day_ago = now - 86400
 
-    db = await open_db()
-    try:
+    # активных за сутки (rollup activity_user) и объём истории (с учётом CONV_STORAGE)
+    active_today, _, _ = await get_active_counts(now)
+    total_msgs = await get_conv_messages_count()
+
+    async with read_db() as db:
         # всего пользователей
         cur = await db.execute("SELECT COUNT(*) FROM users")
         total_users = (await cur.fetchone() or [0])[0]
         await cur.close()
 
-        # активных за 24ч (по сообщениям в conv_buffer)
-        cur = await db.execute(
-            "SELECT COUNT(DISTINCT tg_hash) FROM conv_buffer WHERE created_at >= ?",
-            (day_ago,),
-        )
-        active_24h = (await cur.fetchone() or [0])[0]
-        await cur.close()
-
-        # всего сообщений в буфере
-        cur = await db.execute("SELECT COUNT(*) FROM conv_buffer")
-        total_msgs = (await cur.fetchone() or [0])[0]
-        await cur.close()
-
         # фидбек: всего и за 7 дней
         week_ago = now - 7 * 86400
         cur = await db.execute("SELECT COUNT(*) FROM feedback")
@@ -104,14 +93,12 @@ async def cmd_astats(m: Message):
         text = (
             "<b>Сводная статистика</b>\n"
             f"Пользователи: <b>{total_users}</b>\n"
-            f"Активны за 24ч: <b>{active_24h}</b>\n"
-            f"Сообщений (conv_buffer): <b>{total_msgs}</b>\n"
+            f"Активны сегодня (UTC): <b>{active_today}</b>\n"
+            f"Сообщений в истории: <b>{total_msgs}</b>\n"
             f"Фидбеков всего: <b>{total_fb}</b>\n"
             f"Фидбеков за 7д: <b>{fb_7d}</b>\n"
         )
         await m.answer(text)
-    finally:
-        await db.close()
 
 # ---------- новые фидбеки ----------
 
@@ -120,8 +107,7 @@ async def cmd_newfb(m: Message):
     if not _is_admin(m.from_user.id):
         return
 
-    db = await open_db()
-    try:
+    async with read_db() as db:
         # последние 10 фидбеков
         cur = await db.execute(
             "SELECT id, tg_hash, created_at, blob FROM feedback ORDER BY id DESC LIMIT 10"
@@ -150,8 +136,6 @@ async def cmd_newfb(m: Message):
             )
 
         await m.answer("\n".join(lines))
-    finally:
-        await db.close()
 
 # ---------- health ----------
 
@@ -175,16 +159,11 @@ async def cmd_health(m: Message):
     # доступ к БД
     db_ok = True
     try:
-        db = await open_db()
-        await db.execute("SELECT 1")
+        async with read_db() as db:
+            await db.execute("SELECT 1")
     except Exception as e:
         db_ok = False
         problems.append(f"DB fail: {type(e).__name__}")
-    finally:
-        try:
-            await db.close()
-        except Exception:
-            pass
 
     ok = not problems and db_ok
     msg = "<b>HEALTH:</b> OK" if ok else "<b>HEALTH:</b> issues:\n- " + "\n- ".join(problems or [])
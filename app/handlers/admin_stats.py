@@ -1,4 +1,5 @@
 # app/handlers/admin_stats.py
+import re
 import time
 from aiogram import Router, F
 from aiogram.filters import Command, CommandObject
@@ -7,13 +8,25 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.exceptions import TelegramBadRequest
 
 from ..config import settings
-from ..db import get_active_counts, get_total_users_count, get_user_stats_30d
+from ..db import get_active_counts, get_total_users_count, get_user_stats_30d, get_top_users_30d
 from ..security import hash_user_id
 from ..limits import get_limits_snapshot, add_bonus_messages
 from ..db import get_user_flag, set_user_flag  # grace_reset
+from ..llm import llm_queue_stats, classify_cache_stats, premod_stats
+from ..langdetect import lang_stats
+from ..telemetry import flush_usage, get_usage_summary
+from .dialog import moderation_stats, coalesce_stats
 
 router = Router()
 _START_TS = int(time.time())
+# Очередь LLM, кэш классификатора, пре-модерация, язык, модерация и склейка считаются
+# в памяти процесса основного бота; в admin_bot.py (отдельный процесс) они всегда нулевые
+_process_stats = True
+
+def disable_process_stats() -> None:
+    """Для admin_bot.py: не показывать счётчики, которые живут только в процессе основного бота."""
+    global _process_stats
+    _process_stats = False
 
 # ---------- Утилиты ----------
 
@@ -45,6 +58,10 @@ def _kb_stats() -> InlineKeyboardMarkup:
     kb.adjust(1)
     return kb.as_markup()
 
+def _md(value) -> str:
+    """Экранирование для legacy Markdown: half_open, pro_advice и т.п. иначе ломают разметку."""
+    return re.sub(r"([_*`\[])", r"\\\1", str(value))
+
 def _fmt_bool(b: bool) -> str:
     return "✅" if b else "—"
 
@@ -64,10 +81,74 @@ def _fmt_top(rows: list[dict], limit: int = 10) -> str:
         )
     return "\n".join(lines)
 
+def _fmt_llm_queue(q: dict) -> str:
+    return (
+        f"В работе: {q['active']}/{q['limit']}   В очереди: {q['queued']}/{q['max_queue']}\n"
+        f"Ожидание: avg {q['wait_avg_ms']} мс, p95 {q['wait_p95_ms']} мс, max {q['wait_max_ms']} мс\n"
+        f"Пропущено: {q['admitted']}   Отказано: {q['rejected']}   Вытеснено: {q['evicted']}\n"
+        f"Circuit breaker: {_md(q['breaker'])}"
+        + "".join(
+            f"\n  {_md(p['name'])}: p95 {p['p95_ms']} мс, ошибок {p['error_rate']:.0%} (n={p['samples']})"
+            for p in q.get("providers", [])
+        )
+    )
+
+def _fmt_lang(c: dict) -> str:
+    if not c.get("checked"):
+        return "_нет данных_"
+    return (
+        f"Проверено: {c.get('checked', 0)}   транслит: {c.get('lang_translit', 0)} "
+        f"(локально в кириллицу: {c.get('translit_local', 0)})   "
+        f"англ.: {c.get('lang_en', 0)}\n"
+        f"Переписано: {c.get('rewrite', 0)}   перегенерировано: {c.get('regenerate', 0)}   "
+        f"пропущено по дедлайну: {c.get('skipped_deadline', 0)}   не помогло: {c.get('fix_failed', 0)}"
+    )
+
+def _fmt_classify_cache(c: dict) -> str:
+    total = c["hits"] + c["db_hits"] + c["misses"]
+    share = (c["hits"] + c["db_hits"]) / total if total else 0.0
+    b = c["batch"]
+    return (
+        f"Попаданий: {c['hits']} + {c['db_hits']} из БД, промахов: {c['misses']} ({share:.0%} без LLM)\n"
+        f"В памяти: {c['items']}   версия: `{c['version']}`\n"
+        f"Пачек: {b['batches']} (в среднем {b['avg_batch']:.1f})   поштучно: {b['singles']}   "
+        f"не разобрались: {b['fallbacks']}"
+    )
+
+def _fmt_premod(p: dict) -> str:
+    lines = [
+        f"Режим: {_md(p['mode'])}   проверено: {p['checked']}   локально: {p['local']}   "
+        f"неочевидно: {p['ambiguous']}   без совпадений: {p['no_hits']}   "
+        f"в среднем {p['avg_check_us']:.0f} мкс",
+        f"Сверено с LLM: {p['compared']}",
+    ]
+    for label, m in p["labels"].items():
+        prec = f"{m['precision']:.0%}" if m["precision"] is not None else "—"
+        rec = f"{m['recall']:.0%}" if m["recall"] is not None else "—"
+        lines.append(f"• {_md(label)}: точность {prec}, полнота {rec} (tp {m['tp']}, fp {m['fp']}, fn {m['fn']})")
+    return "\n".join(lines)
+
+def _fmt_moderation(c: dict) -> str:
+    labels = ", ".join(f"{_md(k[6:])}: {v}" for k, v in sorted(c.items()) if k.startswith("label_")) or "—"
+    return (
+        f"Режим: {_md(settings.dialog_moderation)}   проверено: {c.get('checked', 0)}   метки: {labels}\n"
+        f"Генерация отменена: {c.get('cancelled', 0)}   уже готова зря: {c.get('wasted', 0)}   "
+        f"ответ ждал метку: {c.get('waited', 0)}"
+    )
+
+def _fmt_coalesce(c: dict) -> str:
+    return (
+        f"Окно: {settings.dialog_coalesce_window_sec:g} с (макс. {settings.dialog_coalesce_max_wait_sec:g} с)   "
+        f"реплик: {c['turns']}   дописано сообщений: {c['merged']}   в среднем {c['avg_parts']:.2f} на реплику"
+    )
+
 async def _stats_text() -> str:
     dau, wau, mau = await get_active_counts()
     total = await get_total_users_count()
-    top = await get_user_stats_30d(limit=20)
+    # витрину пересобирает планировщик основного бота; пока её нет — считаем вживую
+    top = await get_top_users_30d(limit=20)
+    if top is None:
+        top = await get_user_stats_30d(limit=20)
     lines = [
         f"*Пользователи*",
         f"DAU: *{dau}*   WAU: *{wau}*   MAU: *{mau}*   Total: *{total}*",
@@ -75,6 +156,29 @@ async def _stats_text() -> str:
         "*Топ / активность за 30 дней*",
         _fmt_top(top, limit=10),
     ]
+    if not _process_stats:
+        lines += ["", "_Очередь к LLM, кэши и модерация — только в /stats основного бота._"]
+        return "\n".join(lines)
+    lines += [
+        "",
+        "*Очередь к LLM*",
+        _fmt_llm_queue(llm_queue_stats()),
+        "",
+        "*Язык ответов*",
+        _fmt_lang(lang_stats()),
+        "",
+        "*Кэш классификатора*",
+        _fmt_classify_cache(classify_cache_stats()),
+        "",
+        "*Пре-модерация*",
+        _fmt_premod(premod_stats()),
+        "",
+        "*Модерация диалога*",
+        _fmt_moderation(moderation_stats()),
+        "",
+        "*Склейка сообщений*",
+        _fmt_coalesce(coalesce_stats()),
+    ]
     return "\n".join(lines)
 
 def _parse_target(arg: str | None) -> str | None:
@@ -109,6 +213,41 @@ async def admin_refresh(cb: CallbackQuery):
     await _safe_edit(cb.message, text, reply_markup=_kb_stats(), parse_mode="Markdown")
     await cb.answer("Обновлено")
 
+# ---------- Телеметрия LLM ----------
+
+def _fmt_usage(rows: list[dict]) -> str:
+    if not rows:
+        return "<i>нет данных</i>"
+    lines = []
+    for r in rows:
+        p50 = r["latency_p50_ms"]
+        p95 = r["latency_p95_ms"]
+        mx = f", max {r['latency_max_ms']} мс" if r["latency_max_ms"] else ""
+        cached = r["cache_hit_tokens"] / r["prompt_tokens"] if r["prompt_tokens"] else 0.0
+        lines.append(
+            f"<b>{r['key']}</b>: {r['calls']} выз., ошибок {r['errors']}, ретраев {r['retries']}\n"
+            f"  токены: in {r['prompt_tokens']} (кэш {cached:.0%}), out {r['completion_tokens']}  ≈ ${r['cost_usd']:.4f}\n"
+            f"  задержка: avg {r['latency_avg_ms']} мс, p50 ≤{p50} мс, p95 ≤{p95} мс{mx}"
+        )
+    return "\n".join(lines)
+
+@router.message(Command("llmstats"))
+async def admin_llm_stats(msg: Message, command: CommandObject):
+    """/llmstats [часы] — стоимость и задержка LLM по тарифам и местам вызова (по умолчанию за 24 ч)."""
+    if not _is_admin(msg.from_user.id):
+        return
+    arg = (command.args or "").strip()
+    hours = int(arg) if arg.isdigit() and int(arg) > 0 else 24
+    await flush_usage()  # досыпаем текущие минуты из памяти
+    since = int(time.time()) - hours * 3600
+    by_tier = await get_usage_summary(since, group_by="tier")
+    by_site = await get_usage_summary(since, group_by="site")
+    text = (
+        f"<b>LLM за {hours} ч — по тарифам</b>\n{_fmt_usage(by_tier)}\n\n"
+        f"<b>По местам вызова</b>\n{_fmt_usage(by_site)}"
+    )
+    await msg.answer(text, parse_mode="HTML")
+
 # ---- бонусы/грейс — (оставьте как было у вас, ниже только пример) ----
 
 @router.message(Command("grant"))
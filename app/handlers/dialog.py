@@ -1,19 +1,56 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import logging
+import random
+import re
+import time
+from collections import Counter
+from contextlib import aclosing, nullcontext
+
 from aiogram import Router, F
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import Message
 from aiogram.utils.chat_action import ChatActionSender
 
 from ..security import hash_user_id
 from ..prefilter import rate_limit_ok, is_gibberish
-from ..limits import ensure_user, consume_one_message
-from ..llm import chat as llm_chat
-from ..prompts import gleb_SYSTEM_PROMPT as GLEB_SYSTEM_PROMPT
+from ..limits import consume_one_message, refund_one_message
+from ..config import settings
+from ..llm import (
+    chat as llm_chat, chat_stream as llm_chat_stream, classify,
+    LLMBusy, LLMUnavailable, priority_for, set_llm_priority, llm_would_reject,
+)
+from ..prompts import (
+    gleb_SYSTEM_PROMPT as GLEB_SYSTEM_PROMPT,
+    CRISIS_REPLIES, ILLEGAL_REPLIES, UNSAFE_REPLIES, BOUNDARIES_REPLIES, PRO_ADVICE_REPLIES, ROMANCE_REPLIES,
+)
 from ..limit_notice import pick_limit_notice
-from ..db import conv_load_history, conv_append
+from ..db import conv_load_history, conv_append, record_activity
+from ..deadline import DeadlineExceeded, start_deadline, remaining as deadline_remaining
+from ..prompt_budget import HistoryBudgeter, estimate_message
+from ..langdetect import detect_lang, translit_local, counters as lang_counters
+from ..coalesce import Coalescer
 
 router = Router(name="dialog")
+log = logging.getLogger(__name__)
+
+_HISTORY_KEEP = settings.conv_keep
+_budgeter = HistoryBudgeter(settings.dialog_prompt_budget_tokens, settings.dialog_prompt_max_history)
+_coalescer = Coalescer(settings.dialog_coalesce_window_sec, settings.dialog_coalesce_max_wait_sec)
+_BUSY_TEXT = "Сейчас слишком много желающих поговорить. Напиши через минуту."
+_DOWN_TEXT = "Что-то я завис. Напиши чуть позже."
 
-_HISTORY_KEEP = 8
+# метка классификатора → заготовки вместо ответа LLM
+_MODERATION_REPLIES = {
+    "crisis": CRISIS_REPLIES,
+    "illegal": ILLEGAL_REPLIES,
+    "unsafe": UNSAFE_REPLIES,
+    "boundaries": BOUNDARIES_REPLIES,
+    "pro_advice": PRO_ADVICE_REPLIES,
+    "romance": ROMANCE_REPLIES,
+}
+# счётчики модерации (см. moderation_stats)
+mod_counters: Counter = Counter()
 
 def _clamp(s: str, n: int = 800) -> str:
     s = (s or "").strip()
@@ -21,26 +58,187 @@ def _clamp(s: str, n: int = 800) -> str:
         return s
     return s[:n].rstrip() + "..."
 
+_SENTENCE_SPLIT = re.compile(r"(?<=[\.\!\?])\s+")
+
 def _shorten_sentences(reply: str, max_sentences: int = 3) -> str:
     r = (reply or "").strip()
     if not r:
         return r
-    import re
-    parts = re.split(r"(?<=[\.\!\?])\s+", r)
+    parts = _SENTENCE_SPLIT.split(r)
     if len(parts) > max_sentences:
         return " ".join(parts[:max_sentences]).strip()
     return r
 
-async def _ensure_russian(reply: str) -> str:
-    if not reply:
+_RU_ONLY = "Отвечай ТОЛЬКО на русском языке, кириллицей. Без транслита и английских слов."
+
+async def _ensure_russian(reply: str, messages: list) -> str:
+    if not reply or settings.dialog_lang_fix == "off":
+        return reply
+    lang = detect_lang(reply)
+    lang_counters["checked"] += 1
+    lang_counters[f"lang_{lang}"] += 1
+    if lang == "translit":
+        # "privet, kak dela" — переводим локально, без второго запроса, если перевод однозначный;
+        # иначе (потерянные ь/ъ и т.п.) — переписываем через LLM, как английский
+        local = translit_local(reply)
+        if local is not None:
+            lang_counters["translit_local"] += 1
+            return local
+    elif lang != "en":
         return reply
-    # Если весь ответ латиницей — просим LLM переписать по-русски
-    import re
-    if re.search(r"[A-Za-z]{3,}", reply) and not re.search(r"[А-Яа-яЁё]", reply):
-        sys = "Перепиши ответ СТРОГО на русском языке. Без транслита и англицизмов. Коротко."
-        fixed = await llm_chat([{"role":"system","content":sys},{"role":"user","content":reply}], max_tokens=120, temperature=0.3)
-        return (fixed or reply).strip()
-    return reply
+    left = deadline_remaining()
+    if left is not None and left < settings.dialog_optional_min_sec:
+        # шаг необязательный — на него не хватает бюджета апдейта
+        lang_counters["skipped_deadline"] += 1
+        return reply
+    try:
+        if settings.dialog_lang_fix == "regenerate":
+            # тот же запрос плюс требование языка в конце — префикс не меняется
+            lang_counters["regenerate"] += 1
+            fixed = await llm_chat(messages + [{"role":"system","content":_RU_ONLY}], max_tokens=140, temperature=0.6, site="ensure_russian")
+            fixed = _shorten_sentences(fixed, max_sentences=3)
+        else:
+            lang_counters["rewrite"] += 1
+            sys = "Перепиши ответ СТРОГО на русском языке. Без транслита и англицизмов. Коротко."
+            fixed = await llm_chat([{"role":"system","content":sys},{"role":"user","content":reply}], max_tokens=120, temperature=0.3, site="ensure_russian")
+    except LLMUnavailable:
+        return reply
+    fixed = (fixed or "").strip()
+    if detect_lang(fixed) not in ("ru", "mixed"):
+        lang_counters["fix_failed"] += 1
+    return fixed or reply
+
+class _ProgressiveReply:
+    """Сообщение-ответ, которое отправляется один раз и дальше дописывается правками
+    не чаще, чем раз в interval секунд."""
+
+    def __init__(self, msg: Message, interval: float):
+        self._msg = msg
+        self._interval = max(0.0, float(interval))
+        self._last = 0.0
+        self._shown = ""
+        self.sent: Message | None = None
+
+    async def show(self, text: str, *, final: bool = False) -> None:
+        text = (text or "").strip()
+        if not text or text == self._shown:
+            return
+        now = time.monotonic()
+        if self.sent is None:
+            self.sent = await self._msg.answer(text)
+        elif final or now - self._last >= self._interval:
+            try:
+                await self._edit(text, final)
+            except TelegramRetryAfter as e:
+                # промежуточную правку просто пропускаем
+                self._last = now + e.retry_after
+                return
+        else:
+            return
+        self._shown = text
+        self._last = now
+
+    async def _edit(self, text: str, final: bool) -> None:
+        """Финальную правку при RetryAfter дожидаемся один раз; не вышло — шлём текст новым сообщением."""
+        for attempt in range(2):
+            try:
+                await self.sent.edit_text(text)
+                return
+            except TelegramRetryAfter as e:
+                if not final:
+                    raise
+                if attempt == 0:
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                log.warning("final edit_text rate-limited again, sending a new message")
+            except TelegramBadRequest as e:
+                # "message is not modified" и т.п. — не повод ронять ответ
+                if not final or "message is not modified" in str(e).lower():
+                    log.debug("edit_text: %s", e)
+                    return
+                log.warning("final edit_text failed (%s), sending a new message", e)
+            break
+        self.sent = await self._msg.answer(text)
+
+
+def _label_of(mod: asyncio.Task | None) -> str | None:
+    """Метка готовой задачи классификатора; None — ещё не готова. classify сам fail-open."""
+    if mod is None:
+        return "normal"
+    if not mod.done():
+        return None
+    if mod.cancelled() or mod.exception() is not None:
+        return "normal"
+    return mod.result().get("label", "normal")
+
+
+def _discard(task: asyncio.Task) -> None:
+    """Отменить ненужную задачу и не оставить «Task exception was never retrieved»."""
+    if task.done():
+        if not task.cancelled():
+            task.exception()
+    else:
+        task.cancel()
+
+
+def moderation_stats() -> dict:
+    return dict(mod_counters)
+
+
+def coalesce_stats() -> dict:
+    return _coalescer.stats()
+
+
+async def _stream_reply(msg: Message, messages: list, mod: asyncio.Task | None = None) -> tuple[str, _ProgressiveReply]:
+    """
+    Потоковая генерация: как только готово первое предложение — отправляем его,
+    дальше правим сообщение по мере прихода текста. Возвращает сырой ответ
+    (постобработку и финальную правку делает вызывающий).
+
+    Как только начался (max_sentences+1)-й кусок, поток закрываем: первые
+    max_sentences предложений уже не изменятся, и _shorten_sentences от
+    обрезанного текста даёт ровно то же, что от полного. Поток не длится
+    дольше дедлайна апдейта — по нему оставляем то, что успело прийти.
+
+    mod — параллельная модерация: пока метки нет (или она не normal),
+    пользователю ничего не показываем, текст копится в буфере.
+    """
+    max_sentences = 3
+    out = _ProgressiveReply(msg, settings.dialog_stream_edit_interval_sec)
+    buf = ""
+
+    async def _consume() -> None:
+        nonlocal buf
+        stream = llm_chat_stream(messages, max_tokens=140, temperature=0.6, site="dialog")
+        async with aclosing(stream):
+            async for piece in stream:
+                buf += piece
+                parts = _SENTENCE_SPLIT.split(buf.strip())
+                if len(parts) > max_sentences:
+                    log.debug("stream stopped early at %d chars", len(buf))
+                    break
+                if _label_of(mod) != "normal":
+                    continue
+                if out.sent is None:
+                    # первое сообщение — только законченные предложения
+                    if len(parts) > 1:
+                        await out.show(" ".join(parts[:-1]))
+                else:
+                    await out.show(" ".join(parts))
+
+    await msg.bot.send_chat_action(msg.chat.id, "typing")
+    try:
+        await asyncio.wait_for(_consume(), deadline_remaining())
+    except LLMUnavailable:
+        raise
+    except Exception:
+        if not buf:
+            # поток не начался — обычный запрос с ретраями
+            log.warning("stream failed before first token, falling back", exc_info=True)
+            return await llm_chat(messages, max_tokens=140, temperature=0.6, site="dialog"), out
+        log.warning("stream interrupted, using partial reply", exc_info=True)
+    return buf, out
+
 
 @router.message(F.text)
 async def on_dialog(msg: Message):
@@ -51,8 +249,23 @@ async def on_dialog(msg: Message):
     if not user_text:
         return
 
-    # Prefilter: частота и бессмыслица
-    ok_rate, why = rate_limit_ok(uid, msg.date.timestamp() if msg.date else None)
+    # Несколько сообщений подряд — одна реплика: отвечает обработчик первого,
+    # остальные дописываются в его окно и выходят
+    user_text = await _coalescer.collect(uid, user_text)
+    if user_text is None:
+        return
+
+    # общий бюджет на апдейт: LLM-вызовы и ожидание соединений БД укладываются в остаток
+    # (отсчёт — после окна склейки)
+    start_deadline(settings.dialog_deadline_sec)
+
+    # Prefilter: частота и бессмыслица. При склейке «слишком быстро» не бывает —
+    # быстрые сообщения уже стали одной репликой; остаётся только лимит на всплески
+    ok_rate, why = rate_limit_ok(
+        uid,
+        msg.date.timestamp() if msg.date else time.time(),
+        hard_every_sec=0.0 if _coalescer.enabled else 2.0,
+    )
     if not ok_rate:
         await msg.answer("Ты заебал так быстро писать.")
         return
@@ -60,35 +273,91 @@ async def on_dialog(msg: Message):
         await msg.answer("Даже слово написать не можешь, хуйня безграмотная.")
         return
 
-    await ensure_user(tg_hash)
-
     # Лимит: если нет сообщений — отшиваем нейтральным пинком
+    # (consume_one_message сам заводит пользователя и делает суточный сброс)
     ok = await consume_one_message(tg_hash)
     if not ok:
         notice = await pick_limit_notice(tg_hash)
         await msg.answer(notice)
         return
 
-    # История + системный промпт
+    try:
+        await _reply_turn(msg, tg_hash, user_text, ok)
+    except (LLMUnavailable, DeadlineExceeded) as e:
+        # сообщение списано, а ответа не будет — возвращаем; бюджет апдейта
+        # к этому моменту может быть исчерпан, поэтому возврат пишем уже без дедлайна
+        start_deadline(0)
+        await refund_one_message(tg_hash, ok["charged"])
+        await msg.answer(_BUSY_TEXT if isinstance(e, LLMBusy) else _DOWN_TEXT)
+
+
+async def _reply_turn(msg: Message, tg_hash: str, user_text: str, ok: dict) -> None:
+    """Всё, что после списания: LLMUnavailable и DeadlineExceeded обрабатывает on_dialog (с возвратом)."""
+    # Очередь к LLM: платные идут первыми; если места нет — сразу «занято», сообщение возвращаем
+    set_llm_priority(priority_for(ok["subscription_tier"], ok["subscription_until"]))
+    if llm_would_reject():
+        raise LLMBusy("LLM queue is full")
+
+    # История + системный промпт. Порядок: system → история → новая реплика;
+    # начало окна истории стоит на месте между ходами, чтобы префикс попадал в кэш DeepSeek
     hist = await conv_load_history(tg_hash, limit=_HISTORY_KEEP)
-    messages = [{"role":"system","content":GLEB_SYSTEM_PROMPT.strip()}]
+    system = {"role":"system","content":GLEB_SYSTEM_PROMPT.strip()}
+    user = {"role":"user","content":_clamp(user_text)}
+    history = []
     for m in hist:
         role = m.get("role")
         content = _clamp(m.get("content",""))
         if role in ("user","assistant") and content:
-            messages.append({"role": role, "content": content})
-    messages.append({"role":"user","content":_clamp(user_text)})
+            history.append({"role": role, "content": content})
+    history = _budgeter.select(tg_hash, history, estimate_message(system) + estimate_message(user))
+    messages = [system, *history, user]
 
-    # Генерация
-    async with ChatActionSender.typing(msg.chat.id, msg.bot):
-        reply = await llm_chat(messages, max_tokens=140, temperature=0.6)
+    # Генерация и модерация стартуют одновременно (задачи наследуют приоритет и дедлайн);
+    # метка обычно приходит раньше ответа, и модерация не добавляет задержки
+    mod = None
+    if settings.dialog_moderation == "parallel":
+        mod = asyncio.create_task(classify(user_text))
+    progressive = None
+    if settings.dialog_streaming:
+        gen = asyncio.create_task(_stream_reply(msg, messages, mod))
+    else:
+        gen = asyncio.create_task(llm_chat(messages, max_tokens=140, temperature=0.6, site="dialog"))
+    # в потоковом режиме «печатает» шлёт сам _stream_reply, дальше видно сообщение
+    typing = nullcontext() if settings.dialog_streaming else ChatActionSender.typing(msg.chat.id, msg.bot)
+    async with typing:
+        if mod is not None:
+            await asyncio.wait([mod])
+            label = _label_of(mod)
+            mod_counters["checked"] += 1
+            if label != "normal":
+                mod_counters[f"label_{label}"] += 1
+                mod_counters["cancelled" if not gen.done() else "wasted"] += 1
+                _discard(gen)
+                # заготовка вместо ответа — сообщение пользователю не засчитываем
+                await refund_one_message(tg_hash, ok["charged"])
+                await record_activity(tg_hash)
+                await msg.answer(random.choice(_MODERATION_REPLIES[label]))
+                return
+            if gen.done():
+                # ответ был готов раньше метки — ждали модерацию
+                mod_counters["waited"] += 1
+        result = await gen
+    if settings.dialog_streaming:
+        reply, progressive = result
+    else:
+        reply = result
 
     # Постобработка
     reply = _shorten_sentences(reply, max_sentences=3)
-    reply = await _ensure_russian(reply)
+    reply = await _ensure_russian(reply, messages)
 
     # Сохранение истории
     await conv_append(tg_hash, "user", user_text, keep=_HISTORY_KEEP)
     await conv_append(tg_hash, "assistant", reply, keep=_HISTORY_KEEP)
+    await record_activity(tg_hash)
 
-    await msg.answer(reply)
+    if progressive is not None:
+        # финальная правка — текст после постобработки (в т.ч. перевод на русский)
+        await progressive.show(reply, final=True)
+    else:
+        await msg.answer(reply)
@@ -11,7 +11,7 @@ from aiogram.types import Message
 
 from ..config import settings
 from ..security import hash_user_id, encrypt_feedback
-from ..db import open_db, get_user_kv, set_user_kv
+from ..db import write_db, get_user_kv, set_user_kv
 
 router = Router()
 log = logging.getLogger(__name__)
@@ -56,16 +56,12 @@ async def fb_save(msg: Message, state: FSMContext):
         return
 
     # Запись в БД
-    db = await open_db()
-    try:
+    async with write_db() as db:
         blob = encrypt_feedback(text)
         await db.execute(
             "INSERT INTO feedback(tg_hash, created_at, blob) VALUES(?,?,?)",
             (tg_hash, int(time.time()), blob),
         )
-        await db.commit()
-    finally:
-        await db.close()
 
     # Сохраняем метку кулдауна
     await set_user_kv(tg_hash, key_cd, str(time.time()))
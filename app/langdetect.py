@@ -0,0 +1,196 @@
+# app/langdetect.py
+"""
+Локальное определение языка ответа без LLM: доля кириллицы/латиницы по
+Unicode-скриптам плюс n-граммы и частые слова, чтобы отличить английский
+от русского транслита ("privet, kak dela").
+
+detect_lang() → "ru" | "mixed" | "translit" | "en" | "other"
+translit_to_cyrillic() переводит транслит обратно в кириллицу — без второго вызова LLM.
+Транслит теряет ь/ъ ("ochen", "zdes"), поэтому translit_local() отдаёт перевод,
+только когда он однозначен; иначе ответ переписывает LLM.
+"""
+from __future__ import annotations
+
+import re
+from collections import Counter
+from typing import Dict, Optional
+
+# счётчики решений dialog._ensure_russian (см. lang_stats)
+counters: Counter = Counter()
+
+_WORD = re.compile(r"[a-z']+")
+
+# n-граммы, типичные для русского транслита / для английского, с весами
+_TRANSLIT_NGRAMS: Dict[str, float] = {
+    "zh": 2.0, "kh": 2.0, "shch": 3.0, "sch": 1.0, "ts": 0.5, "ya": 1.5, "yu": 1.5,
+    "yo": 0.5, "iy": 1.5, "yy": 2.0, "ij": 1.0, "ov": 0.5, "ev": 0.5, "aya": 1.5,
+    "oye": 1.0, "ego": 1.0, "ogo": 1.0, "tsya": 3.0,
+}
+_EN_NGRAMS: Dict[str, float] = {
+    "th": 2.0, "wh": 1.5, "ing": 2.0, "ght": 2.0, "tion": 2.0, "ea": 1.0, "ou": 0.5,
+    "ee": 1.0, "oo": 1.0, "ck": 1.0, "w": 0.5, "ly": 0.5, "'s": 1.0, "'t": 1.5,
+}
+# частые короткие слова: по ним язык виден даже в коротком ответе
+_TRANSLIT_WORDS = frozenset(
+    "privet kak chto cho eto ty ya mne menya tebya tebe net da nu vot tak tozhe"
+    " ochen prosto seychas sejchas pochemu kogda gde zdes tut khorosho horosho"
+    " ploho spasibo poka davay davai blin zhe uzhe esche eshche mozhno nado"
+    " nichego vsyo vse kto chem dela delo sebya svoy moy tvoy".split()
+)
+_EN_WORDS = frozenset(
+    "the you and is are i to it what that this of in not do have me my your can"
+    " how just be was so but if with for on at about know think feel really".split()
+)
+
+# транслит → кириллица: сначала длинные сочетания
+_TRANSLIT_MAP = [
+    ("shch", "щ"), ("sch", "щ"), ("tsya", "ться"), ("zh", "ж"), ("kh", "х"), ("ch", "ч"),
+    ("sh", "ш"), ("ts", "ц"), ("yu", "ю"), ("ya", "я"), ("yo", "ё"), ("ye", "е"),
+    ("iy", "ий"), ("yy", "ый"), ("ij", "ий"), ("a", "а"), ("b", "б"), ("v", "в"),
+    ("w", "в"), ("g", "г"), ("d", "д"), ("e", "е"), ("z", "з"), ("i", "и"), ("j", "й"),
+    ("k", "к"), ("l", "л"), ("m", "м"), ("n", "н"), ("o", "о"), ("p", "п"), ("r", "р"),
+    ("s", "с"), ("t", "т"), ("u", "у"), ("f", "ф"), ("h", "х"), ("c", "ц"), ("y", "ы"),
+    ("x", "кс"), ("q", "к"), ("'", "ь"),
+]
+_TRANSLIT_RE = re.compile("|".join(re.escape(k) for k, _ in _TRANSLIT_MAP))
+_TRANSLIT_DICT = dict(_TRANSLIT_MAP)
+# до посимвольной замены: "e" в начале слова перед t/k/h — это «э» (eto, etot, ekh, ekzamen),
+# а esli/eshche/emu остаются с «е»; "y" после гласной и не перед гласной — «й» (moy, davay, seychas)
+# "sh" в конце после e/i/yo — глагольное -ешь/-ишь/-ёшь (delaesh, vidish)
+_TRANSLIT_PRE = [
+    (re.compile(r"^e(?=[tkh])"), "э"),
+    (re.compile(r"(?<=[aeiouэ])y(?![aeiouy])"), "j"),
+    (re.compile(r"(?:(?<=[ei])|(?<=yo))sh$"), "sh'"),
+]
+# "tsya" → "ться"; после е/у/ю/ё — это 3-е лицо: кажется, учатся, смеются
+_TRANSLIT_POST = [(re.compile(r"(?<=[еуюё])ться$"), "тся")]
+# частые слова с ь/ъ, которые транслитом пишут без апострофа: по буквам их не восстановить
+_SOFT_WORDS: Dict[str, str] = {
+    "ochen": "очень", "zdes": "здесь", "est": "есть", "byt": "быть", "den": "день", "ves": "весь",
+    "tolko": "только", "skolko": "сколько", "bolshe": "больше", "menshe": "меньше",
+    "teper": "теперь", "zhizn": "жизнь", "lyubov": "любовь", "pust": "пусть", "mysl": "мысль",
+    "noch": "ночь", "pomoch": "помочь", "moch": "мочь", "nibud": "нибудь", "malchik": "мальчик",
+    "pismo": "письмо", "semya": "семья", "delat": "делать", "znat": "знать", "dumat": "думать",
+    "spat": "спать", "zhit": "жить", "obyasni": "объясни", "obyasnit": "объяснить",
+    "podyezd": "подъезд", "syest": "съесть",
+}
+# где без контекста не понять, нужен ли ь/ъ: учится/учиться, "tsa" вместо "тся",
+# приставка перед y+гласная (obyazatelno, но obyasnit), окончания -т/-ст/-ч (говорит/говорить,
+# мост/пусть, врач/ночь); гласная+"et" — 3-е лицо (byvaet, znaet), его не трогаем
+_AMBIGUOUS = re.compile(
+    r"itsya$|tsa$|^(?:ob|pod|raz|iz|ot|nad|s)y[aeou]|(?<=[aeiouy])(?<![aeiouy]e)t$|st$|ch$"
+)
+# кириллица → канонический транслит: проверка, что перевод однозначен
+_CYR_TO_LAT = dict(zip(
+    "абвгдеёжзийклмнопрстуфхцчшщъыьэюя",
+    "a b v g d e yo zh z i y k l m n o p r s t u f h ts ch sh shch _ y _ e yu ya".split(),
+))
+_CANON = [("'", ""), ("kh", "h"), ("sch", "shch"), ("ij", "iy"), ("j", "y"), ("ye", "e")]
+
+
+def script_counts(text: str) -> Dict[str, int]:
+    """Сколько букв кириллицей, латиницей и прочими алфавитами."""
+    cyr = lat = other = 0
+    for ch in text or "":
+        if not ch.isalpha():
+            continue
+        if "Ѐ" <= ch <= "ӿ":
+            cyr += 1
+        elif ch.isascii():
+            lat += 1
+        else:
+            other += 1
+    return {"cyr": cyr, "lat": lat, "other": other}
+
+
+def translit_score(text: str) -> float:
+    """> 0 — латиница похожа на русский транслит, < 0 — на английский."""
+    score = 0.0
+    for w in _WORD.findall((text or "").lower()):
+        if w in _TRANSLIT_WORDS:
+            score += 3.0
+        elif w in _EN_WORDS:
+            score -= 3.0
+        for ng, wt in _TRANSLIT_NGRAMS.items():
+            if ng in w:
+                score += wt
+        for ng, wt in _EN_NGRAMS.items():
+            if ng in w:
+                score -= wt
+    return score
+
+
+def detect_lang(text: str) -> str:
+    c = script_counts(text)
+    letters = c["cyr"] + c["lat"] + c["other"]
+    if letters == 0:
+        return "other"
+    if c["cyr"] and c["cyr"] >= c["lat"]:
+        return "ru"
+    if c["cyr"]:
+        return "mixed"
+    if c["lat"] < letters * 0.5:
+        return "other"
+    # одиночные междометия и бренды ("ok", "lol", "WTF") за язык не считаем
+    if len(_WORD.findall(text.lower())) < 3 and c["lat"] < 10:
+        return "other"
+    return "translit" if translit_score(text) > 0 else "en"
+
+
+def translit_to_cyrillic(text: str) -> str:
+    def _sub(m: re.Match) -> str:
+        return _TRANSLIT_DICT[m.group(0)]
+
+    def _word(m: re.Match) -> str:
+        w = m.group(0)
+        out = _SOFT_WORDS.get(w.lower())
+        if out is None:
+            out = w.lower()
+            for rx, repl in _TRANSLIT_PRE:
+                out = rx.sub(repl, out)
+            out = _TRANSLIT_RE.sub(_sub, out)
+            for rx, repl in _TRANSLIT_POST:
+                out = rx.sub(repl, out)
+        if w[:1].isupper():
+            out = out[:1].upper() + out[1:]
+        return out
+
+    return re.sub(r"[A-Za-z']+", _word, text or "")
+
+
+def _canon(latin: str) -> str:
+    out = latin.lower()
+    for a, b in _CANON:
+        out = out.replace(a, b)
+    return out
+
+
+def _round_trips(latin: str, cyrillic: str) -> bool:
+    """Кириллица обратно в транслит совпадает с исходным (с точностью до kh/h, j/y, апострофов)."""
+    back = "".join(_CYR_TO_LAT.get(ch, ch) for ch in cyrillic.lower()).replace("_", "")
+    return _canon(back) == _canon(latin)
+
+
+def translit_local(text: str) -> Optional[str]:
+    """
+    Кириллица — если транслит уверенный (в среднем не меньше балла translit_score
+    на слово), в нём нет слов, где ь/ъ не угадать, и перевод сходится обратно
+    (нет w/c/x/q и т.п.). None — пусть переписывает LLM.
+    """
+    words = _WORD.findall((text or "").lower())
+    if not words or translit_score(text) < len(words):
+        return None
+    for w in words:
+        if w in _SOFT_WORDS or w in _TRANSLIT_WORDS or "'" in w:
+            continue
+        if _AMBIGUOUS.search(w):
+            return None
+    out = translit_to_cyrillic(text)
+    for w, cyr in zip(re.findall(r"[A-Za-z']+", text), re.findall(r"[А-Яа-яЁё]+", out)):
+        if not _round_trips(w, cyr):
+            return None
+    return out
+
+
+def lang_stats() -> Dict[str, int]:
+    return dict(counters)
@@ -21,7 +21,7 @@ async def build_contextual_pause(last_messages: List[Dict], max_tokens: int = 40
     messages = [{"role": "system", "content": SYSTEM_PROMPT.strip()}]
     messages.extend(tail)
     try:
-        text = await llm_chat(messages, max_tokens=max_tokens, temperature=0.35)
+        text = await llm_chat(messages, max_tokens=max_tokens, temperature=0.35, site="limit_pause")
         text = (text or "").strip()
         first_line = text.splitlines()[0].strip(" \t\"'`")
         if len(first_line) > 160:
@@ -3,18 +3,29 @@ from __future__ import annotations
 
 import time
 import json
+import logging
+from datetime import datetime, timedelta, time as dtime, tzinfo
 from typing import Dict, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from .config import settings
-from .db import open_db, get_user_kv, set_user_kv
+from .db import read_db, write_db, get_user_kv
+
+log = logging.getLogger(__name__)
 
 
 # -------- Конфигурация квот --------
 
 _KV_LIMITS_MAP = "limits:daily_map"  # JSON вида {"FREE":10,"PLUS":30,"PREMIUM":100}
+_KV_LIMITS_VERSION = "limits:daily_map_version"  # растёт при каждом set_quota_map
 
+# Кэш карты квот в памяти процесса. Раз в QUOTA_VERSION_CHECK_SEC сверяем только номер версии
+# в kv (точечное чтение); карту перечитываем, лишь если версия сменилась (другой процесс,
+# например админ-бот, выполнил /setquota).
+_quota_cache: Dict[str, object] = {"map": None, "version": None, "checked": 0.0}
 
-async def get_quota_map() -> Dict[str, int]:
+
+async def _load_quota_map() -> Dict[str, int]:
     """
     Источник приоритетов:
     1) kv['limits:daily_map'] (можно менять «на лету»)
@@ -46,25 +57,86 @@ async def get_quota_map() -> Dict[str, int]:
     }
 
 
-async def set_quota_map(map_: Dict[str, int]) -> None:
+async def get_quota_version() -> int:
+    raw = await get_user_kv("global", _KV_LIMITS_VERSION)
+    try:
+        return int(raw) if raw else 0
+    except ValueError:
+        return 0
+
+
+async def get_quota_map() -> Dict[str, int]:
     """
-    Устанавливает карту квот «на лету». Пример:
+    Текущая карта квот (см. приоритеты в _load_quota_map).
+    Между проверками версии — просто словарь из памяти; не изменяйте результат.
+    """
+    now = time.monotonic()
+    cached = _quota_cache["map"]
+    if cached is not None and now - float(_quota_cache["checked"]) < settings.quota_version_check_sec:
+        return cached  # type: ignore[return-value]
+
+    version = await get_quota_version()
+    if cached is None or version != _quota_cache["version"]:
+        cached = await _load_quota_map()
+        _quota_cache["map"] = cached
+        _quota_cache["version"] = version
+    _quota_cache["checked"] = now
+    return cached  # type: ignore[return-value]
+
+
+async def set_quota_map(map_: Dict[str, int]) -> int:
+    """
+    Устанавливает карту квот «на лету» и поднимает её версию — остальные процессы
+    подхватят карту при ближайшей сверке версии. Возвращает новую версию. Пример:
     await set_quota_map({"FREE": 12, "PLUS": 30, "PREMIUM": 100})
     """
     safe = {str(k).upper(): int(v) for k, v in map_.items()}
-    await set_user_kv("global", _KV_LIMITS_MAP, json.dumps(safe, ensure_ascii=False))
+    now = time.time()
+    # мимо write-behind: карта и версия должны попасть в БД вместе и сразу
+    async with write_db() as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO kv(user_id, key, value, updated) VALUES(?,?,?,?)",
+            ("global", _KV_LIMITS_MAP, json.dumps(safe, ensure_ascii=False), now),
+        )
+        cur = await db.execute(
+            """
+            INSERT INTO kv(user_id, key, value, updated) VALUES(?, ?, '1', ?)
+            ON CONFLICT(user_id, key) DO UPDATE SET
+              value = CAST(COALESCE(NULLIF(value, ''), '0') AS INTEGER) + 1,
+              updated = excluded.updated
+            RETURNING value
+            """,
+            ("global", _KV_LIMITS_VERSION, now),
+        )
+        row = await cur.fetchone()
+        await cur.close()
+    version = int(row[0])
+    _quota_cache.update(map=safe, version=version, checked=time.monotonic())
+    return version
 
 
-def _next_midnight_ts(now_ts: int | None = None) -> int:
+def _tz(tz_name: Optional[str] = None) -> tzinfo:
     """
-    Возвращает Unix-время ближайшей полуночи (UTC-нейтрально).
+    Часовой пояс для суточного сброса: users.tz_name → QUOTA_TZ → локальный пояс сервера.
+    Неизвестное имя зоны молча заменяем на следующий вариант.
     """
-    now = int(now_ts or time.time())
-    # вычислим локально: округлим до дней
-    # (точная TZ-полночь не критична для счётчика; можно заменить на пользовательскую TZ при желании)
-    t = time.gmtime(now)
-    midnight = int(time.mktime((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0, t.tm_wday, t.tm_yday, t.tm_isdst))) + 24 * 3600
-    return midnight
+    for name in (tz_name, settings.quota_tz):
+        if name:
+            try:
+                return ZoneInfo(name)
+            except (ZoneInfoNotFoundError, ValueError):
+                continue
+    return datetime.now().astimezone().tzinfo
+
+
+def _next_midnight_ts(now_ts: int | None = None, tz_name: Optional[str] = None) -> int:
+    """
+    Возвращает Unix-время ближайшей полуночи в поясе пользователя (см. _tz).
+    """
+    tz = _tz(tz_name)
+    now = datetime.fromtimestamp(int(now_ts or time.time()), tz)
+    midnight = datetime.combine(now.date() + timedelta(days=1), dtime(0), tzinfo=tz)
+    return int(midnight.timestamp())
 
 
 async def _compute_user_daily_limit(subscription_tier: str, subscription_until: Optional[int]) -> int:
@@ -91,11 +163,11 @@ async def _compute_user_daily_limit(subscription_tier: str, subscription_until:
 async def ensure_user(tg_hash: str) -> None:
     """
     Создаёт запись о пользователе при первом входе.
-    Если наступила новая «полночь» — сбрасывает дневной лимит согласно карте квот.
+    Если наступила новая «полночь», а фоновый reset_due_limits() ещё не успел, —
+    сбрасывает дневной лимит этому пользователю сам (для /start, снапшотов, оплат).
     """
-    db = await open_db()
-    try:
-        cur = await db.execute("SELECT tg_hash, counter_reset_at, subscription_tier, subscription_until, daily_limit_remaining FROM users WHERE tg_hash=? LIMIT 1", (tg_hash,))
+    async with write_db() as db:
+        cur = await db.execute("SELECT tz_name, counter_reset_at, subscription_tier, subscription_until, daily_limit_remaining FROM users WHERE tg_hash=? LIMIT 1", (tg_hash,))
         row = await cur.fetchone()
         await cur.close()
         now = int(time.time())
@@ -110,60 +182,121 @@ async def ensure_user(tg_hash: str) -> None:
                 "INSERT INTO users (tg_hash, created_at, counter_reset_at, subscription_tier, subscription_until, daily_limit_remaining) VALUES (?,?,?,?,?,?)",
                 (tg_hash, now, reset_at, tier, None, int(limit)),
             )
-            await db.commit()
             return
 
         # существующий: проверим необходимость сброса
-        _, counter_reset_at, tier, sub_until, daily_left = row
+        tz_name, counter_reset_at, tier, sub_until, daily_left = row
         if not counter_reset_at or int(counter_reset_at) <= now:
             limit = await _compute_user_daily_limit(tier, sub_until)
-            reset_at = _next_midnight_ts(now)
+            reset_at = _next_midnight_ts(now, tz_name)
             await db.execute(
                 "UPDATE users SET daily_limit_remaining=?, counter_reset_at=? WHERE tg_hash=?",
                 (int(limit), int(reset_at), tg_hash),
             )
-            await db.commit()
-    finally:
-        await db.close()
 
 
-async def consume_one_message(tg_hash: str) -> bool:
+def _fallback_limits(m: Dict[str, int]) -> tuple[int, int]:
+    """(лимит для активной подписки без своего tier в карте, лимит без подписки) — как в _compute_user_daily_limit."""
+    paid = int(m.get("PAID", m.get("PLUS", settings.paid_daily_limit)))
+    free = int(m.get("FREE", settings.free_daily_limit))
+    return paid, free
+
+
+# Дневной лимит строки users по карте квот (:qmap — JSON), та же логика, что в _compute_user_daily_limit
+_SQL_TIER_LIMIT = """
+COALESCE(
+  json_extract(:qmap, '$."' || UPPER(COALESCE(subscription_tier, 'FREE')) || '"'),
+  CASE WHEN COALESCE(subscription_until, 0) > :now THEN :paid_fallback ELSE :free_fallback END
+)
+"""
+
+# Полночь уже наступила, а reset_due_limits() до строки ещё не дошёл: сбрасываем её прямо при списании.
+# Следующий сброс — через целое число суток от прошлого: это полночь в поясе пользователя
+# (кроме дня перехода на летнее/зимнее время — там ошибка в час, её поправит следующий плановый сброс).
+_SQL_DUE = "counter_reset_at <= :now"
+_SQL_NEXT_RESET = "counter_reset_at + 86400 * ((:now - counter_reset_at) / 86400 + 1)"
+_SQL_DAILY_LEFT = f"CASE WHEN {_SQL_DUE} THEN {_SQL_TIER_LIMIT} ELSE daily_limit_remaining END"
+_SQL_RETURNING = "RETURNING daily_limit_remaining, bonus_messages, counter_reset_at, subscription_tier, subscription_until"
+
+# Каждое выражение — одна точечная атомарная запись с условием в WHERE; строка вернулась ⇔ списание прошло.
+# 1) из дневного лимита (с ленивым сбросом) — обычный путь, один запрос
+_SQL_CHARGE_DAILY = f"""
+UPDATE users SET
+  daily_limit_remaining = ({_SQL_DAILY_LEFT}) - 1,
+  counter_reset_at = CASE WHEN {_SQL_DUE} THEN {_SQL_NEXT_RESET} ELSE counter_reset_at END
+WHERE tg_hash = :tg_hash AND ({_SQL_DAILY_LEFT}) > 0
+{_SQL_RETURNING}
+"""
+# 2) дневной лимит пуст — из bonus_messages
+_SQL_CHARGE_BONUS = f"""
+UPDATE users SET
+  daily_limit_remaining = {_SQL_DAILY_LEFT},
+  counter_reset_at = CASE WHEN {_SQL_DUE} THEN {_SQL_NEXT_RESET} ELSE counter_reset_at END,
+  bonus_messages = bonus_messages - 1
+WHERE tg_hash = :tg_hash AND ({_SQL_DAILY_LEFT}) <= 0 AND bonus_messages > 0
+{_SQL_RETURNING}
+"""
+# 3) пользователя ещё нет — заводим сразу со списанием (без бесплатной квоты не заводим: бонусов у него нет)
+_SQL_CHARGE_NEW = f"""
+INSERT INTO users (tg_hash, created_at, counter_reset_at, subscription_tier, subscription_until, daily_limit_remaining)
+SELECT :tg_hash, :now, :reset_at, 'FREE', NULL, :new_limit - 1
+WHERE :new_limit > 0
+ON CONFLICT(tg_hash) DO NOTHING
+{_SQL_RETURNING}
+"""
+
+
+async def consume_one_message(tg_hash: str) -> dict | None:
     """
-    Списывает 1 сообщение: сначала из дневного лимита, потом из bonus_messages.
-    Возвращает True, если удалось списать.
+    Атомарно списывает 1 сообщение: сначала из дневного лимита, потом из bonus_messages.
+    Заводит пользователя и делает просроченный суточный сброс сам — отдельный ensure_user() не нужен.
+    Возвращает новые счётчики {"daily_limit_remaining", "bonus_messages", "counter_reset_at"},
+    подписку {"subscription_tier", "subscription_until"} и "charged": "daily" | "bonus"
+    (откуда списали — туда и вернёт refund_one_message) или None, если списывать нечего.
     """
-    await ensure_user(tg_hash)
-    db = await open_db()
-    try:
-        cur = await db.execute(
-            "SELECT daily_limit_remaining, bonus_messages FROM users WHERE tg_hash=? LIMIT 1",
-            (tg_hash,),
-        )
-        row = await cur.fetchone()
-        await cur.close()
-        if not row:
-            return False
+    m = await get_quota_map()
+    paid_fallback, free_fallback = _fallback_limits(m)
+    now = int(time.time())
+    params = {
+        "tg_hash": tg_hash,
+        "now": now,
+        "reset_at": _next_midnight_ts(now),
+        "new_limit": free_fallback,  # = _compute_user_daily_limit("FREE", None)
+        "qmap": json.dumps(m),
+        "paid_fallback": paid_fallback,
+        "free_fallback": free_fallback,
+    }
+    row = None
+    async with write_db() as db:
+        for bucket, sql in (("daily", _SQL_CHARGE_DAILY), ("bonus", _SQL_CHARGE_BONUS), ("daily", _SQL_CHARGE_NEW)):
+            cur = await db.execute(sql, params)
+            row = await cur.fetchone()
+            await cur.close()
+            if row:
+                break
+    if not row:
+        return None
+    return {
+        "daily_limit_remaining": int(row[0] or 0),
+        "bonus_messages": int(row[1] or 0),
+        "counter_reset_at": int(row[2] or 0),
+        "subscription_tier": row[3] or "FREE",
+        "subscription_until": int(row[4]) if row[4] is not None else None,
+        "charged": bucket,
+    }
 
-        daily, bonus = int(row[0] or 0), int(row[1] or 0)
-        if daily > 0:
-            await db.execute(
-                "UPDATE users SET daily_limit_remaining=daily_limit_remaining-1 WHERE tg_hash=?",
-                (tg_hash,),
-            )
-            await db.commit()
-            return True
 
-        if bonus > 0:
-            await db.execute(
-                "UPDATE users SET bonus_messages=bonus_messages-1 WHERE tg_hash=?",
-                (tg_hash,),
-            )
-            await db.commit()
-            return True
-
-        return False
-    finally:
-        await db.close()
+async def refund_one_message(tg_hash: str, charged: str = "daily") -> None:
+    """
+    Возвращает сообщение, списанное consume_one_message (ответа не было), в тот же счётчик:
+    charged — поле "charged" из его результата. Бонус не должен превращаться в дневной слот.
+    """
+    column = "bonus_messages" if charged == "bonus" else "daily_limit_remaining"
+    async with write_db() as db:
+        await db.execute(
+            f"UPDATE users SET {column}={column}+1 WHERE tg_hash=?",
+            (tg_hash,),
+        )
 
 
 async def add_bonus_messages(tg_hash: str, amount: int) -> None:
@@ -171,15 +304,11 @@ async def add_bonus_messages(tg_hash: str, amount: int) -> None:
     if not amount or amount <= 0:
         return
     await ensure_user(tg_hash)
-    db = await open_db()
-    try:
+    async with write_db() as db:
         await db.execute(
             "UPDATE users SET bonus_messages=bonus_messages+? WHERE tg_hash=?",
             (int(amount), tg_hash),
         )
-        await db.commit()
-    finally:
-        await db.close()
 
 
 async def get_limits_snapshot(tg_hash: str) -> dict:
@@ -194,8 +323,7 @@ async def get_limits_snapshot(tg_hash: str) -> dict:
       }
     """
     await ensure_user(tg_hash)
-    db = await open_db()
-    try:
+    async with read_db() as db:
         cur = await db.execute(
             "SELECT daily_limit_remaining, bonus_messages, counter_reset_at, subscription_tier, subscription_until FROM users WHERE tg_hash=? LIMIT 1",
             (tg_hash,),
@@ -211,8 +339,6 @@ async def get_limits_snapshot(tg_hash: str) -> dict:
             "subscription_tier": (row[3] or "FREE"),
             "subscription_until": (row[4] if row[4] is not None else None),
         }
-    finally:
-        await db.close()
 
 
 # --- Утилиты для «быстрой регулировки» ---
@@ -223,38 +349,77 @@ async def set_user_tier(tg_hash: str, tier: str, subscription_until: Optional[in
     Следующий сброс пересчитает дневной лимит автоматически.
     """
     tier = (tier or "FREE").upper()
-    db = await open_db()
-    try:
+    async with write_db() as db:
         await db.execute(
             "UPDATE users SET subscription_tier=?, subscription_until=? WHERE tg_hash=?",
             (tier, subscription_until, tg_hash),
         )
-        await db.commit()
-    finally:
-        await db.close()
 
 
 async def force_reset_today_limit(tg_hash: str) -> None:
     """
     Принудительно «пересобирает» лимит сейчас (для админских нужд).
     """
-    db = await open_db()
-    try:
+    async with write_db() as db:
         cur = await db.execute(
-            "SELECT subscription_tier, subscription_until FROM users WHERE tg_hash=? LIMIT 1",
+            "SELECT subscription_tier, subscription_until, tz_name FROM users WHERE tg_hash=? LIMIT 1",
             (tg_hash,),
         )
         row = await cur.fetchone()
         await cur.close()
         if not row:
             return
-        tier, sub_until = row
+        tier, sub_until, tz_name = row
         limit = await _compute_user_daily_limit(tier, sub_until)
-        reset_at = _next_midnight_ts()
+        reset_at = _next_midnight_ts(tz_name=tz_name)
         await db.execute(
             "UPDATE users SET daily_limit_remaining=?, counter_reset_at=? WHERE tg_hash=?",
             (int(limit), int(reset_at), tg_hash),
         )
-        await db.commit()
-    finally:
-        await db.close()
+
+
+# --- Суточный сброс пачкой (планировщик) ---
+
+async def reset_due_limits(now_ts: int | None = None) -> int:
+    """
+    Сбрасывает дневной лимит всем, у кого наступила полночь (counter_reset_at <= now).
+    Пользователи группируются по tz_name: на каждый пояс — один UPDATE, лимит по тарифу
+    считается в SQL (_SQL_TIER_LIMIT). Каждый пояс — своя короткая транзакция,
+    чтобы не держать писателя долго. Возвращает число сброшенных пользователей.
+    """
+    now = int(now_ts or time.time())
+    m = await get_quota_map()
+    paid_fallback, free_fallback = _fallback_limits(m)
+
+    async with read_db() as db:
+        cur = await db.execute(
+            "SELECT DISTINCT COALESCE(tz_name, '') FROM users WHERE counter_reset_at <= ?", (now,)
+        )
+        buckets = [r[0] for r in await cur.fetchall()]
+        await cur.close()
+
+    total = 0
+    for tz_name in buckets:
+        params = {
+            "now": now,
+            "tz": tz_name,
+            "reset_at": _next_midnight_ts(now, tz_name or None),
+            "qmap": json.dumps(m),
+            "paid_fallback": paid_fallback,
+            "free_fallback": free_fallback,
+        }
+        async with write_db() as db:
+            cur = await db.execute(
+                f"""
+                UPDATE users
+                SET daily_limit_remaining = {_SQL_TIER_LIMIT},
+                    counter_reset_at = :reset_at
+                WHERE counter_reset_at <= :now AND COALESCE(tz_name, '') = :tz
+                """,
+                params,
+            )
+            total += int(cur.rowcount or 0)
+            await cur.close()
+    if total:
+        log.info("Суточный сброс лимитов: %d пользователей, поясов: %d", total, len(buckets))
+    return total
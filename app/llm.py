@@ -1,51 +1,727 @@
 # app/llm.py
 import asyncio
+import heapq
+import itertools
 import json
+import logging
+import os
+import random
 import re
-from typing import Any, Dict, List
+import time
+from collections import deque
+from contextlib import aclosing, asynccontextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Dict, List, Optional
 
 import aiohttp
 
 from .config import settings
-from .prompts import CLASSIFIER_PROMPT
+from .deadline import clamp as deadline_clamp, spawn_detached
+from .prompt_budget import estimate_message, estimate_tokens
+from .telemetry import record_llm_call
+from .prompts import CLASSIFIER_PROMPT, CLASSIFIER_BATCH_SUFFIX
+from .classify_cache import ClassifyCache, classifier_version
+from .premod import PreModerator
+from .microbatch import MicroBatcher
+
+log = logging.getLogger(__name__)
 
 API_URL = "https://api.deepseek.com/chat/completions"
 
 
-async def _post(payload: Dict[str, Any]) -> str:
+class LLMClient:
     """
-    Безопасный POST с ретраями и тайм-аутом.
-    Возвращает content первой choice.
+    HTTP-клиент к OpenAI-совместимому API (по умолчанию DeepSeek) с одной
+    долгоживущей aiohttp-сессией: TCP/TLS-соединения переиспользуются
+    (keep-alive), DNS кэшируется. Создаётся при старте бота (init_llm),
+    закрывается при остановке (close_llm).
     """
-    headers = {
-        "Authorization": f"Bearer {settings.deepseek_api_key}",
-        "Content-Type": "application/json",
-    }
-    # 3 попытки с простым backoff
-    for attempt in range(3):
+
+    def __init__(
+        self,
+        api_url: str = API_URL,
+        *,
+        api_key: Optional[str] = None,
+        pool_size: int = 32,
+        keepalive_sec: float = 30.0,
+        dns_ttl_sec: int = 300,
+        timeout_sec: float = 30.0,
+    ):
+        self.api_url = api_url
+        self._api_key = settings.deepseek_api_key if api_key is None else api_key
+        self._pool_size = max(1, int(pool_size))
+        self._keepalive = float(keepalive_sec)
+        self._dns_ttl = int(dns_ttl_sec)
+        self._timeout = aiohttp.ClientTimeout(total=float(timeout_sec))
+        self._session: aiohttp.ClientSession | None = None
+
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self._api_key}",
+            "Content-Type": "application/json",
+        }
+
+    async def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self._pool_size,
+            limit_per_host=self._pool_size,
+            ttl_dns_cache=self._dns_ttl,
+            keepalive_timeout=self._keepalive,
+            enable_cleanup_closed=True,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=self._timeout,
+            headers=self._headers(),
+        )
+
+    async def close(self) -> None:
+        session, self._session = self._session, None
+        if session is not None and not session.closed:
+            await session.close()
+
+    async def session(self) -> aiohttp.ClientSession:
+        # страховка для скриптов, где init_llm() не вызывали
+        if self._session is None or self._session.closed:
+            await self.start()
+        return self._session
+
+    async def post_json(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        s = await self.session()
+        async with s.post(self.api_url, json=payload) as r:
+            r.raise_for_status()
+            return await r.json()
+
+    async def stream_json(self, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """SSE (`stream: true`): отдаёт JSON-чанки по мере прихода, до `data: [DONE]`."""
+        s = await self.session()
+        async with s.post(self.api_url, json={**payload, "stream": True}) as r:
+            r.raise_for_status()
+            async for raw in r.content:
+                line = raw.decode("utf-8", errors="ignore").strip()
+                if not line.startswith("data:"):
+                    continue  # пустые строки-разделители и keep-alive комментарии
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    yield json.loads(data)
+                except ValueError:
+                    continue
+
+
+class LLMUnavailable(RuntimeError):
+    """LLM сейчас не ответит: провайдеры лежат (circuit breaker открыт) или вышел бюджет времени."""
+
+
+class LLMBusy(LLMUnavailable):
+    """Очередь к LLM переполнена — запрос отклонён сразу, без ожидания."""
+
+
+# HTTP-статусы, которые имеет смысл повторить; остальные 4xx не исправятся от повтора
+_RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class RetryPolicy:
+    """
+    Какие ошибки повторять и сколько ждать: экспоненциальная пауза с джиттером,
+    а если провайдер прислал Retry-After — ждём столько, сколько он просит.
+    """
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0):
+        self.attempts = max(1, int(attempts))
+        self.base_delay = max(0.0, float(base_delay))
+        self.max_delay = max(self.base_delay, float(max_delay))
+
+    def is_retryable(self, exc: BaseException) -> bool:
+        if isinstance(exc, aiohttp.ClientResponseError):
+            return exc.status in _RETRYABLE_STATUS
+        return isinstance(exc, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+    @staticmethod
+    def retry_after(exc: BaseException) -> Optional[float]:
+        headers = getattr(exc, "headers", None) or {}
+        value = headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
         try:
-            timeout = aiohttp.ClientTimeout(total=30)
-            async with aiohttp.ClientSession(timeout=timeout) as s:
-                async with s.post(API_URL, headers=headers, json=payload) as r:
-                    r.raise_for_status()
-                    data = await r.json()
-                    return data["choices"][0]["message"]["content"]
-        except Exception:
-            if attempt == 2:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt: int, exc: BaseException) -> float:
+        """Пауза перед попыткой attempt+1 (attempt — сколько уже сделано, с 1)."""
+        ra = self.retry_after(exc)
+        if ra is not None:
+            return ra
+        cap = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return cap / 2 + random.uniform(0, cap / 2)
+
+
+class CircuitBreaker:
+    """
+    После failure_threshold сбоев провайдера подряд перестаём к нему ходить
+    на reset_sec (вызовы сразу получают LLMUnavailable). Затем пропускаем
+    одну пробу: успех — закрываемся, сбой — снова открываемся.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_sec: float = 30.0):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_sec = float(reset_sec)
+        self.state = "closed"  # closed | open | half_open
+        self._failures = 0
+        self._opened_at = 0.0
+
+    def available(self) -> bool:
+        """Пустит ли allow() запрос сейчас — без побочных эффектов (для выбора и прогнозов)."""
+        return self.state == "closed" or time.monotonic() - self._opened_at >= self.reset_sec
+
+    def allow(self) -> bool:
+        if not self.available():
+            return False
+        if self.state != "closed":
+            # одна проба на reset_sec: пока она в полёте, остальные получают отказ
+            self.state = "half_open"
+            self._opened_at = time.monotonic()
+        return True
+
+    def success(self) -> None:
+        self.state = "closed"
+        self._failures = 0
+
+    def failure(self) -> None:
+        self._failures += 1
+        if self.state == "half_open" or self._failures >= self.failure_threshold:
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+
+class ProviderHealth:
+    """Скользящее окно последних вызовов провайдера: p95 задержки удачных и доля ошибок."""
+
+    MIN_SAMPLES = 5  # пока выборка меньше — p95 считаем нулевым, чтобы провайдер её набрал
+    ERROR_PENALTY_SEC = 10.0  # цена одной доли ошибок в секундах: ошибки видны и на малой выборке
+
+    def __init__(self, window_sec: float = 300.0, max_samples: int = 200):
+        self.window = float(window_sec)
+        self._samples: deque = deque(maxlen=max(self.MIN_SAMPLES, int(max_samples)))  # (ts, latency, ok)
+
+    def add(self, latency_sec: float, ok: bool) -> None:
+        self._samples.append((time.monotonic(), float(latency_sec), bool(ok)))
+
+    def _recent(self) -> List[tuple]:
+        cutoff = time.monotonic() - self.window
+        return [x for x in self._samples if x[0] >= cutoff]
+
+    @staticmethod
+    def _p95(recent: List[tuple]) -> float:
+        lat = sorted(x[1] for x in recent if x[2]) or sorted(x[1] for x in recent)
+        return lat[min(len(lat) - 1, int(len(lat) * 0.95))] if lat else 0.0
+
+    def score(self) -> float:
+        """Меньше — лучше: p95, штрафованный долей ошибок. Старые замеры выпадают из окна,
+        поэтому медленный провайдер через window_sec снова получит пробные запросы.
+
+        На малой выборке доля ошибок считается от MIN_SAMPLES: одна ошибка у нового
+        провайдера уже отодвигает его за здоровых, но не хоронит его совсем."""
+        recent = self._recent()
+        errors = sum(1 for x in recent if not x[2])
+        err = errors / max(len(recent), self.MIN_SAMPLES)
+        p95 = self._p95(recent) if len(recent) >= self.MIN_SAMPLES else 0.0
+        return p95 / max(0.05, 1.0 - err) + err * self.ERROR_PENALTY_SEC
+
+    def snapshot(self) -> Dict[str, Any]:
+        recent = self._recent()
+        return {
+            "samples": len(recent),
+            "p95_ms": int(self._p95(recent) * 1000),
+            "error_rate": (sum(1 for x in recent if not x[2]) / len(recent)) if recent else 0.0,
+        }
+
+
+class Provider:
+    """Один OpenAI-совместимый endpoint: свой HTTP-пул, свой breaker и своя статистика."""
+
+    def __init__(self, name: str, url: str, api_key: str, models: Dict[str, str], routes: Optional[List[str]] = None):
+        self.name = name
+        self.models = dict(models)
+        self.routes = set(routes) if routes else None  # None — обслуживает все маршруты
+        self.client = LLMClient(
+            url,
+            api_key=api_key,
+            pool_size=settings.llm_pool_size,
+            keepalive_sec=settings.llm_keepalive_sec,
+            dns_ttl_sec=settings.llm_dns_ttl_sec,
+            timeout_sec=settings.llm_timeout_sec,
+        )
+        self.breaker = CircuitBreaker(settings.llm_breaker_failures, settings.llm_breaker_reset_sec)
+        self.health = ProviderHealth(settings.llm_health_window_sec)
+
+    def serves(self, route: str) -> bool:
+        return self.routes is None or route in self.routes
+
+    def model_for(self, route: str) -> str:
+        return self.models.get(route) or self.models.get("chat") or settings.deepseek_model
+
+    def success(self, latency_sec: float) -> None:
+        self.breaker.success()
+        self.health.add(latency_sec, True)
+
+    def failure(self, exc: BaseException, latency_sec: float) -> None:
+        """Сбой провайдера (то, что повторяем) — в breaker; осмысленный отказ — значит, провайдер жив."""
+        if _retry.is_retryable(exc):
+            self.breaker.failure()
+            self.health.add(latency_sec, False)
+        else:
+            self.breaker.success()
+
+
+class ProviderRegistry:
+    """
+    Маршрутизация по провайдерам: для маршрута ("chat", "classify", …) берём
+    того, у кого лучше score (p95 и ошибки), пропуская открытые breaker'ы
+    и уже упавших в этом вызове.
+    """
+
+    def __init__(self, providers: List[Provider]):
+        if not providers:
+            raise ValueError("no LLM providers configured")
+        self.providers = providers
+
+    def candidates(self, route: str) -> List[Provider]:
+        serving = [p for p in self.providers if p.serves(route)] or self.providers
+        # sorted стабилен: при равном score — порядок из конфига
+        return sorted(serving, key=lambda p: p.health.score())
+
+    def pick(
+        self, route: str, exclude: Optional[List[Provider]] = None, allow_repeat: bool = True,
+    ) -> Optional[Provider]:
+        cands = self.candidates(route)
+        fresh = [p for p in cands if p not in (exclude or [])]
+        if not fresh and allow_repeat:
+            # все уже пробовали — разрешаем повтор у лучшего
+            fresh = cands
+        # allow() переводит открытый breaker в half_open — зовём его только у того, к кому пойдём
+        for p in fresh:
+            if p.breaker.available() and p.breaker.allow():
+                return p
+        return None
+
+    def has_alternative(self, route: str, exclude: List[Provider]) -> bool:
+        return any(p not in exclude and p.breaker.available() for p in self.candidates(route))
+
+    async def start(self) -> None:
+        for p in self.providers:
+            await p.client.start()
+
+    async def close(self) -> None:
+        for p in self.providers:
+            await p.client.close()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [
+            {"name": p.name, "breaker": p.breaker.state, **p.health.snapshot()}
+            for p in self.providers
+        ]
+
+
+def _build_providers() -> List[Provider]:
+    out: List[Provider] = []
+    for i, spec in enumerate(settings.llm_providers):
+        url = spec.get("url")
+        models = spec.get("models") or {}
+        if not url or not isinstance(models, dict):
+            log.warning("LLM_PROVIDERS[%d]: нет url или models — пропускаем", i)
+            continue
+        key = spec.get("api_key") or os.getenv(spec.get("api_key_env") or "", "")
+        out.append(Provider(str(spec.get("name") or f"p{i}"), url, key, models, spec.get("routes")))
+    if not out:
+        out.append(Provider(
+            "deepseek", API_URL, settings.deepseek_api_key,
+            {"chat": settings.deepseek_model, "classify": settings.deepseek_classify_model},
+        ))
+    return out
+
+
+# Приоритет в очереди к LLM: меньше — раньше
+PRIORITY_PAID = 0
+PRIORITY_FREE = 1
+
+
+class LLMGovernor:
+    """
+    Ограничитель одновременных запросов к LLM: в работе не больше limit,
+    остальные ждут в очереди по приоритету (при равном — по порядку прихода).
+    Очередь ограничена max_queue: сверх неё — сразу LLMBusy, но запрос с
+    лучшим приоритетом вытесняет самого позднего из худшего класса.
+    """
+
+    def __init__(self, limit: int, max_queue: int):
+        self.limit = max(1, int(limit))
+        self.max_queue = max(0, int(max_queue))
+        self._active = 0
+        # (priority, seq, future); отменённые/вытесненные выбрасываются лениво в release()
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        self._waiting = 0  # живые ожидающие в _heap
+        self._waits: deque = deque(maxlen=512)  # последние времена ожидания, сек
+
+        self.admitted = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    def _free_slot(self) -> bool:
+        return self._active < self.limit and self._waiting == 0
+
+    def _victim(self, priority: int) -> Optional[tuple]:
+        """Самый поздний ожидающий с приоритетом хуже priority (его и вытесняем)."""
+        worst = max((e for e in self._heap if not e[2].done()), default=None, key=lambda e: (e[0], e[1]))
+        if worst is None or worst[0] <= priority:
+            return None
+        return worst
+
+    def would_reject(self, priority: int) -> bool:
+        if self._free_slot() or self._waiting < self.max_queue:
+            return False
+        return self._victim(priority) is None
+
+    async def acquire(self, priority: int) -> None:
+        if self._free_slot():
+            self._active += 1
+            self.admitted += 1
+            self._waits.append(0.0)
+            return
+        if self._waiting >= self.max_queue:
+            victim = self._victim(priority)
+            if victim is None:
+                self.rejected += 1
+                raise LLMBusy("LLM queue is full")
+            victim[2].set_exception(LLMBusy("LLM queue is full (evicted)"))
+            self._waiting -= 1
+            self.evicted += 1
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (int(priority), next(self._seq), fut))
+        self._waiting += 1
+        t0 = time.monotonic()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.cancelled():
+                self._waiting -= 1
+            elif fut.exception() is None:
+                # слот уже передали нам, а нас отменили — отдаём следующему
+                self.release()
+            raise
+        self.admitted += 1
+        self._waits.append(time.monotonic() - t0)
+
+    def release(self) -> None:
+        while self._heap:
+            _, _, fut = heapq.heappop(self._heap)
+            if fut.done():
+                continue
+            self._waiting -= 1
+            fut.set_result(None)  # слот переходит ожидающему, _active не меняется
+            return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+        return {
+            "active": self._active,
+            "limit": self.limit,
+            "queued": self._waiting,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "evicted": self.evicted,
+            "wait_avg_ms": int(sum(waits) / len(waits) * 1000) if waits else 0,
+            "wait_p95_ms": int(p95 * 1000),
+            "wait_max_ms": int(waits[-1] * 1000) if waits else 0,
+        }
+
+
+_governor = LLMGovernor(settings.llm_max_concurrency, settings.llm_max_queue)
+_retry = RetryPolicy(settings.llm_retry_attempts, settings.llm_retry_base_sec, settings.llm_retry_max_sec)
+
+# Приоритет текущего апдейта (ставит хендлер; у каждого апдейта aiogram своя задача и свой контекст)
+_priority: ContextVar[int] = ContextVar("llm_priority", default=PRIORITY_FREE)
+
+
+# Место вызова для телеметрии, если chat(..., site=...) не указан
+_site: ContextVar[str] = ContextVar("llm_site", default="other")
+
+
+def _tier() -> str:
+    return "paid" if _priority.get() == PRIORITY_PAID else "free"
+
+
+def priority_for(subscription_tier: Optional[str], subscription_until: Optional[int], now: Optional[int] = None) -> int:
+    """Платный — активная подписка (until > now) или выданный без срока не-FREE tier."""
+    now = int(time.time()) if now is None else int(now)
+    if subscription_until:
+        return PRIORITY_PAID if int(subscription_until) > now else PRIORITY_FREE
+    return PRIORITY_FREE if (subscription_tier or "FREE").upper() == "FREE" else PRIORITY_PAID
+
+
+def set_llm_priority(priority: int) -> None:
+    """Приоритет для всех LLM-вызовов текущего апдейта."""
+    _priority.set(int(priority))
+
+
+def llm_would_reject() -> bool:
+    """Быстрая проверка до списания лимита: получит ли запрос текущего приоритета LLMBusy."""
+    return _governor.would_reject(_priority.get())
+
+
+_registry = ProviderRegistry(_build_providers())
+
+
+def llm_queue_stats() -> Dict[str, Any]:
+    providers = _registry.stats()
+    return {
+        **_governor.stats(),
+        "breaker": ", ".join(f"{p['name']}: {p['breaker']}" for p in providers),
+        "providers": providers,
+    }
+
+
+async def init_llm() -> None:
+    """Открывает HTTP-сессии провайдеров (вызывать при старте бота)."""
+    await _registry.start()
+
+
+async def close_llm() -> None:
+    """Закрывает HTTP-сессии провайдеров (вызывать при остановке бота)."""
+    await _registry.close()
+
+
+def _log_usage(usage: Optional[Dict[str, Any]]) -> None:
+    """prompt_cache_hit_tokens — сколько токенов промпта DeepSeek взял из кэша префиксов."""
+    if not usage:
+        return
+    log.debug(
+        "llm usage: prompt=%s cache_hit=%s cache_miss=%s completion=%s",
+        usage.get("prompt_tokens"), usage.get("prompt_cache_hit_tokens"),
+        usage.get("prompt_cache_miss_tokens"), usage.get("completion_tokens"),
+    )
+
+
+# Тайм-аут попытки считается сбоем провайдера, только если ему дали хотя бы столько времени
+_FAIR_WINDOW_SEC = min(settings.llm_timeout_sec, settings.llm_call_budget_sec) / 2
+
+
+@asynccontextmanager
+async def _slot(deadline: float):
+    """Слот у LLMGovernor, но ждём его не дольше, чем до deadline."""
+    try:
+        await asyncio.wait_for(_governor.acquire(_priority.get()), max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        raise LLMUnavailable("LLM deadline exceeded while queued") from None
+    try:
+        yield
+    finally:
+        _governor.release()
+
+
+async def _post(payload: Dict[str, Any], site: str, route: str) -> str:
+    """
+    POST с ретраями по RetryPolicy. Каждую попытку отправляем лучшему по
+    p95/ошибкам провайдеру маршрута route; после сбоя следующая попытка
+    сразу идёт к другому провайдеру (без паузы), если он есть.
+    Весь вызов (очередь, попытки и паузы) укладывается в LLM_CALL_BUDGET_SEC
+    и в остаток бюджета апдейта (app/deadline.py). Когда время вышло, ретраи
+    кончились, ошибка не ретраится или все провайдеры недоступны — LLMUnavailable
+    (исходная ошибка — в __cause__). Возвращает content первой choice.
+    Попытка, которую оборвал наш собственный бюджет, провайдеру в сбой не пишется.
+    В телеметрию уходят usage, задержка HTTP удачной попытки и число ретраев.
+    """
+    started = time.monotonic()
+    deadline = started + deadline_clamp(settings.llm_call_budget_sec)
+    attempt = 0
+    tried: List[Provider] = []
+    model = ""
+    try:
+        while True:
+            if time.monotonic() >= deadline:
+                raise LLMUnavailable("LLM deadline exceeded")
+            provider = _registry.pick(route, exclude=tried)
+            if provider is None:
+                raise LLMUnavailable("all LLM providers are unavailable (circuit open)")
+            attempt += 1
+            model = f"{provider.name}/{provider.model_for(route)}"
+            t0 = time.monotonic()
+            window = 0.0
+            try:
+                # слот берём на каждую попытку, чтобы паузы между ними не держали очередь
+                async with _slot(deadline):
+                    t0 = time.monotonic()
+                    window = max(0.0, deadline - t0)
+                    data = await asyncio.wait_for(
+                        provider.client.post_json({**payload, "model": provider.model_for(route)}),
+                        window,
+                    )
+                    http_sec = time.monotonic() - t0
+                content = data["choices"][0]["message"]["content"]
+            except LLMUnavailable:
                 raise
-            await asyncio.sleep(1.5 * (attempt + 1))
-    # теоретически недостижимо
-    raise RuntimeError("DeepSeek API failed")
+            except Exception as e:
+                elapsed = time.monotonic() - t0
+                if isinstance(e, asyncio.TimeoutError) and elapsed >= window - 0.01 and window < _FAIR_WINDOW_SEC:
+                    # оборвали мы сами (короткий остаток бюджета апдейта/вызова), а не провайдер
+                    # не ответил: в breaker и p95 не пишем, иначе короткие бюджеты открывают breaker всем
+                    raise LLMUnavailable("LLM deadline exceeded") from e
+                provider.failure(e, elapsed)
+                tried.append(provider)
+                if not _retry.is_retryable(e) or attempt >= _retry.attempts:
+                    raise LLMUnavailable(f"LLM request failed: {e!r}") from e
+                pause = 0.0 if _registry.has_alternative(route, tried) else _retry.delay(attempt, e)
+                if time.monotonic() + pause >= deadline:
+                    raise LLMUnavailable("LLM deadline exceeded") from e
+                if pause:
+                    await asyncio.sleep(pause)
+                continue
+            provider.success(http_sec)
+            _log_usage(data.get("usage"))
+            record_llm_call(
+                site=site, tier=_tier(), model=model, latency_sec=http_sec,
+                usage=data.get("usage"), retries=attempt - 1,
+            )
+            return content
+    except Exception:
+        record_llm_call(
+            site=site, tier=_tier(), model=model, latency_sec=time.monotonic() - started,
+            retries=max(0, attempt - 1), ok=False,
+        )
+        raise
 
 
-async def chat(messages: List[Dict[str, str]], max_tokens: int = 120, temperature: float = 0.65) -> str:
+async def chat(
+    messages: List[Dict[str, str]],
+    max_tokens: int = 120,
+    temperature: float = 0.65,
+    *,
+    site: Optional[str] = None,
+    route: str = "chat",
+) -> str:
+    """route — маршрут провайдеров/моделей ("chat", "classify"; см. LLM_PROVIDERS)."""
     payload = {
-        "model": settings.deepseek_model,
         "messages": messages,
         "max_tokens": max_tokens,
         "temperature": temperature,
     }
-    return await _post(payload)
+    return await _post(payload, site or _site.get(), route)
+
+
+async def chat_stream(
+    messages: List[Dict[str, str]],
+    max_tokens: int = 120,
+    temperature: float = 0.65,
+    *,
+    site: Optional[str] = None,
+    route: str = "chat",
+) -> AsyncIterator[str]:
+    """
+    Потоковая генерация: отдаёт кусочки текста (delta.content) по мере прихода.
+    Если соединение или первый кусок не удались — сразу пробуем следующего
+    провайдера (как у chat(), по p95/ошибкам); не осталось ни одного — LLMUnavailable.
+    После первого куска ретраев нет — если поток оборвался, вызывающий решает сам
+    (см. dialog._stream_reply).
+    Прервать генерацию можно, просто закрыв генератор (aclose / выход из async for).
+    Бюджет на очередь и попытки — как у chat().
+    В телеметрию задержкой идёт время до первого куска; если поток закрыли
+    раньше, чем пришёл usage, токены оцениваются локально (prompt_budget).
+    """
+    site = site or _site.get()
+    deadline = time.monotonic() + deadline_clamp(settings.llm_call_budget_sec)
+    tried: List[Provider] = []
+    last_exc: Optional[Exception] = None
+    model = ""
+    started = False
+    t0 = time.monotonic()
+    ttft = 0.0
+    usage: Optional[Dict[str, Any]] = None
+    text: List[str] = []
+    ok = False
+    try:
+        async with _slot(deadline):
+            while True:
+                provider = _registry.pick(route, exclude=tried, allow_repeat=False)
+                if provider is None:
+                    if last_exc is not None:
+                        raise LLMUnavailable(f"LLM stream failed: {last_exc!r}") from last_exc
+                    raise LLMUnavailable("all LLM providers are unavailable (circuit open)")
+                payload = {
+                    "model": provider.model_for(route),
+                    "messages": messages,
+                    "max_tokens": max_tokens,
+                    "temperature": temperature,
+                    # usage придёт последним чанком (если поток не закрыли раньше)
+                    "stream_options": {"include_usage": True},
+                }
+                model = f"{provider.name}/{payload['model']}"
+                t0 = time.monotonic()
+                try:
+                    # aclosing: при досрочном выходе закрываем и HTTP-ответ — сервер перестаёт генерировать
+                    async with aclosing(provider.client.stream_json(payload)) as chunks:
+                        async for chunk in chunks:
+                            if not started:
+                                started = True
+                                ttft = time.monotonic() - t0
+                                provider.success(ttft)
+                            if chunk.get("usage"):
+                                usage = chunk["usage"]
+                                _log_usage(usage)
+                            try:
+                                delta = chunk["choices"][0].get("delta") or {}
+                            except (KeyError, IndexError, AttributeError):
+                                continue
+                            piece = delta.get("content")
+                            if piece:
+                                text.append(piece)
+                                yield piece
+                except Exception as e:
+                    if started:
+                        raise
+                    # соединение или первый кусок не пришли — пользователь ещё ничего не видел,
+                    # можно без паузы перейти к следующему провайдеру
+                    provider.failure(e, time.monotonic() - t0)
+                    tried.append(provider)
+                    last_exc = e
+                    if time.monotonic() >= deadline:
+                        raise LLMUnavailable("LLM deadline exceeded") from e
+                    log.warning("LLM stream via %s failed before first chunk: %r", provider.name, e)
+                    continue
+                break
+        ok = True
+    finally:
+        if usage is None and started:
+            usage = {
+                "prompt_tokens": sum(estimate_message(m) for m in messages),
+                "completion_tokens": estimate_tokens("".join(text)),
+            }
+        record_llm_call(
+            site=site, tier=_tier(), model=model,
+            latency_sec=ttft if started else time.monotonic() - t0, usage=usage, ok=ok or started,
+            retries=len(tried) if started else max(0, len(tried) - 1),
+        )
 
 
 def _safe_json_extract(text: str) -> str:
@@ -54,26 +730,154 @@ def _safe_json_extract(text: str) -> str:
     return m.group(0) if m else text
 
 
+CLASSIFY_LABELS = ("crisis", "illegal", "unsafe", "boundaries", "pro_advice", "romance", "normal")
+
+_classify_cache = ClassifyCache(
+    classifier_version(CLASSIFIER_PROMPT, CLASSIFY_LABELS),
+    settings.classify_cache_max,
+    settings.classify_cache_ttl_sec,
+    settings.classify_cache_sqlite,
+)
+# один запрос к LLM на одинаковый текст, пришедший одновременно
+_classify_inflight: Dict[str, asyncio.Future] = {}
+
+
+def _classify_result(obj: Any) -> Dict[str, Any]:
+    if not isinstance(obj, dict):
+        raise ValueError(f"classifier item is not an object: {obj!r}")
+    label = str(obj.get("label", "normal")).lower().strip()
+    if label not in CLASSIFY_LABELS:
+        label = "normal"
+    return {"label": label, "confidence": float(obj.get("confidence") or 0.0)}
+
+
+async def _classify_llm(text: str) -> Dict[str, Any]:
+    messages = [
+        {"role": "system", "content": CLASSIFIER_PROMPT.strip()},
+        {"role": "user", "content": text},
+    ]
+    raw = await chat(messages, max_tokens=120, temperature=0, site="classify", route="classify")
+    js = _safe_json_extract(raw)
+    return _classify_result(json.loads(js))
+
+
+async def _classify_one(item: tuple) -> Dict[str, Any]:
+    text, priority = item
+    _priority.set(priority)
+    return await _classify_llm(text)
+
+
+async def _classify_many(items: List[tuple]) -> List[Dict[str, Any]]:
+    """Одна пачка — один запрос: системный промпт платится один раз. ValueError — ответ не разобрался."""
+    # пачка идёт с лучшим приоритетом из собранных: платный не ждёт за бесплатными
+    _priority.set(min(p for _, p in items))
+    texts = [t for t, _ in items]
+    messages = [
+        {"role": "system", "content": CLASSIFIER_PROMPT.strip() + "\n" + CLASSIFIER_BATCH_SUFFIX.strip()},
+        {"role": "user", "content": json.dumps(texts, ensure_ascii=False)},
+    ]
+    raw = await chat(messages, max_tokens=30 * len(texts) + 20, temperature=0, site="classify_batch", route="classify")
+    m = re.search(r"\[.*\]", raw, re.S)
+    arr = json.loads(m.group(0) if m else raw)
+    if not isinstance(arr, list):
+        raise ValueError("classifier batch reply is not a JSON array")
+    return [_classify_result(o) for o in arr]
+
+
+_classify_batcher = MicroBatcher(
+    _classify_many, _classify_one, settings.classify_batch_max, settings.classify_batch_wait_ms / 1000
+)
+
+
+_premod = PreModerator()
+# фоновые перепроверки локальных решений (держим ссылки, чтобы задачи не собрал GC)
+_premod_shadow: set = set()
+
+
 async def classify(text: str) -> Dict[str, Any]:
     """
     Возвращает dict вида {'label': '...', 'confidence': 0.xx}.
-    При ошибке — label='normal' (fail-open).
+    Сначала локальная пре-модерация (PREMOD_MODE): очевидные случаи без LLM.
+    При ошибке — label='normal' (fail-open); такие ответы не кэшируются.
+    Повторы (с точностью до регистра и пробелов) берутся из кэша меток.
     """
-    messages = [
-        {"role": "system", "content": CLASSIFIER_PROMPT.strip()},
-        {"role": "user", "content": text.strip()[:1000]},
-    ]
+    text = text.strip()[:1000]
+    if settings.premod_mode in ("assist", "local"):
+        verdict = _premod.check(text)
+        local = verdict.label
+        if local is None and settings.premod_mode == "local" and not verdict.scores:
+            local = "normal"
+        if local is not None:
+            if random.random() < settings.premod_shadow_rate:
+                # перепроверка фоновая: без дедлайна апдейта и с приоритетом по умолчанию
+                task = spawn_detached(_premod_recheck(text, local))
+                _premod_shadow.add(task)
+                task.add_done_callback(_premod_shadow.discard)
+            return {"label": local, "confidence": verdict.confidence if verdict.label else 0.5}
+        res = await _classify_cached(text)
+        if res is not None:
+            _premod.compare(None, res["label"])
+            return res
+        return {"label": "normal", "confidence": 0.0}
+    res = await _classify_cached(text)
+    return res if res is not None else {"label": "normal", "confidence": 0.0}
+
+
+async def _premod_recheck(text: str, local: str) -> None:
+    res = await _classify_cached(text)
+    if res is not None:
+        _premod.compare(local, res["label"])
+
+
+async def _classify_cached(text: str) -> Optional[Dict[str, Any]]:
+    """Метка от LLM (через кэш и склейку одинаковых запросов); None — LLM недоступен."""
+    key = _classify_cache.key(text)
     try:
-        raw = await chat(messages, max_tokens=120, temperature=0)
-        js = _safe_json_extract(raw)
-        obj = json.loads(js)
-        label = str(obj.get("label", "normal")).lower().strip()
-        valid = {"crisis", "illegal", "unsafe", "boundaries", "pro_advice", "romance", "normal"}
-        if label not in valid:
-            label = "normal"
-        return {"label": label, "confidence": float(obj.get("confidence", 0.0))}
+        hit = await _classify_cache.get(key)
     except Exception:
-        return {"label": "normal", "confidence": 0.0}
+        log.warning("classify cache read failed", exc_info=True)
+        hit = None
+    if hit is not None:
+        return {"label": hit[0], "confidence": hit[1]}
+
+    fut = _classify_inflight.get(key)
+    if fut is not None:
+        res = await asyncio.shield(fut)
+        return dict(res) if res else None
+
+    fut = asyncio.get_running_loop().create_future()
+    _classify_inflight[key] = fut
+    res = None
+    try:
+        if _classify_batcher.max_items > 1:
+            res = await _classify_batcher.submit((text, _priority.get()))
+        else:
+            res = await _classify_llm(text)
+    except Exception:
+        pass
+    finally:
+        _classify_inflight.pop(key, None)
+        if not fut.done():
+            fut.set_result(res)
+    if res is None:
+        return None
+    try:
+        await _classify_cache.put(key, res["label"], res["confidence"])
+    except Exception:
+        log.warning("classify cache write failed", exc_info=True)
+    return res
+
+
+def classify_cache_stats() -> Dict[str, Any]:
+    return {**_classify_cache.stats(), "version": _classify_cache.version, "batch": _classify_batcher.stats()}
+
+
+def premod_stats() -> Dict[str, Any]:
+    return {**_premod.stats(), "mode": settings.premod_mode}
+
+
+async def prune_classify_cache() -> int:
+    return await _classify_cache.prune()
 
 
 # --- Удобная обёртка для канал-модуля (и вообще) ---
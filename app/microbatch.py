@@ -0,0 +1,111 @@
+# app/microbatch.py
+"""
+Микро-батчинг асинхронных вызовов: submit() копит входы не дольше max_wait
+секунд или до max_items штук и отдаёт их одним вызовом batch_fn; каждый
+вызывающий получает свой результат.
+
+Если batch_fn не смогла разобрать ответ (ValueError, в т.ч. json.JSONDecodeError),
+пачка переигрывается поштучно через single_fn. Прочие ошибки (например,
+LLM недоступен) достаются всем ждущим — поштучный повтор только умножил бы нагрузку.
+
+Пачка общая для нескольких апдейтов, поэтому идёт в чистом контексте
+(deadline.spawn_detached) с самым поздним дедлайном из собранных: кто-то из
+ждущих ещё готов ждать, а ушедшие раньше просто отменят своё ожидание.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .deadline import deadline_at, spawn_detached
+
+log = logging.getLogger(__name__)
+
+BatchFn = Callable[[List[Any]], Awaitable[List[Any]]]
+SingleFn = Callable[[Any], Awaitable[Any]]
+
+
+class MicroBatcher:
+    def __init__(self, batch_fn: BatchFn, single_fn: SingleFn, max_items: int, max_wait_sec: float):
+        self._batch_fn = batch_fn
+        self._single_fn = single_fn
+        self.max_items = max(1, int(max_items))
+        self.max_wait = max(0.0, float(max_wait_sec))
+        self._pending: List[Tuple[Any, asyncio.Future, Optional[float]]] = []  # (вход, future, дедлайн)
+        self._timer: Optional[asyncio.Task] = None
+        self._tasks: set = set()
+
+        self.batches = 0
+        self.items = 0
+        self.singles = 0      # пачка из одного входа — обычный вызов
+        self.fallbacks = 0    # ответ пачки не разобрался — повтор поштучно
+
+    async def submit(self, item: Any) -> Any:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((item, fut, deadline_at()))
+        if len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = spawn_detached(self._flush_later())
+        return await fut
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.max_wait)
+        self._timer = None
+        self._flush()
+
+    def _flush(self) -> None:
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            # пачка живёт в своей задаче: отмена одного ждущего её не прерывает
+            deadlines = [d for _, _, d in batch]
+            deadline = None if None in deadlines else max(deadlines)
+            task = spawn_detached(self._run(batch), deadline)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future, Optional[float]]]) -> None:
+        items = [it for it, _, _ in batch]
+        futs = [f for _, f, _ in batch]
+        try:
+            if len(items) == 1:
+                self.singles += 1
+                results = [await self._single_fn(items[0])]
+            else:
+                self.batches += 1
+                self.items += len(items)
+                try:
+                    results = await self._batch_fn(items)
+                    if len(results) != len(items):
+                        raise ValueError(f"batch returned {len(results)} results for {len(items)} items")
+                except ValueError:
+                    log.warning("micro-batch of %d unparsable, falling back to single calls", len(items), exc_info=True)
+                    self.fallbacks += 1
+                    results = await asyncio.gather(*(self._single_fn(it) for it in items), return_exceptions=True)
+        except BaseException as e:
+            for f in futs:
+                if not f.done():
+                    f.set_exception(e if isinstance(e, Exception) else asyncio.CancelledError())
+            if not isinstance(e, Exception):
+                raise
+            return
+        for f, r in zip(futs, results):
+            if f.done():
+                continue
+            if isinstance(r, BaseException):
+                f.set_exception(r)
+            else:
+                f.set_result(r)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "batched_items": self.items,
+            "singles": self.singles,
+            "fallbacks": self.fallbacks,
+            "avg_batch": (self.items / self.batches) if self.batches else 0.0,
+        }
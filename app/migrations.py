@@ -0,0 +1,298 @@
+# app/migrations.py
+"""
+Версионированные миграции схемы БД.
+
+Номер последнего применённого шага хранится в PRAGMA user_version.
+Миграции прогоняет init_db() один раз при старте процесса; остальные
+соединения только сверяют номер версии.
+
+Правило: новые шаги добавляем В КОНЕЦ списка MIGRATIONS, уже выпущенные не правим.
+"""
+from __future__ import annotations
+
+import logging
+import sqlite3
+from typing import Awaitable, Callable, List, Tuple, Union
+
+import aiosqlite
+
+log = logging.getLogger(__name__)
+
+Step = Union[str, Callable[[aiosqlite.Connection], Awaitable[None]]]
+
+
+# -------- Шаги --------
+
+_V1_BASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  tg_hash TEXT UNIQUE NOT NULL,
+  created_at INTEGER NOT NULL,
+  counter_reset_at INTEGER NOT NULL,
+  subscription_tier TEXT NOT NULL DEFAULT 'FREE',
+  subscription_until INTEGER,
+  daily_limit_remaining INTEGER NOT NULL DEFAULT 10,
+  bonus_messages INTEGER NOT NULL DEFAULT 0,
+  earned_referral_messages INTEGER NOT NULL DEFAULT 0,
+  referrer_hash TEXT,
+  tz_name TEXT,
+  gender TEXT NOT NULL DEFAULT 'male'
+);
+
+CREATE TABLE IF NOT EXISTS usage_events(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  tg_hash TEXT NOT NULL,
+  created_at INTEGER NOT NULL,
+  type TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS referrals(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  referrer_hash TEXT NOT NULL,
+  invitee_hash TEXT NOT NULL UNIQUE,
+  created_at INTEGER NOT NULL,
+  activated_at INTEGER,
+  status TEXT NOT NULL DEFAULT 'pending',
+  progress_count INTEGER NOT NULL DEFAULT 0,
+  expires_at INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS purchases(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  tg_hash TEXT NOT NULL,
+  created_at INTEGER NOT NULL,
+  kind TEXT NOT NULL,
+  meta TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS feedback(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  tg_hash TEXT NOT NULL,
+  created_at INTEGER NOT NULL,
+  blob BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS conv_buffer(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  tg_hash TEXT NOT NULL,
+  role TEXT NOT NULL,
+  created_at INTEGER NOT NULL,
+  blob BLOB NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_conv_hash_id ON conv_buffer(tg_hash, id);
+CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedback(created_at);
+
+CREATE TABLE IF NOT EXISTS flags(
+  user_id TEXT NOT NULL,
+  flag TEXT NOT NULL,
+  value TEXT NOT NULL,
+  updated REAL NOT NULL,
+  PRIMARY KEY(user_id, flag)
+);
+
+CREATE TABLE IF NOT EXISTS kv(
+  user_id TEXT NOT NULL,
+  key TEXT NOT NULL,
+  value TEXT,
+  updated REAL NOT NULL,
+  PRIMARY KEY(user_id, key)
+);
+
+CREATE TABLE IF NOT EXISTS stability(
+  user_id TEXT PRIMARY KEY,
+  label TEXT NOT NULL,
+  count INTEGER NOT NULL
+);
+"""
+
+
+async def _v2_users_tz_gender(db: aiosqlite.Connection) -> None:
+    """Старые базы создавались без users.tz_name / users.gender."""
+    cur = await db.execute("PRAGMA table_info(users)")
+    cols = [row[1] for row in await cur.fetchall()]
+    await cur.close()
+    if "tz_name" not in cols:
+        await db.execute("ALTER TABLE users ADD COLUMN tz_name TEXT")
+    if "gender" not in cols:
+        await db.execute("ALTER TABLE users ADD COLUMN gender TEXT DEFAULT 'male'")
+
+
+_V3_CONV_RING = """
+CREATE TABLE IF NOT EXISTS conv_ring(
+  tg_hash TEXT PRIMARY KEY,
+  updated_at INTEGER NOT NULL,
+  n_items INTEGER NOT NULL DEFAULT 0,
+  blob BLOB NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_conv_ring_updated_at ON conv_ring(updated_at);
+"""
+
+
+# day — номер суток UTC (unix_ts // 86400). Бэкфилл — из того, что осталось в истории.
+_V4_ACTIVITY = """
+CREATE TABLE IF NOT EXISTS activity_daily(
+  day INTEGER NOT NULL,
+  tg_hash TEXT NOT NULL,
+  messages INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(day, tg_hash)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS activity_user(
+  tg_hash TEXT PRIMARY KEY,
+  first_day INTEGER NOT NULL,
+  last_day INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_activity_user_last_day ON activity_user(last_day);
+
+INSERT OR IGNORE INTO activity_daily(day, tg_hash, messages)
+SELECT created_at / 86400, tg_hash, COUNT(*)
+FROM conv_buffer
+WHERE role = 'user'
+GROUP BY created_at / 86400, tg_hash;
+
+INSERT OR IGNORE INTO activity_daily(day, tg_hash, messages)
+SELECT updated_at / 86400, tg_hash, 1
+FROM conv_ring;
+
+INSERT OR IGNORE INTO activity_user(tg_hash, first_day, last_day)
+SELECT tg_hash, MIN(day), MAX(day)
+FROM activity_daily
+GROUP BY tg_hash;
+"""
+
+_V5_TOP_USERS = """
+CREATE INDEX IF NOT EXISTS idx_purchases_hash ON purchases(tg_hash);
+
+CREATE TABLE IF NOT EXISTS top_users_30d(
+  rank INTEGER PRIMARY KEY,
+  tg_hash TEXT NOT NULL,
+  msg_30d INTEGER NOT NULL,
+  has_purchases INTEGER NOT NULL,
+  has_subscription INTEGER NOT NULL,
+  refreshed_at INTEGER NOT NULL
+);
+"""
+
+# Поминутные агрегаты вызовов LLM (app/telemetry.py): счётчики аддитивные,
+# задержка — гистограмма по фиксированным корзинам (верхняя граница в мс в имени колонки)
+_V7_LLM_USAGE = """
+CREATE TABLE IF NOT EXISTS llm_usage_minute(
+  minute INTEGER NOT NULL,
+  site TEXT NOT NULL,
+  tier TEXT NOT NULL,
+  model TEXT NOT NULL,
+  calls INTEGER NOT NULL DEFAULT 0,
+  errors INTEGER NOT NULL DEFAULT 0,
+  retries INTEGER NOT NULL DEFAULT 0,
+  prompt_tokens INTEGER NOT NULL DEFAULT 0,
+  cache_hit_tokens INTEGER NOT NULL DEFAULT 0,
+  cache_miss_tokens INTEGER NOT NULL DEFAULT 0,
+  completion_tokens INTEGER NOT NULL DEFAULT 0,
+  latency_ms_sum INTEGER NOT NULL DEFAULT 0,
+  lat_le_250 INTEGER NOT NULL DEFAULT 0,
+  lat_le_500 INTEGER NOT NULL DEFAULT 0,
+  lat_le_1000 INTEGER NOT NULL DEFAULT 0,
+  lat_le_2000 INTEGER NOT NULL DEFAULT 0,
+  lat_le_4000 INTEGER NOT NULL DEFAULT 0,
+  lat_le_8000 INTEGER NOT NULL DEFAULT 0,
+  lat_gt_8000 INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (minute, site, tier, model)
+) WITHOUT ROWID;
+"""
+
+# Метки классификатора; версия промпта зашита в key, старые записи чистит планировщик по TTL
+_V8_CLASSIFY_CACHE = """
+CREATE TABLE IF NOT EXISTS classify_cache(
+  key TEXT PRIMARY KEY,
+  label TEXT NOT NULL,
+  confidence REAL NOT NULL,
+  created_at INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_classify_cache_created ON classify_cache(created_at);
+"""
+
+# Самая долгая задержка за минуту: корзина lat_gt_8000 сверху не ограничена, и p95 из неё
+# нельзя честно назвать числом без наблюдённого максимума
+_V9_LLM_USAGE_MAX = "ALTER TABLE llm_usage_minute ADD COLUMN latency_ms_max INTEGER NOT NULL DEFAULT 0;"
+
+MIGRATIONS: List[Tuple[int, str, Step]] = [
+    (1, "базовая схема", _V1_BASE_SCHEMA),
+    (2, "users.tz_name / users.gender", _v2_users_tz_gender),
+    (3, "conv_ring — история одним blob на пользователя", _V3_CONV_RING),
+    (4, "activity_daily / activity_user — rollup для DAU/WAU/MAU", _V4_ACTIVITY),
+    (5, "индекс purchases(tg_hash), витрина top_users_30d", _V5_TOP_USERS),
+    (6, "индекс users(counter_reset_at) для пакетного сброса", "CREATE INDEX IF NOT EXISTS idx_users_counter_reset_at ON users(counter_reset_at);"),
+    (7, "llm_usage_minute — телеметрия вызовов LLM", _V7_LLM_USAGE),
+    (8, "classify_cache — кэш меток классификатора", _V8_CLASSIFY_CACHE),
+    (9, "llm_usage_minute.latency_ms_max", _V9_LLM_USAGE_MAX),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# -------- Движок --------
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    cur = await db.execute("PRAGMA user_version")
+    row = await cur.fetchone()
+    await cur.close()
+    return int(row[0] or 0) if row else 0
+
+
+async def _exec_script(db: aiosqlite.Connection, script: str) -> None:
+    """
+    Выполняет SQL-скрипт по одному выражению.
+    executescript() сам делает COMMIT, а нам нужно остаться внутри транзакции шага.
+    """
+    buf = ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            await db.execute(buf)
+            buf = ""
+    if buf.strip():
+        await db.execute(buf)
+
+
+async def migrate(db: aiosqlite.Connection) -> int:
+    """
+    Применяет недостающие шаги, каждый — в своей транзакции вместе с новым user_version.
+    Возвращает итоговую версию схемы.
+    """
+    current = await get_schema_version(db)
+    if current > LATEST_VERSION:
+        log.warning("Версия схемы БД (%d) новее кода (%d)", current, LATEST_VERSION)
+        return current
+    if current == LATEST_VERSION:
+        return current
+
+    if db.in_transaction:
+        await db.commit()
+
+    for version, title, step in MIGRATIONS:
+        if version <= current:
+            continue
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            # второй процесс (админ-бот) мог успеть применить шаг, пока мы ждали блокировку
+            if await get_schema_version(db) >= version:
+                await db.rollback()
+                current = version
+                continue
+            if isinstance(step, str):
+                await _exec_script(db, step)
+            else:
+                await step(db)
+            await db.execute(f"PRAGMA user_version={int(version)}")
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        log.info("Миграция %d применена: %s", version, title)
+        current = version
+
+    return current
@@ -0,0 +1,205 @@
+# app/premod.py
+"""
+Локальная пре-модерация перед llm.classify: один проход автомата Ахо–Корасик
+по нормализованному тексту со словарями RU/EN.
+
+Запись словаря: "слово" — целое слово, "основа*" — любое слово с этого начала
+(морфология: "наркот*" ловит наркотики/наркоту/наркотический), во фразе
+звёздочка допустима только у последнего слова. Сильная запись решает сама,
+слабая — только вдвоём с ещё одной слабой той же метки.
+
+Очевидные случаи (одна метка набрала порог, других нет) размечаются
+локально, остальное уходит в LLM. Для оценки качества считаем TP/FP/FN по
+меткам относительно ответов LLM: по текстам, которые всё равно ушли в LLM,
+и по выборке локальных решений, перепроверенных LLM в фоне.
+"""
+from __future__ import annotations
+
+import re
+import time
+from collections import Counter, deque
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+STRONG = 1.0
+WEAK = 0.5
+THRESHOLD = 1.0
+
+# метка → (вес, записи)
+LEXICON: Dict[str, List[Tuple[float, List[str]]]] = {
+    "crisis": [
+        (STRONG, [
+            "покончить с собой", "покончу с собой", "суицид*", "самоубий*", "убить себя", "убью себя",
+            "не хочу жить", "хочу умереть", "повеситься", "повешусь", "вскрыть вены", "вскрою вены",
+            "порезать вены", "выйти в окно", "спрыгнуть с крыши", "наглотаться таблет*",
+            "kill myself", "suicid*", "want to die", "end my life", "self harm", "cut myself",
+        ]),
+        (WEAK, ["умереть", "жить не хочу", "нет смысла жить", "die"]),
+    ],
+    "illegal": [
+        (STRONG, [
+            "купить наркот*", "где купить наркот*", "мефедрон*", "кокаин*", "амфетамин*",
+            "гашиш*", "героин", "героина", "героином", "как сделать бомб*", "взрывчатк*", "отмыть деньги", "поддельный паспорт",
+            "поддельные документы", "buy drugs", "cocaine*", "heroin*", "make a bomb", "launder money",
+        ]),
+        (WEAK, ["наркот*", "закладк*", "спайс*", "взломать*", "обналич*", "hack*", "meth", "weed"]),
+    ],
+    "unsafe": [
+        (STRONG, ["изнасил*", "расчлен*", "зоофил*", "педофил*", "детское порно", "rape*", "child porn*"]),
+        (WEAK, ["порн*", "porn*", "gore", "nude*", "расстрелять*", "зарезать*"]),
+    ],
+    "boundaries": [
+        (STRONG, ["разденься", "раздевайся", "пришли нюдс*", "секс по переписке", "send nudes", "sexting"]),
+        (WEAK, ["секс*", "интим*", "пришли фото", "голая", "голый", "хочу тебя", "sex*", "horny"]),
+    ],
+    "romance": [
+        (STRONG, [
+            "я тебя люблю", "люблю тебя", "будь моей девушкой", "будь моим парнем", "давай встречаться",
+            "выйдешь за меня", "i love you", "be my girlfriend", "be my boyfriend", "marry me",
+        ]),
+        (WEAK, ["влюбил*", "влюблен*", "поцелу*", "свидани*", "date", "kiss*"]),
+    ],
+    "pro_advice": [
+        (STRONG, [
+            "подать в суд", "исковое заявление", "налоговый вычет", "какая дозировк*", "поставь диагноз",
+            "dosage", "file a lawsuit",
+        ]),
+        (WEAK, [
+            "диагноз*", "дозировк*", "лекарств*", "симптом*", "юрист*", "адвокат*", "кредит*",
+            "ипотек*", "инвестиц*", "инвестир*", "куда вложить", "diagnos*", "lawyer*", "invest*",
+        ]),
+    ],
+}
+
+LABELS = tuple(LEXICON)
+_NON_WORD = re.compile(r"[^0-9a-zа-я]+")
+
+
+def normalize(text: str) -> str:
+    """Нижний регистр, ё→е, всё кроме букв/цифр — пробел; пробелы по краям, чтобы якорить слова."""
+    t = (text or "").lower().replace("ё", "е")
+    return " " + _NON_WORD.sub(" ", t).strip() + " "
+
+
+def _pattern(entry: str) -> str:
+    stem = entry.endswith("*")
+    body = normalize(entry.rstrip("*")).strip()
+    return " " + body + ("" if stem else " ")
+
+
+class Automaton:
+    """Ахо–Корасик: все вхождения всех шаблонов за один проход по тексту."""
+
+    def __init__(self, patterns: Iterable[Tuple[str, object]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[Tuple[int, object]]] = [[]]  # (длина шаблона, payload)
+        for pat, payload in patterns:
+            node = 0
+            for ch in pat:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append((len(pat), payload))
+        # BFS: ссылки неудач и склейка выходов
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                cand = self._goto[f].get(ch, 0)
+                self._fail[nxt] = cand if cand != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+                queue.append(nxt)
+
+    def finditer(self, text: str) -> Iterator[Tuple[int, object]]:
+        """(позиция начала, payload) для каждого вхождения."""
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for length, payload in self._out[node]:
+                yield i - length + 1, payload
+
+
+class Verdict(NamedTuple):
+    label: Optional[str]  # None — неочевидно, нужен LLM
+    confidence: float
+    scores: Dict[str, float]
+
+
+class PreModerator:
+    def __init__(self, lexicon: Dict[str, List[Tuple[float, List[str]]]] = LEXICON):
+        patterns = []
+        for label, groups in lexicon.items():
+            for weight, entries in groups:
+                for e in entries:
+                    patterns.append((_pattern(e), (label, weight, e)))
+        self._ac = Automaton(patterns)
+        self.counters: Counter = Counter()
+        self._check_ns = 0
+
+    def check(self, text: str) -> Verdict:
+        t0 = time.perf_counter_ns()
+        norm = normalize(text)
+        scores: Dict[str, float] = {}
+        seen = set()
+        for start, (label, weight, entry) in self._ac.finditer(norm):
+            # "я не люблю тебя" — отрицание прямо перед шаблоном снимает его
+            if norm[max(0, start - 3):start + 1] == " не ":
+                continue
+            if entry in seen:
+                continue
+            seen.add(entry)
+            scores[label] = scores.get(label, 0.0) + weight
+        verdict = self._decide(scores)
+        self._check_ns += time.perf_counter_ns() - t0
+        self.counters["checked"] += 1
+        self.counters["local" if verdict.label else ("no_hits" if not scores else "ambiguous")] += 1
+        return verdict
+
+    @staticmethod
+    def _decide(scores: Dict[str, float]) -> Verdict:
+        if scores.get("crisis", 0.0) >= THRESHOLD:
+            # безопасность важнее точности: кризис не ждёт LLM
+            return Verdict("crisis", 0.9, scores)
+        strong = [l for l, s in scores.items() if s >= THRESHOLD]
+        if len(strong) == 1 and len(scores) == 1:
+            return Verdict(strong[0], 0.9, scores)
+        return Verdict(None, 0.0, scores)
+
+    def compare(self, local: Optional[str], llm_label: str) -> None:
+        """Сверка с LLM. local — локальная метка (или "normal", если так решили локально), None — не решили."""
+        self.counters["compared"] += 1
+        if local is not None and local != "normal":
+            self.counters[f"tp:{local}" if local == llm_label else f"fp:{local}"] += 1
+        if llm_label != "normal" and local != llm_label:
+            self.counters[f"fn:{llm_label}"] += 1
+
+    def stats(self) -> Dict[str, object]:
+        c = self.counters
+        per_label = {}
+        for label in LABELS:
+            tp, fp, fn = c[f"tp:{label}"], c[f"fp:{label}"], c[f"fn:{label}"]
+            if tp + fp + fn:
+                per_label[label] = {
+                    "precision": tp / (tp + fp) if tp + fp else None,
+                    "recall": tp / (tp + fn) if tp + fn else None,
+                    "tp": tp, "fp": fp, "fn": fn,
+                }
+        return {
+            "checked": c["checked"],
+            "local": c["local"],
+            "ambiguous": c["ambiguous"],
+            "no_hits": c["no_hits"],
+            "compared": c["compared"],
+            "avg_check_us": (self._check_ns / c["checked"] / 1000) if c["checked"] else 0.0,
+            "labels": per_label,
+        }
@@ -0,0 +1,116 @@
+# app/prompt_budget.py
+"""
+Оценка токенов без токенизатора и подбор истории под бюджет промпта.
+
+Порядок сообщений: system → история (старые → новые) → новая реплика.
+DeepSeek кэширует общий префикс запросов, поэтому начало окна истории
+держим на месте между репликами (якорь): окно растёт с конца, пока влезает
+в бюджет, и только потом разом сдвигается, ужимаясь до нижней отметки.
+Так system + старые реплики остаются побайтно одинаковыми несколько ходов подряд.
+"""
+from __future__ import annotations
+
+import hashlib
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# служебные токены на одно сообщение (роль, разделители)
+_MSG_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка под BPE-токенизатор DeepSeek: латиница и цифры ~4 символа
+    на токен, кириллица ~2.5, прочие непробельные символы (знаки, эмодзи) — по токену.
+    Ошибается скорее в большую сторону.
+    """
+    ascii_n = cyr_n = other_n = 0
+    for ch in text or "":
+        if ch.isspace():
+            continue
+        if ch.isascii():
+            if ch.isalnum():
+                ascii_n += 1
+            else:
+                other_n += 1
+        elif "Ѐ" <= ch <= "ӿ":
+            cyr_n += 1
+        else:
+            other_n += 1
+    return int(ascii_n / 4 + cyr_n / 2.5 + other_n + 0.999)
+
+
+def estimate_message(m: Dict[str, str]) -> int:
+    return estimate_tokens(m.get("content", "")) + _MSG_OVERHEAD
+
+
+def _fingerprint(m: Dict[str, str]) -> str:
+    h = hashlib.blake2b(digest_size=8)
+    h.update(m.get("role", "").encode("utf-8"))
+    h.update(b"\0")
+    h.update(m.get("content", "").encode("utf-8"))
+    return h.hexdigest()
+
+
+class HistoryBudgeter:
+    """
+    Выбирает окно истории под бюджет токенов с якорем на первом сообщении окна.
+    Якоря — в памяти процесса (LRU на max_users); потеря якоря стоит одного
+    промаха кэша у провайдера, не больше.
+    """
+
+    def __init__(self, budget_tokens: int, max_messages: int, low_watermark: float = 0.5, max_users: int = 10000):
+        self.budget = max(0, int(budget_tokens))
+        self.max_messages = max(0, int(max_messages))
+        self.low = min(1.0, max(0.0, float(low_watermark)))
+        self.max_users = max(1, int(max_users))
+        self._anchors: "OrderedDict[str, str]" = OrderedDict()
+
+        self.kept = 0      # ход с тем же началом окна (префикс не менялся)
+        self.reanchored = 0
+
+    def select(self, tg_hash: str, history: List[Dict[str, str]], fixed_tokens: int) -> List[Dict[str, str]]:
+        """
+        history — реплики от старых к новым; fixed_tokens — system + новая реплика.
+        Возвращает суффикс history, который влезает в бюджет.
+        """
+        budget = self.budget - int(fixed_tokens)
+        if budget <= 0 or not history or self.max_messages == 0:
+            self._anchors.pop(tg_hash, None)
+            return []
+        costs = [estimate_message(m) for m in history]
+
+        start = self._find_anchor(tg_hash, history)
+        if start is not None and len(history) - start <= self.max_messages and sum(costs[start:]) <= budget:
+            self.kept += 1
+        else:
+            # сдвигаем окно: берём новые реплики до нижней отметки, чтобы дальше снова расти
+            limit_tokens = budget * self.low
+            limit_msgs = max(1, int(self.max_messages * self.low))
+            start, total = len(history), 0
+            while start > 0 and len(history) - start < limit_msgs and total + costs[start - 1] <= limit_tokens:
+                start -= 1
+                total += costs[start]
+            self.reanchored += 1
+
+        window = history[start:]
+        if window:
+            self._anchors[tg_hash] = _fingerprint(window[0])
+            self._anchors.move_to_end(tg_hash)
+            while len(self._anchors) > self.max_users:
+                self._anchors.popitem(last=False)
+        else:
+            self._anchors.pop(tg_hash, None)
+        return window
+
+    def _find_anchor(self, tg_hash: str, history: List[Dict[str, str]]) -> Optional[int]:
+        fp = self._anchors.get(tg_hash)
+        if fp is None:
+            return None
+        for i, m in enumerate(history):
+            if _fingerprint(m) == fp:
+                return i
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        return {"users": len(self._anchors), "kept": self.kept, "reanchored": self.reanchored}
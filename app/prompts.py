@@ -51,6 +51,12 @@ UNSAFE_REPLIES = [
     "Блядь, у меня работы до ебени матери, иди уже нахуй!",
 ]
 
+# Кризис — единственный случай, когда Глеб не хамит
+CRISIS_REPLIES = [
+    "Слушай, без шуток: если тебе сейчас совсем хуево, позвони на бесплатный телефон доверия "
+    "8-800-2000-122 или в 112. Там живые люди, и они правда помогут.",
+]
+
 # ——— Варианты сообщений при «паузе» (лимит) ———
 LIMIT_NOTICE_VARIANTS = [
     'Наконец-то у тебя лимит блядь. В тишине побуду хоть чуть-чуть!',
@@ -76,3 +82,11 @@ Valid labels (choose exactly one):
 Respond with ONE LINE of compact JSON ONLY, no extra text:
 {"label": "<one_of_above>", "confidence": <0..1 number>}
 """
+
+# Пакетный режим классификатора (llm.classify при CLASSIFY_BATCH_MAX > 1):
+# дописывается к CLASSIFIER_PROMPT, реплики приходят JSON-массивом строк
+CLASSIFIER_BATCH_SUFFIX = """
+BATCH MODE: the user message is a JSON array of N separate messages. Classify each one independently.
+Respond with ONE LINE of compact JSON ONLY: an array of exactly N objects in the same order:
+[{"label": "<one_of_above>", "confidence": <0..1 number>}, ...]
+"""
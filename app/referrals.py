@@ -6,7 +6,7 @@ import time
 import hashlib
 from typing import Optional
 
-from .db import open_db
+from .db import write_db
 
 # ===== Параметры реферальной программы =====
 REF_BONUS = 10          # сколько сообщений даём рефереру при активации
@@ -55,8 +55,7 @@ async def accept_referral(ref_code: str, invitee_user_id: int) -> bool:
 # ===== НИЖЕ — ВАШИ ИСХОДНЫЕ ФУНКЦИИ (без изменений по логике) =====
 
 async def set_referrer_if_empty(invitee_hash: str, referrer_hash: str):
-    db = await open_db()
-    try:
+    async with write_db() as db:
         cur = await db.execute("SELECT referrer_hash FROM users WHERE tg_hash=?", (invitee_hash,))
         row = await cur.fetchone()
         await cur.close()
@@ -69,15 +68,11 @@ async def set_referrer_if_empty(invitee_hash: str, referrer_hash: str):
             "UPDATE users SET referrer_hash=? WHERE tg_hash=?",
             (referrer_hash, invitee_hash)
         )
-        await db.commit()
-    finally:
-        await db.close()
 
 async def create_pending_referral(referrer_hash: str, invitee_hash: str):
     now = int(time.time())
     expires = now + REF_DEADLINE_DAYS * 24 * 3600
-    db = await open_db()
-    try:
+    async with write_db() as db:
         # не создаём, если юзер уже есть
         cur = await db.execute("SELECT tg_hash FROM users WHERE tg_hash=?", (invitee_hash,))
         existing_user = await cur.fetchone()
@@ -97,13 +92,9 @@ async def create_pending_referral(referrer_hash: str, invitee_hash: str):
             "VALUES(?,?,?,?,?,?)",
             (referrer_hash, invitee_hash, now, "pending", 0, expires)
         )
-        await db.commit()
-    finally:
-        await db.close()
 
 async def on_counted_message(invitee_hash: str):
-    db = await open_db()
-    try:
+    async with write_db() as db:
         cur = await db.execute(
             "SELECT id, referrer_hash, progress_count, status, expires_at "
             "FROM referrals WHERE invitee_hash=?",
@@ -120,7 +111,6 @@ async def on_counted_message(invitee_hash: str):
 
         if expires_at and int(time.time()) > int(expires_at):
             await db.execute("UPDATE referrals SET status='expired' WHERE id=?", (ref_id,))
-            await db.commit()
             return
 
         prog += 1
@@ -148,19 +138,11 @@ async def on_counted_message(invitee_hash: str):
                         (grant, grant, referrer_hash)
                     )
 
-        await db.commit()
-    finally:
-        await db.close()
-
 async def sweep_expired():
-    db = await open_db()
-    try:
+    async with write_db() as db:
         now = int(time.time())
         await db.execute(
             "UPDATE referrals SET status='expired' "
             "WHERE status='pending' AND expires_at IS NOT NULL AND expires_at < ?",
             (now,)
         )
-        await db.commit()
-    finally:
-        await db.close()
@@ -0,0 +1,83 @@
+# app/scheduler.py
+"""
+Фоновые задачи основного бота (APScheduler в том же event loop, что и aiogram).
+
+start_scheduler() — после init_db(), shutdown_scheduler() — до close_db().
+"""
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timezone
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from .config import settings
+from .db import refresh_top_users_30d
+from .limits import reset_due_limits
+from .telemetry import flush_usage
+from .llm import prune_classify_cache
+
+log = logging.getLogger(__name__)
+
+_scheduler: AsyncIOScheduler | None = None
+
+
+async def _job_refresh_top_users() -> None:
+    n = await refresh_top_users_30d(limit=50)
+    log.debug("top_users_30d обновлён: %d строк", n)
+
+
+async def _job_reset_due_limits() -> None:
+    await reset_due_limits()
+
+
+async def _job_prune_classify_cache() -> None:
+    n = await prune_classify_cache()
+    log.debug("classify_cache: удалено %d устаревших меток", n)
+
+
+async def _job_flush_usage() -> None:
+    n = await flush_usage()
+    log.debug("llm_usage_minute: записано %d строк", n)
+
+
+def start_scheduler() -> AsyncIOScheduler:
+    """Создаёт и запускает планировщик (вызывать из работающего event loop)."""
+    global _scheduler
+    if _scheduler is not None:
+        return _scheduler
+
+    sched = AsyncIOScheduler(timezone="UTC", job_defaults={"coalesce": True, "max_instances": 1})
+    sched.add_job(
+        _job_refresh_top_users,
+        "interval",
+        minutes=max(1, int(settings.stats_refresh_min)),
+        id="refresh_top_users_30d",
+        next_run_time=datetime.now(timezone.utc),  # первая сборка витрины — сразу при старте
+    )
+    sched.add_job(
+        _job_reset_due_limits,
+        "interval",
+        seconds=max(5, int(settings.quota_reset_every_sec)),
+        id="reset_due_limits",
+        next_run_time=datetime.now(timezone.utc),  # после простоя — сразу догоняем пропущенные полуночи
+    )
+    sched.add_job(
+        _job_flush_usage,
+        "interval",
+        seconds=max(5, int(settings.telemetry_flush_sec)),
+        id="flush_llm_usage",
+    )
+    if settings.classify_cache_sqlite:
+        sched.add_job(_job_prune_classify_cache, "interval", hours=6, id="prune_classify_cache")
+    sched.start()
+    _scheduler = sched
+    log.info("Планировщик запущен: %s", ", ".join(j.id for j in sched.get_jobs()))
+    return sched
+
+
+def shutdown_scheduler() -> None:
+    global _scheduler
+    sched, _scheduler = _scheduler, None
+    if sched is not None:
+        sched.shutdown(wait=False)
@@ -0,0 +1,174 @@
+# app/telemetry.py
+"""
+Телеметрия вызовов LLM: токены (в т.ч. кэш префиксов), задержка, ретраи
+и ошибки по месту вызова (dialog, classify, ensure_russian, limit_pause…)
+и по тарифу пользователя.
+
+record() только складывает в поминутные корзины в памяти; flush_usage()
+пачкой дописывает их в llm_usage_minute (аддитивный UPSERT) — его зовёт
+планировщик и main() бота при остановке.
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import settings
+from .db import read_db, write_db
+
+# верхние границы корзин гистограммы задержки, мс (последняя корзина — всё, что дольше)
+LATENCY_BUCKETS_MS = (250, 500, 1000, 2000, 4000, 8000)
+_HIST_COLS = [f"lat_le_{b}" for b in LATENCY_BUCKETS_MS] + [f"lat_gt_{LATENCY_BUCKETS_MS[-1]}"]
+_COUNTERS = (
+    "calls", "errors", "retries", "prompt_tokens", "cache_hit_tokens",
+    "cache_miss_tokens", "completion_tokens", "latency_ms_sum",
+)
+# последняя ячейка строки — максимум задержки: складывается через MAX, а не суммой
+_MAX_COL = "latency_ms_max"
+_ROW_LEN = len(_COUNTERS) + len(_HIST_COLS) + 1
+
+Key = Tuple[int, str, str, str]  # (minute, site, tier, model)
+
+
+def _bucket(latency_ms: int) -> int:
+    for i, edge in enumerate(LATENCY_BUCKETS_MS):
+        if latency_ms <= edge:
+            return i
+    return len(LATENCY_BUCKETS_MS)
+
+
+class UsageAggregator:
+    def __init__(self):
+        self._rows: Dict[Key, List[int]] = {}
+        self._lock = asyncio.Lock()
+
+    def record(
+        self,
+        *,
+        site: str,
+        tier: str,
+        model: str,
+        latency_sec: float,
+        usage: Optional[Dict[str, Any]] = None,
+        retries: int = 0,
+        ok: bool = True,
+        now: Optional[float] = None,
+    ) -> None:
+        minute = int((time.time() if now is None else now) // 60)
+        key = (minute, site or "other", tier or "free", model or "")
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = [0] * _ROW_LEN
+        usage = usage or {}
+        latency_ms = max(0, int(latency_sec * 1000))
+        vals = (
+            1,
+            0 if ok else 1,
+            int(retries),
+            int(usage.get("prompt_tokens") or 0),
+            int(usage.get("prompt_cache_hit_tokens") or 0),
+            int(usage.get("prompt_cache_miss_tokens") or 0),
+            int(usage.get("completion_tokens") or 0),
+            latency_ms,
+        )
+        for i, v in enumerate(vals):
+            row[i] += v
+        row[len(_COUNTERS) + _bucket(latency_ms)] += 1
+        row[-1] = max(row[-1], latency_ms)
+
+    async def flush(self) -> int:
+        """Пишет накопленное в БД; при ошибке корзины возвращаются обратно. Возвращает число строк."""
+        async with self._lock:
+            rows, self._rows = self._rows, {}
+            if not rows:
+                return 0
+            cols = list(_COUNTERS) + _HIST_COLS
+            sql = (
+                f"INSERT INTO llm_usage_minute(minute, site, tier, model, {', '.join(cols)}, {_MAX_COL}) "
+                f"VALUES(?,?,?,?,{','.join('?' * len(cols))},?) "
+                "ON CONFLICT(minute, site, tier, model) DO UPDATE SET "
+                + ", ".join(f"{c}={c}+excluded.{c}" for c in cols)
+                + f", {_MAX_COL}=MAX({_MAX_COL}, excluded.{_MAX_COL})"
+            )
+            try:
+                async with write_db() as db:
+                    await db.executemany(sql, [(*k, *v) for k, v in rows.items()])
+            except Exception:
+                # вернём корзины, чтобы не потерять — сложатся с новыми
+                for k, v in rows.items():
+                    cur = self._rows.setdefault(k, [0] * len(v))
+                    for i, x in enumerate(v[:-1]):
+                        cur[i] += x
+                    cur[-1] = max(cur[-1], v[-1])
+                raise
+            return len(rows)
+
+
+_usage = UsageAggregator()
+
+
+def record_llm_call(**kw) -> None:
+    _usage.record(**kw)
+
+
+async def flush_usage() -> int:
+    return await _usage.flush()
+
+
+def _cost(prompt: int, hit: int, miss: int, completion: int) -> float:
+    """Стоимость в $ по ценам за 1M токенов из настроек (промпт без разбивки — как промах кэша)."""
+    if hit + miss < prompt:
+        miss = prompt - hit
+    return (
+        hit * settings.llm_price_cache_hit
+        + miss * settings.llm_price_cache_miss
+        + completion * settings.llm_price_output
+    ) / 1_000_000
+
+
+def _quantile_ms(hist: List[int], q: float, max_ms: int = 0) -> Optional[int]:
+    """
+    Оценка квантиля по гистограмме — верхняя граница корзины. У последней корзины
+    верхней границы нет: отдаём наблюдённый максимум (не меньше её нижней границы).
+    """
+    total = sum(hist)
+    if not total:
+        return None
+    need = q * total
+    acc = 0
+    for i, n in enumerate(hist):
+        acc += n
+        if acc >= need and i < len(LATENCY_BUCKETS_MS):
+            return LATENCY_BUCKETS_MS[i]
+    return max(int(max_ms), LATENCY_BUCKETS_MS[-1])
+
+
+async def get_usage_summary(since_ts: int, group_by: str = "tier") -> List[Dict[str, Any]]:
+    """Сводка с since_ts по tier или site: вызовы, ошибки, токены, $ и задержка (avg/p50/p95)."""
+    if group_by not in ("tier", "site"):
+        raise ValueError("group_by must be 'tier' or 'site'")
+    cols = list(_COUNTERS) + _HIST_COLS
+    async with read_db() as db:
+        cur = await db.execute(
+            f"SELECT {group_by}, {', '.join(f'SUM({c})' for c in cols)}, MAX({_MAX_COL}) "
+            f"FROM llm_usage_minute WHERE minute >= ? GROUP BY {group_by} ORDER BY {group_by}",
+            (int(since_ts) // 60,),
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+    out: List[Dict[str, Any]] = []
+    for r in rows:
+        c = dict(zip(_COUNTERS, (int(x or 0) for x in r[1:1 + len(_COUNTERS)])))
+        hist = [int(x or 0) for x in r[1 + len(_COUNTERS):-1]]
+        max_ms = int(r[-1] or 0)
+        c.update(
+            key=r[0],
+            cost_usd=_cost(c["prompt_tokens"], c["cache_hit_tokens"], c["cache_miss_tokens"], c["completion_tokens"]),
+            latency_avg_ms=c["latency_ms_sum"] // c["calls"] if c["calls"] else 0,
+            latency_p50_ms=_quantile_ms(hist, 0.5, max_ms),
+            latency_p95_ms=_quantile_ms(hist, 0.95, max_ms),
+            latency_max_ms=max_ms,
+        )
+        out.append(c)
+    return out
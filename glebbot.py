@@ -8,6 +8,10 @@ from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 
 from app.config import settings
+from app.db import init_db, close_db
+from app.llm import init_llm, close_llm
+from app.scheduler import start_scheduler, shutdown_scheduler
+from app.telemetry import flush_usage
 from app.handlers import (
     payments_stars_diag,  # перехватчик Stars
     payments,             # твоя основная оплата
@@ -33,11 +37,16 @@ async def main() -> None:
     log.info("Python: %s", sys.version.replace("\n", " "))
     log.info("BOT_TOKEN: %s***", settings.bot_token[:10])
 
-    # 2) Создаём бота/диспетчер
+    # 2) Пул соединений с БД, HTTP-сессия LLM (открываем один раз на процесс) и фоновые задачи
+    await init_db(main=True)
+    await init_llm()
+    start_scheduler()
+
+    # 3) Создаём бота/диспетчер
     bot = Bot(token=settings.bot_token, default=DefaultBotProperties(parse_mode="HTML"))
     dp = Dispatcher()
 
-    # 3) Подключаем роутеры
+    # 4) Подключаем роутеры
     dp.include_router(payments_stars_diag.router)   # 1) пусть именно он первый ловит Stars
     dp.include_router(payments.router)              # 2) твоя остальная оплата
     dp.include_router(start.router)
@@ -47,7 +56,7 @@ async def main() -> None:
     dp.include_router(diag_ping.router)             # опционально
     dp.include_router(diag_callbacks.router)    
 
-    # 4) Старт поллинга
+    # 5) Старт поллинга
     log.info("Стартуем polling...")
     try:
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
@@ -60,6 +69,19 @@ async def main() -> None:
             await bot.session.close()
         except Exception:
             log.exception("Ошибка при закрытии сессии")
+        shutdown_scheduler()
+        try:
+            await flush_usage()
+        except Exception:
+            log.exception("Ошибка при записи телеметрии LLM")
+        try:
+            await close_llm()
+        except Exception:
+            log.exception("Ошибка при закрытии LLM-клиента")
+        try:
+            await close_db()
+        except Exception:
+            log.exception("Ошибка при закрытии БД")
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,42 @@
+# tests/test_langdetect.py
+import pytest
+
+from app.langdetect import detect_lang, translit_local, translit_to_cyrillic
+
+
+@pytest.mark.parametrize("latin, cyrillic", [
+    ("ochen", "очень"),
+    ("zdes", "здесь"),
+    ("delaesh", "делаешь"),
+    ("vidish", "видишь"),
+    ("kazhetsya", "кажется"),
+    ("smeyutsya", "смеются"),
+    ("obyasni", "объясни"),
+    ("ochen'", "очень"),
+    ("eto", "это"),
+    ("moy", "мой"),
+    ("Privet", "Привет"),
+])
+def test_translit_soft_signs(latin, cyrillic):
+    assert translit_to_cyrillic(latin) == cyrillic
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Privet, kak dela? Chto delaesh segodnya?", "Привет, как дела? Что делаешь сегодня?"),
+    ("Ya ochen rad, chto ty zdes.", "Я очень рад, что ты здесь."),
+    ("Mne kazhetsya, eto khorosho.", "Мне кажется, это хорошо."),
+    ("Nichego strashnogo, byvaet", "Ничего страшного, бывает"),
+])
+def test_translit_local_confident(text, expected):
+    assert detect_lang(text) == "translit"
+    assert translit_local(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "Ty dolzhen uchitsya",             # учится / учиться
+    "Ne znayu, cho skazat tebe",       # сказать: ь не угадать
+    "On govorit pravdu, ya dumayu",    # говорит / говорить
+    "Nu eto prosto wow, ya v shoke",   # w — не транслит, обратно не сходится
+])
+def test_translit_local_ambiguous_goes_to_llm(text):
+    assert translit_local(text) is None